@@ -1,20 +1,32 @@
 import random
 import math
-import json
+import os
 import sys
-import numpy as np
-from cryptography.fernet import Fernet
-from path_oram_server import PathORAMServer
+from path_oram_server import PathORAMServer, level_offsets
+from block_codec import BinaryBlockCodec
+from cipher import AESGCMCipher
+from storage import InMemoryStorage
+from stash import Stash
+from crypto_pool import DummyPool
+from recursive_path_oram_client import _ArrayPositionMap, _save_state, _load_state, _check_layout, _flush
 
 
 class PathORAMClient:
-    def __init__(self, N, L=None, B=2**15, Z=4):
+    def __init__(self, N, L=None, B=2**15, Z=4, codec=None, cipher=None, storage=None, treetop_budget=0, batch_size=16,
+                 crypto_pool=None, dummy_pool_size=0, bucket_sizes=None, position_path=None, state_path=None):
         if N <= 0:
             raise ValueError(f"N={N} is not positive")
+        # per-level bucket capacities (root first) instead of Z, they set L
+        if bucket_sizes is not None:
+            if L is not None and L != len(bucket_sizes) - 1:
+                raise ValueError(f"{len(bucket_sizes)} bucket sizes given for L={L}")
+            L = len(bucket_sizes) - 1
+            Z = max(bucket_sizes)
         # height is 0 of tree with just root node
         if L is None:
             L = int(math.ceil(math.log(max(1, math.ceil(N / Z)), 2)))
-        total_N = (2 ** (L + 1) - 1) * Z
+        bucket_sizes = list(bucket_sizes) if bucket_sizes is not None else [Z] * (L + 1)
+        total_N = sum(2 ** l * z for l, z in enumerate(bucket_sizes))
         if N > total_N:
             raise ValueError(f"N={N} is too big given L={L} and Z={Z} (total_N={total_N})")
        
@@ -22,28 +34,86 @@ class PathORAMClient:
         self._total_N = total_N # total # blocks stored on server (including dummy blocks)
         self.L = L # height of binary tree
         self.B = B # block size (in bits)
-        self.Z = Z # capacity of each bucket (in blocks)
-
-        self.S = {} # stash
-        self.position = self._initialize_position() # position map
-
-        # encryption/decryption
-        key = Fernet.generate_key()
-        self.f = Fernet(key)
-
-        # client initializes dummy data and starts a new server with it
-        self.server = PathORAMServer(np.array(self._generate_initial_data()))
+        self.Z = Z # capacity of each bucket (in blocks), the largest one with per-level sizes
+        self.bucket_sizes = bucket_sizes # capacity of the buckets of every level, root first
+        self.batch_size = batch_size # paths per batch of access_many
+        self.codec = codec if codec is not None else BinaryBlockCodec(B) # block <-> B byte plaintext
+
+        self.S = Stash(leaf=lambda a, data: int(self.position[a])) # stash
+
+        # treetop cache: the top levels of the tree that fit in treetop_budget bytes are kept
+        # as plaintext buckets in client memory and are never read from or written to the server
+        self.treetop_levels = 0
+        while (self.treetop_levels <= L and
+               sum(2 ** l * z for l, z in enumerate(bucket_sizes[:self.treetop_levels + 1])) * B <= treetop_budget):
+            self.treetop_levels += 1
+        self._treetop = [{} for _ in range(2 ** self.treetop_levels - 1)] # bucket index -> bucket
+        # position map, the same in-memory map as Client's (memory-mapped to a .npy file with position_path)
+        self.position_map = _ArrayPositionMap(N, 2 ** L, position_path)
+        self.position = self.position_map._position
+        # client state file written by close(), an existing one reopens the ORAM (as in Client)
+        self.state_path = state_path
+        self._position_path = position_path
+        reopen = state_path is not None and os.path.exists(state_path)
+
+        # encryption/decryption, different bucket sizes need slots that do not depend on the bucket size
+        uniform = len(set(bucket_sizes)) == 1
+        if cipher is None:
+            cipher = AESGCMCipher() if uniform else AESGCMCipher(granularity="block")
+        self.cipher = cipher
+        if len({self.cipher.slot_size(z, B) for z in bucket_sizes}) > 1:
+            raise ValueError("Per-level bucket sizes need a cipher whose slot size does not depend on the bucket size")
+        self.crypto_pool = crypto_pool # optional crypto_pool.CryptoPool for the buckets of a path
+        # server slots per bucket, or per bucket of every level
+        self._slots = self.cipher.slots_per_bucket(Z) if uniform else [self.cipher.slots_per_bucket(z) for z in bucket_sizes]
+        self._dummy_block = self.codec.encode(-1, b"")
+        # background-refilled encrypted dummies for padding buckets (off by default)
+        self.dummy_pool = DummyPool(self.cipher, self._dummy_block, Z, dummy_pool_size) if dummy_pool_size else None
+
+        # client initializes dummy data and starts a new server with it, or reopens the tree already in storage
+        storage = storage if storage is not None else InMemoryStorage()
+        if reopen:
+            level_slots = self._slots if isinstance(self._slots, list) else [self._slots] * (L + 1)
+            _check_layout(storage, level_offsets(level_slots)[1], self.cipher.slot_size(Z, B))
+            state = _load_state(state_path)
+            self.S.update(state["stash"])
+            self._treetop = state["treetop"]
+            if position_path is None:
+                self.position[:] = state["position"]
+        else:
+            self._write_initial_data(storage)
+        self.server = PathORAMServer(storage, L, self._slots)
+
+    def close(self):
+        """
+            saves the client state to state_path (if given) and flushes the storage, so that the ORAM can be reopened,
+            and stops the dummy pool
+        """
+        if self.state_path is not None:
+            _save_state(self.state_path, {"stash": dict(self.S), "treetop": self._treetop,
+                                          "position": self.position if self._position_path is None else None})
+        _flush(self.server.data, self.position)
+        if self.dummy_pool is not None:
+            self.dummy_pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def access(self, op, a, new_data=None):
         # a is block id
-        x = self.position[a]
+        x = int(self.position[a])
         # assign new randomized path for a
         self.position[a] = self._uniform_random(2 ** self.L - 1)
         
-        # reads each bucket on the path and adds to stash
-        for l in range(self.L + 1):
-            read = (self._read_bucket(self._P(x, l)))
-            self.S = self.S | read
+        # reads the cached top of the path locally and the rest in one request, adding to stash
+        k = self.treetop_levels
+        for l in range(k):
+            self.S.update(self._treetop[2 ** l - 1 + (x >> (self.L - l))])
+        for bucket in self._open_buckets(self.server.read_path(x, k)):
+            self.S.update(bucket)
         
 
         if op == "write":
@@ -59,86 +129,124 @@ class PathORAMClient:
                 raise
         else:
             raise ValueError(f"Invalid op {op}")
-        for l in range(self.L, -1, -1):
-            S_prime = {}
-            # choose min(|S_prime}, Z) blocks from S_prime
-            for a_prime in self.S.keys():
-                if self._P(x, l) == self._P(self.position[a_prime], l):
-                    S_prime[a_prime] = self.S[a_prime]
-                    if len(S_prime) >= self.Z:
-                        break
-            for a_prime in S_prime.keys():
-                del self.S[a_prime]
-
-            self._write_bucket(self._P(x, l), S_prime)
-        
+        # greedily fill the buckets on the path from the leaf up
+        buckets = self.S.evict_path(x, self.L, self.bucket_sizes)
+        for l in range(k):
+            self._treetop[2 ** l - 1 + (x >> (self.L - l))] = buckets[l]
+
+        # writes the uncached part of the path back in one request
+        self.server.write_path(x, self._seal_buckets(buckets[k:], self.bucket_sizes[k:]), k)
         return data
-    
-    def _initialize_position(self):
-        # returns an initialized position map
-        position = {}
-        for i in range(self.N):
-            position[i] = self._uniform_random(2 ** self.L - 1) # 0 to num leafs - 1 (inclusive)
-        return position
-    
+
+    def access_many(self, requests, batch_size=None, return_exceptions=False):
+        """
+            requests: list of (op, a, new_data) (new_data is ignored for reads), returns the old data of every request.
+            Batches of at most batch_size distinct blocks read the union of batch_size paths (padded with random paths)
+            and are evicted over all of them in a single write back.
+            Reads of blocks that were never written raise KeyError once their batch has been written back,
+            with return_exceptions the KeyError is returned in their place instead.
+        """
+        batch_size = batch_size if batch_size is not None else self.batch_size
+        for op, _, new_data in requests:
+            if op not in ("read", "write"):
+                raise ValueError(f"Invalid op {op}")
+            if op == "write" and new_data is None:
+                raise ValueError("write op needs new_data")
+        results = []
+        i = 0
+        while i < len(requests):
+            blocks = {}
+            j = i
+            while j < len(requests) and (requests[j][1] in blocks or len(blocks) < batch_size):
+                blocks[requests[j][1]] = None
+                j += 1
+            batch_results = self._access_batch(requests[i:j], list(blocks), batch_size)
+            if not return_exceptions:
+                for result in batch_results:
+                    if isinstance(result, KeyError):
+                        raise result
+            results += batch_results
+            i = j
+        return results
+
+    def dummy_access(self, batch_size=None):
+        """a batch of random paths that touches no block"""
+        self._access_batch([], [], batch_size if batch_size is not None else self.batch_size)
+
+    def _access_batch(self, requests, blocks, batch_size):
+        leaves = [int(self.position[a]) for a in blocks]
+        leaves += [self._uniform_random(2 ** self.L - 1) for _ in range(batch_size - len(blocks))]
+        for a in blocks:
+            self.position[a] = self._uniform_random(2 ** self.L - 1)
+
+        # reads the cached top of the paths locally and the rest of their union in one request
+        k = self.treetop_levels
+        cached = {2 ** l - 1 + (x >> (self.L - l)) for x in leaves for l in range(k)}
+        for bucket in cached:
+            self.S.update(self._treetop[bucket])
+        for bucket in self._open_buckets(list(self.server.read_paths(leaves, k).values())):
+            self.S.update(bucket)
+
+        results = []
+        for op, a, new_data in requests:
+            if op == "write":
+                results.append(self.S.get(a))
+                self.S[a] = new_data
+            else:
+                if a not in self.S:
+                    # raised once the paths are written back, the other requests of the batch are still served
+                    print(f"Block not found in stash {a}", file=sys.stderr)
+                    results.append(KeyError(a))
+                else:
+                    results.append(self.S[a])
+
+        # greedy eviction over the union of the paths, the uncached buckets are written back in one request
+        buckets = self.S.evict_paths(leaves, self.L, self.bucket_sizes)
+        for bucket in cached:
+            self._treetop[bucket] = buckets.pop(bucket)
+        sizes = [self.bucket_sizes[(b + 1).bit_length() - 1] for b in buckets]
+        self.server.write_paths(dict(zip(buckets, self._seal_buckets(list(buckets.values()), sizes))))
+        return results
+        
     def _uniform_random(self, n):
         # return a uniform random int from 0 to n inclusive
         return random.randint(0, n)
     
-    def _generate_initial_data(self):
-        return [self._create_dummy_block() for _ in range(self._total_N)]
-    
-    def _create_dummy_block(self):
-        return self._encrypt_block((-1, ""))
-
-    def _P(self, x, l):
-        return (2 ** l - 1 + x // 2 ** (self.L - l)) * self.Z
-
-    def _read_bucket(self, bucket):
+    def _write_initial_data(self, storage):
+        # fills storage with encrypted empty buckets, one level at a time
+        level_slots = self._slots if isinstance(self._slots, list) else [self._slots] * (self.L + 1)
+        offsets, num_slots = level_offsets(level_slots)
+        storage.allocate(num_slots, self.cipher.slot_size(self.Z, self.B))
+        for l, (offset, slots) in enumerate(zip(offsets, level_slots)):
+            for k in range(2 ** l):
+                storage.write_range(offset + k * slots, offset + (k + 1) * slots, self._seal_bucket({}, self.bucket_sizes[l]))
+
+    # _seal_bucket encrypts a bucket and pads it with dummy blocks if needed
+    def _seal_bucket(self, data, Z): # data should be dict a -> data
+        blocks = [self.codec.encode(a, block_data) for a, block_data in data.items()]
+        if self.dummy_pool is not None:
+            return self.dummy_pool.seal(blocks, Z)
+        blocks += [self._dummy_block] * (Z - len(blocks))
+        return self.cipher.seal(blocks)
+
+    def _open_bucket(self, slots):
         bucket_blocks = {}
-        for i in range(self.Z):
-            encrypted_block = self.server.read_block(bucket + i)
-            a, data = self._decrypt_block(encrypted_block)
-
+        for block in self.cipher.open(slots, self.B):
+            a, data, _ = self.codec.decode(block)
             if a != -1: # not dummy
                 bucket_blocks[a] = data
-
         return bucket_blocks
 
-    # _write_bucket write data back to bucket and pads with dummy blocks if needed
-    def _write_bucket(self, bucket, data):
-        for i, block in enumerate(data.items()):
-            encrypted_block = self._encrypt_block(block)
-            self.server.write_block(bucket + i, encrypted_block)
-        for i in range(len(data), self.Z):
-            encrypted_block = self._create_dummy_block()
-            self.server.write_block(bucket + i, encrypted_block)
-
-    def _encrypt_block(self, block): # block should be (a, data)
-        byte_block = json.dumps(block).encode("utf-8")
-        padded_block = self._pad_block(byte_block)
-        encrypted_block = self._encrypt(padded_block)
-        return encrypted_block
-
-    def _decrypt_block(self, block):
-        padded_decrypted_byte_block = self._decrypt(block)
-        decrypted_byte_block = self._depad_block(padded_decrypted_byte_block)
-        decrypted_block = decrypted_byte_block.decode("utf-8")
-        a, data = json.loads(decrypted_block)
-        return a, data
-    
-    def _pad_block(self, block):
-        if len(block) > self.B:
-            raise ValueError(f"Block size {len(block)} is larger than B={self.B}")
-        if len(block) == self.B:
-            return block
-        return block + b"\x01" + b"\x00" * (self.B - len(block) - 1)
-
-    def _depad_block(self, block):
-        return block.rstrip(b"\x00").removesuffix(b"\x01")
-
-    def _encrypt(self, data, identity=False):
-        return self.f.encrypt(data) if not identity else data
-
-    def _decrypt(self, data, identity=False):
-        return self.f.decrypt(data) if not identity else data
+    def _seal_buckets(self, buckets, sizes):
+        # list of buckets (dict a -> data) and their capacities -> list of the slots of every bucket
+        if self.crypto_pool is None:
+            return [self._seal_bucket(data, Z) for data, Z in zip(buckets, sizes)]
+        blocks = [[(a, block_data, ()) for a, block_data in data.items()] for data in buckets]
+        return self.crypto_pool.seal_buckets(self.cipher, self.codec, blocks, sizes, self._dummy_block, self.dummy_pool)
+
+    def _open_buckets(self, buckets):
+        # inverse of _seal_buckets
+        if self.crypto_pool is None:
+            return [self._open_bucket(slots) for slots in buckets]
+        return [{a: data for a, data, _ in blocks if a != -1}
+                for blocks in self.crypto_pool.open_buckets(self.cipher, self.codec, buckets, self.B)]
@@ -0,0 +1,90 @@
+import json
+import struct
+
+
+class BinaryBlockCodec:
+    """
+        Fixed-width binary block format:
+        header (block id, #positions, payload type, payload length), the positions
+        (leaf for Path ORAM, p_0, ..., p_l for rORAM), then the raw payload, zero padded to B bytes.
+    """
+
+    _HEADER = struct.Struct("<qBBI")
+    _POSITION = struct.Struct("<q")
+
+    # payload types
+    _NONE = 0
+    _BYTES = 1
+    _STR = 2
+    _JSON = 3  # anything else that is json serializable (lists, dicts, ints, ...)
+
+    def __init__(self, B):
+        self.B = B  # encoded block size (in bytes)
+
+    def overhead(self, num_positions=1):
+        """bytes of each block taken up by the header"""
+        return self._HEADER.size + self._POSITION.size * num_positions
+
+    def encode(self, a, data, positions=()):
+        if data is None:
+            kind, payload = self._NONE, b""
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            kind, payload = self._BYTES, data
+        elif isinstance(data, str):
+            kind, payload = self._STR, data.encode("utf-8")
+        else:
+            kind, payload = self._JSON, json.dumps(data).encode("utf-8")
+
+        size = self.overhead(len(positions)) + len(payload)
+        if size > self.B:
+            raise ValueError(f"Block size {size} is larger than B={self.B}")
+        block = bytearray(self.B)
+        self._HEADER.pack_into(block, 0, a, len(positions), kind, len(payload))
+        offset = self._HEADER.size
+        for p in positions:
+            self._POSITION.pack_into(block, offset, p)
+            offset += self._POSITION.size
+        block[offset:offset + len(payload)] = payload
+        return bytes(block)
+
+    def decode(self, block):
+        # block: bytes-like of length B; returns (a, data, positions)
+        view = memoryview(block)
+        a, num_positions, kind, length = self._HEADER.unpack_from(view, 0)
+        offset = self._HEADER.size
+        positions = [self._POSITION.unpack_from(view, offset + k * self._POSITION.size)[0] for k in range(num_positions)]
+        offset += self._POSITION.size * num_positions
+        payload = view[offset:offset + length]
+        if kind == self._BYTES:
+            data = bytes(payload)
+        elif kind == self._STR:
+            data = str(payload, "utf-8")
+        elif kind == self._JSON:
+            data = json.loads(bytes(payload))
+        else:
+            data = None
+        return a, data, positions
+
+
+class JSONBlockCodec:
+    """The original format: json list [a, data, *positions] padded with 0x01 0x00... to B bytes."""
+
+    def __init__(self, B):
+        self.B = B  # encoded block size (in bytes)
+
+    def overhead(self, num_positions=1):
+        return 0
+
+    def encode(self, a, data, positions=()):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError("JSONBlockCodec cannot store binary data, use BinaryBlockCodec")
+        block = json.dumps([a, data, *positions]).encode("utf-8")
+        if len(block) > self.B:
+            raise ValueError(f"Block size {len(block)} is larger than B={self.B}")
+        if len(block) == self.B:
+            return block
+        return block + b"\x01" + b"\x00" * (self.B - len(block) - 1)
+
+    def decode(self, block):
+        a, data, *positions = json.loads(bytes(block).rstrip(b"\x00").removesuffix(b"\x01"))
+        return a, data, positions
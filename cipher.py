@@ -0,0 +1,108 @@
+import os
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+
+
+class FernetCipher:
+    """Per-block Fernet tokens (AES-CBC + HMAC, base64 encoded). This is the original behavior."""
+
+    def __init__(self, key=None):
+        self.key = key if key is not None else Fernet.generate_key()
+        self.f = Fernet(self.key)
+
+    # picklable (for process pools) by key
+    def __getstate__(self):
+        return {"key": self.key}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def encrypt(self, data):
+        return self.f.encrypt(bytes(data))
+
+    def decrypt(self, data):
+        return self.f.decrypt(bytes(data))
+
+    def slots_per_bucket(self, Z):
+        # number of ciphertexts the server stores per bucket of Z blocks
+        return Z
+
+    def slot_size(self, Z, B):
+        # size of each ciphertext: version, timestamp, iv, cbc padded block and hmac, base64 encoded
+        raw = 1 + 8 + 16 + (B // 16 + 1) * 16 + 32
+        return (raw + 2) // 3 * 4
+
+    def seal(self, blocks):
+        """blocks: the Z plaintext blocks of one bucket -> list of slots_per_bucket ciphertexts"""
+        return [self.encrypt(block) for block in blocks]
+
+    def open(self, slots, B):
+        """inverse of seal, returns the plaintext blocks (each B bytes)"""
+        return [self.decrypt(slot) for slot in slots]
+
+
+class AESGCMCipher:
+    """
+        AEAD cipher with raw binary output (nonce || ciphertext || tag).
+        granularity="bucket" seals the Z blocks of a bucket as one unit (one nonce and tag per bucket),
+        granularity="block" encrypts every block on its own.
+    """
+
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    def __init__(self, key=None, granularity="bucket"):
+        if granularity not in ("block", "bucket"):
+            raise ValueError(f"Invalid granularity {granularity}")
+        self.key = key if key is not None else self._generate_key()
+        self.granularity = granularity
+        self._aead = self._primitive(self.key)
+
+    # picklable (for process pools) by key, the AEAD object itself is not
+    def __getstate__(self):
+        return {"key": self.key, "granularity": self.granularity}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _generate_key(self):
+        return AESGCM.generate_key(bit_length=128)
+
+    def _primitive(self, key):
+        return AESGCM(key)
+
+    def encrypt(self, data):
+        nonce = os.urandom(self.NONCE_SIZE)
+        return nonce + self._aead.encrypt(nonce, data, None)
+
+    def decrypt(self, data):
+        view = memoryview(data)
+        return self._aead.decrypt(view[:self.NONCE_SIZE], view[self.NONCE_SIZE:], None)
+
+    def slots_per_bucket(self, Z):
+        return 1 if self.granularity == "bucket" else Z
+
+    def slot_size(self, Z, B):
+        plaintext_size = Z * B if self.granularity == "bucket" else B
+        return self.NONCE_SIZE + plaintext_size + self.TAG_SIZE
+
+    def seal(self, blocks):
+        if self.granularity == "bucket":
+            return [self.encrypt(b"".join(blocks))]
+        return [self.encrypt(block) for block in blocks]
+
+    def open(self, slots, B):
+        if self.granularity == "bucket":
+            view = memoryview(self.decrypt(slots[0]))
+            return [view[k:k + B] for k in range(0, len(view), B)]
+        return [self.decrypt(slot) for slot in slots]
+
+
+class ChaCha20Poly1305Cipher(AESGCMCipher):
+    """Same as AESGCMCipher but with ChaCha20-Poly1305 (faster without AES-NI)."""
+
+    def _generate_key(self):
+        return ChaCha20Poly1305.generate_key()
+
+    def _primitive(self, key):
+        return ChaCha20Poly1305(key)
@@ -0,0 +1,189 @@
+import collections
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _seal_chunk(cipher, codec, dummy_block, buckets, dummy_pool=None):
+    # buckets: list of (bucket, Z), each bucket a list of (a, data, positions) -> list of the slots of every bucket
+    sealed = []
+    for bucket, Z in buckets:
+        blocks = [codec.encode(a, data, positions) for a, data, positions in bucket]
+        if dummy_pool is not None:
+            sealed.append(dummy_pool.seal(blocks, Z))
+            continue
+        blocks += [dummy_block] * (Z - len(blocks))
+        sealed.append(cipher.seal(blocks))
+    return sealed
+
+
+def _open_chunk(cipher, codec, B, buckets):
+    # buckets: list of the slots of every bucket -> list of buckets, each a list of (a, data, positions) (dummies included)
+    return [[codec.decode(block) for block in cipher.open(slots, B)] for slots in buckets]
+
+
+class CryptoPool:
+    """
+        Opt-in executor that encodes and seals (or opens and decodes) many buckets in parallel chunks,
+        one chunk per worker.
+        kind="thread" is enough for the cryptography primitives, which release the GIL,
+        kind="process" also runs the pure-Python codecs in parallel (ciphers and codecs are pickled).
+        A pool can be shared by several clients, e.g. all the sub-ORAMs of an RORAMClient.
+    """
+
+    def __init__(self, workers=None, kind="thread"):
+        self.workers = workers if workers is not None else os.cpu_count() or 1
+        self.kind = kind
+        if kind == "thread":
+            self._executor = ThreadPoolExecutor(self.workers)
+        elif kind == "process":
+            self._executor = ProcessPoolExecutor(self.workers)
+        else:
+            raise ValueError(f"Invalid kind {kind}")
+
+    def seal_buckets(self, cipher, codec, buckets, Z, dummy_block, dummy_pool=None):
+        """
+            buckets: list of buckets, each a list of (a, data, positions) -> list of the slots of every bucket
+            Z is the capacity of every bucket, or a list of the capacity of each bucket.
+            dummy_pool (a DummyPool of this process) pads the buckets in thread pools, process pools encrypt their own dummies.
+        """
+        buckets = list(zip(buckets, Z if isinstance(Z, (list, tuple)) else [Z] * len(buckets)))
+        if self.kind == "thread" and dummy_pool is not None:
+            return self._map(lambda *args: _seal_chunk(*args, dummy_pool), (cipher, codec, dummy_block), buckets)
+        return self._map(_seal_chunk, (cipher, codec, dummy_block), buckets)
+
+    def open_buckets(self, cipher, codec, buckets, B):
+        """buckets: list of the slots of every bucket -> list of buckets, each a list of (a, data, positions)"""
+        if self.kind == "process":
+            buckets = [[bytes(slot) for slot in slots] for slots in buckets] # memoryviews cannot be pickled
+        return self._map(_open_chunk, (cipher, codec, B), buckets)
+
+    def _map(self, fn, args, buckets):
+        if len(buckets) <= 1 or self.workers == 1:
+            return fn(*args, buckets)
+        size = -(-len(buckets) // self.workers)
+        futures = [self._executor.submit(fn, *args, buckets[k:k + size]) for k in range(0, len(buckets), size)]
+        return [bucket for future in futures for bucket in future.result()]
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+class DummyPool:
+    """
+        Pool of freshly encrypted dummies that a background thread keeps refilled, so that padding
+        a bucket does not encrypt dummies on the write path. Every pooled ciphertext is used once.
+        Ciphers that encrypt blocks one by one (slots_per_bucket(Z) == Z) pool dummy block ciphertexts,
+        bucket granularity ciphers pool sealed empty buckets (a partly full bucket is sealed as one unit anyway).
+        When the pool runs dry the dummies are encrypted inline and counted as starved (see stats).
+        close() stops the refill thread. The thread only holds a weak reference to the pool,
+        so a pool that is never closed still stops it when it is garbage collected.
+    """
+
+    _REFILL_BATCH = 64 # dummies encrypted per refill round
+
+    def __init__(self, cipher, dummy_block, Z, capacity=1024):
+        self.cipher = cipher
+        self.dummy_block = dummy_block # encoded dummy block (plaintext)
+        self.Z = Z
+        self.capacity = capacity
+        self._per_block = cipher.slots_per_bucket(Z) == Z
+        self._pool = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # metrics
+        self.generated = 0 # dummies encrypted by the refill thread
+        self.served = 0 # dummies taken from the pool
+        self.starved = 0 # dummies encrypted inline because the pool was empty
+        self._refill_time = 0.0 # seconds the refill thread spent encrypting
+
+        self._thread = threading.Thread(target=_refill, args=(weakref.ref(self), self._cond), daemon=True)
+        self._thread.start()
+        weakref.finalize(self, _wake, self._cond) # wakes the refill thread up to exit
+
+    def _dummy(self):
+        # a fresh dummy block ciphertext, or a freshly sealed empty bucket
+        if self._per_block:
+            return self.cipher.encrypt(self.dummy_block)
+        return self.cipher.seal([self.dummy_block] * self.Z)
+
+    def _take(self, n):
+        with self._cond:
+            dummies = [self._pool.popleft() for _ in range(min(n, len(self._pool)))]
+            self.served += len(dummies)
+            self.starved += n - len(dummies)
+            self._cond.notify()
+        return dummies + [self._dummy() for _ in range(n - len(dummies))]
+
+    def seal(self, blocks, Z=None):
+        """
+            blocks: the encoded real blocks of a bucket (at most Z) -> the slots of the bucket padded with dummies.
+            Z overrides the bucket capacity for ciphers that encrypt blocks one by one (per-level bucket sizes).
+        """
+        Z = Z if Z is not None else self.Z
+        if self._per_block:
+            return [self.cipher.encrypt(block) for block in blocks] + self._take(Z - len(blocks))
+        if Z != self.Z:
+            raise ValueError(f"Pooled buckets hold Z={self.Z} blocks, not {Z}")
+        if blocks:
+            return self.cipher.seal(list(blocks) + [self.dummy_block] * (self.Z - len(blocks)))
+        return self._take(1)[0]
+
+    def stats(self):
+        """pool size, generated/served/starved counts and the refill rate (dummies per second of refilling)"""
+        with self._cond:
+            return {
+                "size": len(self._pool),
+                "generated": self.generated,
+                "served": self.served,
+                "starved": self.starved,
+                "refill_rate": self.generated / self._refill_time if self._refill_time else 0.0,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _refill(pool_ref, cond):
+    # refill thread of a DummyPool, it only holds the pool while it is encrypting and not while it waits
+    while True:
+        with cond:
+            pool = pool_ref()
+            if pool is None or pool._closed:
+                return
+            if len(pool._pool) >= pool.capacity:
+                del pool
+                if pool_ref() is None: # just collected by this thread
+                    return
+                cond.wait()
+                continue
+            n = min(pool._REFILL_BATCH, pool.capacity - len(pool._pool))
+        start = time.perf_counter()
+        dummies = [pool._dummy() for _ in range(n)]
+        with cond:
+            pool._refill_time += time.perf_counter() - start
+            pool.generated += n
+            pool._pool.extend(dummies)
+        del pool
+
+
+def _wake(cond):
+    with cond:
+        cond.notify()
@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import atexit
+import struct
+import threading
+import uuid
+from storage import InMemoryStorage
+
+# Length-prefixed binary protocol. Every frame is
+#   request:  length (of the rest) | request id | opcode | body
+#   response: length (of the rest) | request id | status | body
+# The server executes the requests of a connection in order, so a client can pipeline
+# requests (send more before the responses arrive) and match the responses by request id.
+_FRAME = struct.Struct("<IQB")
+_GEOMETRY = struct.Struct("<QQ") # number of slots, slot size
+_COUNT = struct.Struct("<I")
+_RANGE = struct.Struct("<QQ") # [i,j) in slots
+_PENDING_RESPONSES = 64 # delayed responses queued per connection before the server stops reading requests
+
+# opcodes
+OPEN = 1 # body: storage name (utf-8) -> geometry of the storage (0, 0 if it is new)
+ALLOCATE = 2 # body: geometry
+READ_RANGES = 3 # body: count, ranges -> the slots of all the ranges, concatenated
+WRITE_RANGES = 4 # body: count, ranges, the slots of all the ranges, concatenated
+
+# statuses
+OK = 0
+ERROR = 1 # body: error message (utf-8)
+
+
+class RemoteError(Exception):
+    """an error raised by the server while executing a request"""
+
+
+def _pack_ranges(ranges):
+    return _COUNT.pack(len(ranges)) + b"".join(_RANGE.pack(i, j) for i, j in ranges)
+
+
+def _unpack_ranges(body):
+    count, = _COUNT.unpack_from(body, 0)
+    ranges = [_RANGE.unpack_from(body, _COUNT.size + k * _RANGE.size) for k in range(count)]
+    return ranges, _COUNT.size + count * _RANGE.size
+
+
+class ORAMStorageServer:
+    """
+        asyncio server that stores the slots of ORAM trees (one storage backend per name, created by storage_factory).
+        Block, bucket and slice operations are slot ranges, and a whole path (or a union of paths) is a single
+        READ_RANGES/WRITE_RANGES request.
+        latency (in seconds) delays every response to simulate a round trip, without stopping the server from
+        reading and executing the requests that are pipelined behind it. At most _PENDING_RESPONSES delayed responses
+        wait per connection, and they are drained, so a client that stops reading stops the server from reading.
+    """
+
+    def __init__(self, storage_factory=InMemoryStorage, latency=0.0):
+        self.storage_factory = storage_factory
+        self.latency = latency
+        self.storages = {} # name -> storage backend
+        self._server = None
+        self._connections = {} # writer -> task handling the connection
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        """stops accepting connections and closes the open ones"""
+        if self._server is not None:
+            self._server.close()
+        tasks = list(self._connections.values())
+        for writer in self._connections:
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        self._connections[writer] = asyncio.current_task()
+        storage = None
+        if self.latency:
+            responses = asyncio.Queue(_PENDING_RESPONSES) # (due time, request id, status, payload)
+            sender = asyncio.get_running_loop().create_task(self._send_delayed(writer, responses))
+        try:
+            while True:
+                length, request_id, op = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+                body = await reader.readexactly(length - _FRAME.size + 4)
+                try:
+                    if op == OPEN:
+                        name = body.decode("utf-8")
+                        storage = self.storages.setdefault(name, self.storage_factory())
+                        payload = _GEOMETRY.pack(len(storage), storage.slot_size or 0)
+                    elif storage is None:
+                        raise ValueError("no storage opened on this connection")
+                    else:
+                        payload = self._execute(storage, op, body)
+                    status = OK
+                except Exception as e:
+                    status, payload = ERROR, f"{type(e).__name__}: {e}".encode("utf-8")
+                if self.latency:
+                    await responses.put((asyncio.get_running_loop().time() + self.latency, request_id, status, payload))
+                else:
+                    self._respond(writer, request_id, status, payload)
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            del self._connections[writer]
+            if self.latency:
+                sender.cancel()
+            writer.close()
+
+    def _execute(self, storage, op, body):
+        if op == ALLOCATE:
+            storage.allocate(*_GEOMETRY.unpack(body))
+            return b""
+        if op == READ_RANGES:
+            ranges, _ = _unpack_ranges(body)
+            empty = bytes(storage.slot_size)
+            return b"".join(slot if slot is not None else empty # never written
+                            for slots in storage.read_ranges(ranges) for slot in slots)
+        if op == WRITE_RANGES:
+            ranges, offset = _unpack_ranges(body)
+            view = memoryview(body)
+            slots = []
+            for i, j in ranges:
+                slots.append([view[offset + k * storage.slot_size:offset + (k + 1) * storage.slot_size]
+                              for k in range(j - i)])
+                offset += (j - i) * storage.slot_size
+            storage.write_ranges(ranges, [[bytes(slot) for slot in range_slots] for range_slots in slots])
+            return b""
+        raise ValueError(f"Invalid opcode {op}")
+
+    def _respond(self, writer, request_id, status, payload):
+        if not writer.is_closing():
+            writer.write(_FRAME.pack(_FRAME.size - 4 + len(payload), request_id, status) + payload)
+
+    async def _send_delayed(self, writer, responses):
+        # sends the queued responses in order once they are due, draining after each one
+        loop = asyncio.get_running_loop()
+        while True:
+            due, request_id, status, payload = await responses.get()
+            await asyncio.sleep(due - loop.time())
+            self._respond(writer, request_id, status, payload)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass # the connection handler sees it too and stops
+
+
+class AsyncTransport:
+    """
+        Pipelined asyncio client connection: send() writes a request right away and returns a future for its
+        response, so any number of requests can be outstanding at once.
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._pending = {} # request id -> future
+        self._next_id = 0
+        self._receiver = asyncio.get_running_loop().create_task(self._receive())
+
+    @classmethod
+    async def connect(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def send(self, op, body=b""):
+        request_id = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        self._writer.write(_FRAME.pack(_FRAME.size - 4 + len(body), request_id, op) + body)
+        return future
+
+    async def request(self, op, body=b""):
+        return await self.send(op, body)
+
+    async def _receive(self):
+        try:
+            while True:
+                length, request_id, status = _FRAME.unpack(await self._reader.readexactly(_FRAME.size))
+                payload = await self._reader.readexactly(length - _FRAME.size + 4)
+                future = self._pending.pop(request_id)
+                if status == OK:
+                    future.set_result(payload)
+                else:
+                    future.set_exception(RemoteError(payload.decode("utf-8")))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in self._pending.values():
+                future.set_exception(ConnectionError(f"connection to the server was lost: {e}"))
+            self._pending.clear()
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        self._receiver.cancel()
+
+
+class _EventLoopThread:
+    # a background event loop shared by all the RemoteStorage instances of the process
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self):
+        _stop_loop(self.loop, self._thread)
+
+
+async def _cancel_tasks():
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _stop_loop(loop, thread):
+    # cancels the tasks of a loop running in thread (connections, pending requests) and stops it
+    if loop.is_running():
+        asyncio.run_coroutine_threadsafe(_cancel_tasks(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
+class RemoteStorage:
+    """
+        storage backend on an ORAMStorageServer, usable wherever InMemoryStorage is (storage=, storage_factory=).
+        Writes are pipelined: they return as soon as the request is sent and are acknowledged in the background,
+        so a path write and the next path read cost a single round trip. Errors of a write are raised by
+        the next call (or by flush).
+        name selects the storage on the server (a fresh one by default), reconnecting with the same name
+        reopens it.
+    """
+
+    def __init__(self, host, port, name=None):
+        self.name = name if name is not None else uuid.uuid4().hex
+        self._loop = _EventLoopThread.get()
+        self._transport = self._loop.run(AsyncTransport.connect(host, port))
+        self._unacknowledged = []
+        self.num_slots, self.slot_size = _GEOMETRY.unpack(self._request(OPEN, self.name.encode("utf-8")))
+        self.slot_size = self.slot_size or None
+
+    def _request(self, op, body=b""):
+        self._check_writes()
+        return self._loop.run(self._transport.request(op, body))
+
+    def _post(self, op, body):
+        self._check_writes()
+        # scheduled in order behind the requests before it, without waiting for the response
+        self._unacknowledged.append(asyncio.run_coroutine_threadsafe(self._transport.request(op, body), self._loop.loop))
+
+    def _check_writes(self):
+        # raises the error of a failed write, forgets the acknowledged ones
+        failed = [future for future in self._unacknowledged if future.done() and future.exception() is not None]
+        self._unacknowledged = [future for future in self._unacknowledged if not future.done()]
+        if failed:
+            raise failed[0].exception()
+
+    def flush(self):
+        """waits until every write has been acknowledged"""
+        futures, self._unacknowledged = self._unacknowledged, []
+        for future in futures:
+            future.result()
+
+    def allocate(self, num_slots, slot_size):
+        if (self.num_slots, self.slot_size) == (num_slots, slot_size):
+            return # reopened storage already has the right layout
+        self._request(ALLOCATE, _GEOMETRY.pack(num_slots, slot_size))
+        self.num_slots, self.slot_size = num_slots, slot_size
+
+    def __len__(self):
+        return self.num_slots
+
+    def read(self, i):
+        return self.read_range(i, i + 1)[0]
+
+    def write(self, i, slot):
+        self.write_range(i, i + 1, [slot])
+
+    def read_range(self, i, j): # [i,j)
+        return self.read_ranges([(i, j)])[0]
+
+    def write_range(self, i, j, slots): # [i,j)
+        self.write_ranges([(i, j)], [slots])
+
+    def read_ranges(self, ranges):
+        view = memoryview(self._request(READ_RANGES, _pack_ranges(ranges)))
+        result = []
+        offset = 0
+        for i, j in ranges:
+            result.append([view[offset + k * self.slot_size:offset + (k + 1) * self.slot_size] for k in range(j - i)])
+            offset += (j - i) * self.slot_size
+        return result
+
+    def write_ranges(self, ranges, slots):
+        data = b"".join(slot for range_slots in slots for slot in range_slots)
+        if len(data) != sum(j - i for i, j in ranges) * self.slot_size:
+            raise ValueError(f"Expected {sum(j - i for i, j in ranges)} slots of {self.slot_size} bytes")
+        self._post(WRITE_RANGES, _pack_ranges(ranges) + data)
+
+    def close(self):
+        self.flush()
+        self._loop.run(self._transport.close())
+
+
+class LocalServer:
+    """
+        ORAMStorageServer running on localhost in a background thread, for tests and benchmarks.
+        latency is the simulated round trip time in seconds. storage() returns a new RemoteStorage on the server,
+        so it can be passed as storage_factory.
+    """
+
+    def __init__(self, latency=0.0, storage_factory=InMemoryStorage):
+        self.server = ORAMStorageServer(storage_factory, latency)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+        self.host, self.port = asyncio.run_coroutine_threadsafe(self.server.start(), self._loop).result()
+
+    def storage(self, name=None):
+        return RemoteStorage(self.host, self.port, name)
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self._loop).result()
+        _stop_loop(self._loop, self._thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+async def _serve(host, port, latency):
+    server = ORAMStorageServer(latency=latency)
+    host, port = await server.start(host, port)
+    print(f"Serving ORAM storage on {host}:{port}")
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ORAM storage server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated round trip time in seconds")
+    args = parser.parse_args()
+    asyncio.run(_serve(args.host, args.port, args.latency))
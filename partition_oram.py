@@ -0,0 +1,193 @@
+import math
+import multiprocessing
+import random
+import sys
+import threading
+from recursive_path_oram_client import Client
+
+
+def _partition_worker(conn, client_kwargs):
+    # owns the Client of one partition and serves (op, args) requests until "close"
+    client = Client(**client_kwargs)
+    while True:
+        op, args = conn.recv()
+        if op == "close":
+            conn.close()
+            return
+        try:
+            if op == "take": # read and remove, the block is overwritten with None and its id freed by the caller
+                result = client.update(args[0], lambda old_data: None)
+            elif op == "put":
+                result = client.access("write", *args)
+            elif op == "dummy":
+                result = client.dummy_access(1)
+            else:
+                raise ValueError(f"Invalid op {op}")
+            conn.send((True, result))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class PartitionORAM:
+    """
+        Partition ORAM: the N blocks are spread over K Path ORAM partitions (each a Client with its own server,
+        running in its own worker process). Every access reads the block from its partition (a dummy access
+        if it is in the eviction cache), assigns it to a new random partition and puts it in that partition's
+        eviction cache, then evictions_per_access random partitions are evicted: one cached block is written
+        to the partition, or a dummy access if its cache is empty. Every partition access is a single path, so
+        the server sees one access to a uniformly random partition per request plus the random evictions.
+        Blocks get a local id in their partition from a per-partition free list. A partition holds
+        N / K * (1 + slack) blocks, and every eviction cache holds at most cache_size blocks after an access:
+        extra rounds of one eviction per partition run until it does. The new partitions are drawn before anything
+        is read, and an access that would assign a partition more blocks than it and its cache can hold raises
+        RuntimeError before any partition is touched.
+        client_kwargs are passed to every partition Client (B and Z included).
+    """
+
+    def __init__(self, N, K=4, B=32768, Z=4, evictions_per_access=2, cache_size=32, slack=0.25, client_kwargs=None):
+        if N <= 0:
+            raise ValueError(f"N={N} is not positive")
+        self.N = N
+        self.K = K
+        self.evictions_per_access = evictions_per_access
+        self.cache_size = cache_size # blocks per eviction cache
+        self.partition_N = math.ceil(N / K * (1 + slack)) # blocks per partition
+        self.partition = [-1] * N # block -> partition, -1 if never written
+        self.local = [-1] * N # block -> local id in its partition, -1 while in an eviction cache
+        self.caches = [{} for _ in range(K)] # partition -> eviction cache (block -> data)
+        self.free = [list(range(self.partition_N)) for _ in range(K)] # partition -> free local ids
+        self.max_cache = 0 # largest eviction cache observed (before the extra evictions)
+        self.extra_rounds = 0 # rounds of one eviction per partition run to bring the caches under cache_size
+
+        kwargs = dict(client_kwargs or {}, N=self.partition_N, B=B, Z=Z)
+        self._workers = []
+        for _ in range(K):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_partition_worker, args=(child, kwargs), daemon=True)
+            process.start()
+            self._workers.append((process, conn))
+
+    def access(self, op, a, new_data=None):
+        return self.access_many([(op, a, new_data)])[0]
+
+    def access_many(self, requests):
+        """
+            requests: list of (op, a, new_data), returns the old data of every request.
+            The reads of the distinct blocks run in parallel on their partitions, then all the evictions do.
+            Reads of blocks that were never written raise KeyError.
+        """
+        for op, _, new_data in requests:
+            if op not in ("read", "write"):
+                raise ValueError(f"Invalid op {op}")
+            if op == "write" and new_data is None:
+                raise ValueError("write op needs new_data")
+
+        # the new partition of every block, checked against the capacity of the partitions before anything is read
+        blocks = list(dict.fromkeys(a for _, a, _ in requests))
+        new_partition = {a: random.randrange(self.K) for a in blocks}
+        self._check_capacity(requests, new_partition)
+
+        # one partition access per distinct block: a real read if it is stored in its partition, a dummy otherwise
+        calls = []
+        for a in blocks:
+            p = self.partition[a]
+            if p != -1 and self.local[a] != -1:
+                calls.append((p, "take", (self.local[a],)))
+            else:
+                calls.append((p if p != -1 else random.randrange(self.K), "dummy", ()))
+        data = {}
+        for a, (p, op, _), result in zip(blocks, calls, self._call(calls)):
+            if op == "take":
+                self.free[p].append(self.local[a])
+                self.local[a] = -1
+                data[a] = result
+            elif self.partition[a] != -1:
+                data[a] = self.caches[p].pop(a)
+
+        # serve the requests and move every block to the eviction cache of a new random partition
+        results = []
+        for op, a, new_data in requests:
+            if op == "read" and a not in data:
+                print(f"Block not found {a}", file=sys.stderr)
+                results.append(KeyError(a))
+                continue
+            results.append(data.get(a))
+            if op == "write":
+                data[a] = new_data
+        for a, value in data.items():
+            p = new_partition[a]
+            self.partition[a] = p
+            self.caches[p][a] = value
+
+        self._evict([random.randrange(self.K) for _ in range(self.evictions_per_access * len(blocks))])
+        self.max_cache = max(self.max_cache, *(len(cache) for cache in self.caches))
+        while any(len(cache) > self.cache_size for cache in self.caches):
+            self.extra_rounds += 1
+            self._evict(random.sample(range(self.K), self.K))
+        for result in results:
+            if isinstance(result, KeyError):
+                raise result
+        return results
+
+    def _check_capacity(self, requests, new_partition):
+        # raises RuntimeError if a partition would hold more blocks (stored or cached) than partition_N + cache_size,
+        # so that its eviction cache could not be brought under cache_size
+        blocks = {}
+        for op, a, _ in requests:
+            blocks[a] = blocks.get(a, False) or op == "write" or self.partition[a] != -1 # exists after the requests
+        load = [self.partition_N - len(free) + len(cache) for free, cache in zip(self.free, self.caches)]
+        for a, exists in blocks.items():
+            if self.partition[a] != -1:
+                load[self.partition[a]] -= 1
+            if exists:
+                load[new_partition[a]] += 1
+        for p, blocks_p in enumerate(load):
+            if blocks_p > self.partition_N + self.cache_size:
+                raise RuntimeError(f"Partition {p} would hold {blocks_p} blocks (partition_N={self.partition_N}, "
+                                   f"cache_size={self.cache_size}), nothing was accessed")
+
+    def _evict(self, partitions):
+        # one eviction of each partition in partitions, all sent before any reply is awaited
+        calls = []
+        for p in partitions:
+            cache = self.caches[p]
+            if cache and self.free[p]:
+                a = next(iter(cache))
+                self.local[a] = self.free[p].pop()
+                calls.append((p, "put", (self.local[a], cache.pop(a))))
+            else:
+                calls.append((p, "dummy", ()))
+        self._call(calls)
+
+    def _call(self, calls):
+        # calls: list of (partition, op, args); the requests are sent by another thread while the replies are
+        # received (a full pipe would block both sides otherwise), so different partitions work in parallel
+        # and the requests of one partition run in order
+        def send():
+            for p, op, args in calls:
+                self._workers[p][1].send((op, args))
+        sender = threading.Thread(target=send)
+        sender.start()
+        results = []
+        error = None
+        for p, _, _ in calls:
+            ok, result = self._workers[p][1].recv()
+            if not ok and error is None:
+                error = result
+            results.append(result)
+        sender.join()
+        if error is not None:
+            raise error
+        return results
+
+    def close(self):
+        for process, conn in self._workers:
+            conn.send(("close", ()))
+            process.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
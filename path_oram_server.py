@@ -1,9 +1,67 @@
+def level_offsets(slots):
+    """slots: slots per bucket of every level (root first) -> first slot of every level, and the total number of slots"""
+    offsets = []
+    total = 0
+    for l, level_slots in enumerate(slots):
+        offsets.append(total)
+        total += 2 ** l * level_slots
+    return offsets, total
+
+
 class PathORAMServer:
-    def __init__(self, data):
-        self.data = data
-    
+    def __init__(self, data, L=None, Z=1):
+        self.data = data # storage backend (storage.InMemoryStorage, storage.MMapStorage, network.RemoteStorage)
+        self.L = L # height of binary tree (needed for the path operations)
+        self.Z = Z # slots per bucket, or a list of the slots per bucket of every level (root first)
+        self._offsets = level_offsets(Z)[0] if isinstance(Z, (list, tuple)) else None # first slot of every level
+
     def read_block(self, i):
-        return self.data[i]
-    
+        return self.data.read(i)
+
     def write_block(self, i, block):
-        self.data[i] = block
+        self.data.write(i, block)
+
+    def read_blocks(self, indices):
+        """returns the slots at indices, in one request"""
+        return [slots[0] for slots in self.data.read_ranges([(i, i + 1) for i in indices])]
+
+    def write_blocks(self, blocks):
+        """blocks: dict slot index -> slot, written in one request"""
+        self.data.write_ranges([(i, i + 1) for i in blocks], [[slot] for slot in blocks.values()])
+
+    def write_bucket(self, b, slots):
+        """writes the Z slots of bucket index b"""
+        self.data.write_range(*self._bucket_range(b), slots)
+
+    def _bucket_range(self, b):
+        # [i,j) slots of bucket index b
+        if self._offsets is None:
+            return b * self.Z, (b + 1) * self.Z
+        l = (b + 1).bit_length() - 1
+        start = self._offsets[l] + (b - 2 ** l + 1) * self.Z[l]
+        return start, start + self.Z[l]
+
+    def _path(self, leaf, start=0):
+        # bucket indices from level start (0 is the root) to the leaf (level L)
+        return [2 ** l - 1 + (leaf >> (self.L - l)) for l in range(start, self.L + 1)]
+
+    def _ranges(self, buckets):
+        # slot ranges of bucket indices, every path operation is a single read_ranges/write_ranges request
+        return [self._bucket_range(b) for b in buckets]
+
+    def read_path(self, leaf, start=0):
+        """returns the buckets (each a list of Z slots) on the path to leaf from level start down, root first"""
+        return self.data.read_ranges(self._ranges(self._path(leaf, start)))
+
+    def write_path(self, leaf, buckets, start=0):
+        """buckets: Z slots per bucket on the path to leaf from level start down, root first"""
+        self.data.write_ranges(self._ranges(self._path(leaf, start)), buckets)
+
+    def read_paths(self, leaves, start=0):
+        """returns dict bucket index -> slots for the union of the paths to leaves (from level start down)"""
+        union = list(dict.fromkeys(b for leaf in leaves for b in self._path(leaf, start)))
+        return dict(zip(union, self.data.read_ranges(self._ranges(union))))
+
+    def write_paths(self, buckets):
+        """buckets: dict bucket index -> slots, as returned by read_paths"""
+        self.data.write_ranges(self._ranges(buckets), list(buckets.values()))
@@ -0,0 +1,121 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+
+class ORAMProxy:
+    """
+        Thread-safe front end for a client with access_many (Client, recursiveClient, PathORAMClient).
+        Callers on any number of threads (read/write/submit) or asyncio tasks (aread/awrite) enqueue requests,
+        and a single dispatcher thread serves them in rounds of one access_many batch each: a round takes the
+        queued requests of up to batch_size distinct blocks, so concurrent requests for the same block are
+        served from the stash by the one path read for it, and every round reads and writes batch_size paths.
+        With interval=None rounds run back to back while requests are queued, otherwise one round starts every
+        interval seconds and idle rounds are dummy accesses, so the server sees the same traffic under any load.
+    """
+
+    def __init__(self, client, batch_size=None, interval=None):
+        self.client = client
+        self.batch_size = batch_size if batch_size is not None else client.batch_size
+        self.interval = interval
+        self._queue = [] # (op, a, new_data, future), in arrival order
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # metrics
+        self.rounds = 0
+        self.dummy_rounds = 0
+        self.requests = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, op, a, new_data=None):
+        """enqueues a request, returns a concurrent.futures.Future of its result (the old data)"""
+        if op not in ("read", "write"):
+            raise ValueError(f"Invalid op {op}")
+        if op == "write" and new_data is None:
+            raise ValueError("write op needs new_data")
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("proxy is closed")
+            self._queue.append((op, a, new_data, future))
+            self._cond.notify()
+        return future
+
+    def read(self, a):
+        return self.submit("read", a).result()
+
+    def write(self, a, new_data):
+        return self.submit("write", a, new_data).result()
+
+    async def aread(self, a):
+        return await asyncio.wrap_future(self.submit("read", a))
+
+    async def awrite(self, a, new_data):
+        return await asyncio.wrap_future(self.submit("write", a, new_data))
+
+    def _take_round(self):
+        # the queued requests of the first batch_size distinct blocks, the others stay queued in order
+        blocks = set()
+        taken, kept = [], []
+        for request in self._queue:
+            a = request[1]
+            if a in blocks or len(blocks) < self.batch_size:
+                blocks.add(a)
+                taken.append(request)
+            else:
+                kept.append(request)
+        self._queue = kept
+        return taken
+
+    def _run(self):
+        next_round = time.monotonic()
+        while True:
+            with self._cond:
+                if self.interval is None:
+                    while not self._queue and not self._closed:
+                        self._cond.wait()
+                else:
+                    while not self._closed and next_round - time.monotonic() > 0:
+                        self._cond.wait(next_round - time.monotonic())
+                    next_round = max(next_round + self.interval, time.monotonic())
+                if self._closed and not self._queue:
+                    return
+                requests = self._take_round()
+            self._serve(requests)
+
+    def _serve(self, requests):
+        self.rounds += 1
+        if not requests:
+            self.dummy_rounds += 1
+            self.client.dummy_access(self.batch_size)
+            return
+        self.requests += len(requests)
+        try:
+            results = self.client.access_many([(op, a, new_data) for op, a, new_data, _ in requests],
+                                              self.batch_size, return_exceptions=True)
+        except Exception as e:
+            for *_, future in requests:
+                future.set_exception(e)
+            return
+        for (*_, future), result in zip(requests, results):
+            if isinstance(result, KeyError):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """serves the queued requests and stops the dispatcher"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
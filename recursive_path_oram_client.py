@@ -1,19 +1,44 @@
 import random
 import math
-import json
+import os
+import pickle
+import secrets
 import sys
-from cryptography.fernet import Fernet
-from path_oram_server import PathORAMServer as Server
-
-
-class _InMemoryPositionMap:
-    """position map stored in client memory (get/set by block id)"""
-
-    def __init__(self, position_dict):
-        self._position = position_dict
+from collections.abc import Sequence
+import numpy as np
+from path_oram_server import PathORAMServer as Server, level_offsets
+from block_codec import BinaryBlockCodec
+from cipher import AESGCMCipher
+from storage import InMemoryStorage
+from crypto_pool import DummyPool
+from stash import Stash
+
+
+class _ArrayPositionMap:
+    """
+        position map stored in client memory as a numpy array of leaves (get/set by block id).
+        With path the array is memory-mapped to a .npy file, which is reopened if it already exists.
+    """
+
+    _CHUNK = 1 << 22  # leaves drawn per vectorized call when filling a memory-mapped map
+
+    def __init__(self, N, num_leaves, path=None):
+        dtype = np.uint32 if num_leaves <= 2 ** 32 else np.uint64
+        rng = np.random.default_rng(secrets.randbits(128))  # numpy generator seeded from the OS CSPRNG
+        if path is None:
+            self._position = rng.integers(0, num_leaves, size=N, dtype=dtype)
+        elif os.path.exists(path):
+            self._position = np.load(path, mmap_mode="r+")
+            if self._position.shape != (N,):
+                raise ValueError(f"Position map {path} has {self._position.shape[0]} entries, expected N={N}")
+        else:
+            self._position = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(N,))
+            for start in range(0, N, self._CHUNK):
+                end = min(N, start + self._CHUNK)
+                self._position[start:end] = rng.integers(0, num_leaves, size=end - start, dtype=dtype)
 
     def get(self, a):
-        return self._position[a]
+        return int(self._position[a])
 
     def set(self, a, x):
         self._position[a] = x
@@ -25,13 +50,21 @@ class _InMemoryPositionMap:
             self._position[a] = x
 
     def get_and_set(self, a, new_x):
-        x = self._position[a]
+        x = int(self._position[a])
         self._position[a] = new_x
         return x
 
+    def get_and_set_many(self, updates, batch_size=None):
+        """updates: dict block_id -> new leaf, returns dict block_id -> old leaf"""
+        return {a: self.get_and_set(a, x) for a, x in updates.items()}
+
 
 class _RecursivePositionMap:
-    """position map stored in a recursive ORAM as chunks. Each chunk holds E entries."""
+    """
+        position map stored in a recursive ORAM as chunks. Each chunk holds E entries.
+        A chunk is the bit-packed array of the leaves of blocks [chunk_id * E, (chunk_id + 1) * E),
+        L bits per leaf, so block a is entry a % E and ids are not stored.
+    """
 
     def __init__(self, N, L, E, recursive_oram, num_leaves):
         self.N = N
@@ -39,44 +72,114 @@ class _RecursivePositionMap:
         self.E = E
         self._oram = recursive_oram
         self._num_leaves = num_leaves
-        self._num_chunks = (N + E - 1) // E
+        self._width = _leaf_bits(L)
 
     def get_and_set(self, a, new_x):
-        chunk_id = a // self.E
-        chunk = self._oram.access("read", chunk_id)
-        chunk = {int(k): v for k, v in chunk.items()}
-        x = chunk.get(a, random.randint(0, self._num_leaves - 1))
-        chunk[a] = new_x
-        self._oram.access("write", chunk_id, json.dumps(chunk))
-        return x
+        """one read-modify-write access on the chunk holding a"""
+        chunk = self._oram.update(a // self.E, lambda chunk: self._updated(chunk, {a: new_x}))
+        if chunk is None:
+            return random.randint(0, self._num_leaves - 1)
+        return _get_leaf(chunk, a % self.E, self._width)
 
     def set(self, a, x):
-        """Update position of block a to x (e.g. after evicting onto path to x)."""
+        """Update position of block a to x."""
         self.get_and_set(a, x)
 
     def set_many(self, updates):
-        """updates: dict block_id -> leaf index. Batched by chunk to minimize ORAM accesses."""
-        if not updates:
-            return
+        """updates: dict block_id -> leaf index. One read-modify-write access per touched chunk."""
         by_chunk = {}
         for a, x in updates.items():
-            cid = a // self.E
-            by_chunk.setdefault(cid, {})[a] = x
+            by_chunk.setdefault(a // self.E, {})[a] = x
         for chunk_id, chunk_updates in by_chunk.items():
-            raw = self._oram.access("read", chunk_id)
-            chunk = json.loads(raw) if isinstance(raw, str) else raw
-            chunk = {int(k): v for k, v in chunk.items()}
-            for a, x in chunk_updates.items():
-                chunk[a] = x
-            self._oram.access("write", chunk_id, json.dumps(chunk))
-
-    def initialize(self):
-        """all position map chunks initialize with random leaf indices"""
-        for chunk_id in range(self._num_chunks):
-            start = chunk_id * self.E
-            end = min(self.N, start + self.E)
-            chunk = {a: random.randint(0, self._num_leaves - 1) for a in range(start, end)}
-            self._oram.access("write", chunk_id, json.dumps(chunk))
+            self._oram.update(chunk_id, lambda chunk, chunk_updates=chunk_updates: self._updated(chunk, chunk_updates))
+
+    def get_and_set_many(self, updates, batch_size=None):
+        """
+            updates: dict block_id -> new leaf, returns dict block_id -> old leaf.
+            The touched chunks are updated in one batched access of batch_size paths on the recursive ORAM.
+        """
+        by_chunk = {}
+        for a, x in updates.items():
+            by_chunk.setdefault(a // self.E, {})[a] = x
+        if not by_chunk:
+            self._oram.dummy_access(batch_size) # every level is accessed once per batch
+            return {}
+        chunks = self._oram.update_many(
+            [(chunk_id, lambda chunk, chunk_updates=chunk_updates: self._updated(chunk, chunk_updates))
+             for chunk_id, chunk_updates in by_chunk.items()], batch_size)
+        old = {}
+        for chunk, chunk_updates in zip(chunks, by_chunk.values()):
+            for a in chunk_updates:
+                old[a] = (_get_leaf(chunk, a % self.E, self._width) if chunk is not None
+                          else random.randint(0, self._num_leaves - 1))
+        return old
+
+    def close(self):
+        self._oram.close()
+
+    def _updated(self, chunk, updates):
+        chunk = bytearray(chunk) if chunk is not None else bytearray((self.E * self._width + 7) // 8)
+        for a, x in updates.items():
+            _set_leaf(chunk, a % self.E, self._width, x)
+        return bytes(chunk)
+
+
+def _save_state(path, state):
+    # client state file (pickled), replaced atomically so that a crash leaves the previous state
+    with open(path + ".tmp", "wb") as file:
+        pickle.dump(state, file)
+    os.replace(path + ".tmp", path)
+
+
+def _load_state(path):
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+def _check_layout(storage, num_slots, slot_size):
+    # a reopened ORAM needs storage that already holds a tree of its layout
+    if (len(storage), storage.slot_size) != (num_slots, slot_size):
+        raise ValueError(f"Storage of {len(storage)} slots of {storage.slot_size} bytes does not hold a tree of "
+                         f"{num_slots} slots of {slot_size} bytes")
+
+
+def _flush(storage, position):
+    # writes the storage and a memory-mapped position map through to their files
+    if hasattr(storage, "flush"):
+        storage.flush()
+    if isinstance(position, np.memmap):
+        position.flush()
+
+
+def _leaf_bits(L):
+    # bits per position map entry, leaves are in [0, 2^L-1]
+    return max(1, L)
+
+
+def _reverse_bits(g, L):
+    # the L low bits of g in reverse order: the g-th leaf in reverse lexicographic order
+    return int(format(g % 2 ** L, f"0{L}b")[::-1], 2) if L else 0
+
+
+def _pack_leaves(leaves, width):
+    """bit-packs an array of leaves, width bits each (little endian)"""
+    bits = (np.asarray(leaves, dtype=np.uint64)[:, None] >> np.arange(width, dtype=np.uint64)) & 1
+    return np.packbits(bits.astype(np.uint8).ravel(), bitorder="little").tobytes()
+
+
+def _get_leaf(chunk, k, width):
+    start = k * width
+    lo, hi = start // 8, (start + width + 7) // 8
+    return (int.from_bytes(chunk[lo:hi], "little") >> (start % 8)) & ((1 << width) - 1)
+
+
+def _set_leaf(chunk, k, width, leaf):
+    # chunk is a bytearray
+    start = k * width
+    lo, hi = start // 8, (start + width + 7) // 8
+    shift = start % 8
+    value = int.from_bytes(chunk[lo:hi], "little") & ~(((1 << width) - 1) << shift)
+    chunk[lo:hi] = (value | (leaf << shift)).to_bytes(hi - lo, "little")
 
 
 def _tree_height(N, Z):
@@ -84,21 +187,50 @@ def _tree_height(N, Z):
 
 
 def _entries_per_block(N, L, B):
-    """How many (block_id, leaf) entries fit in B bits. Leaf in [0, 2^L-1]."""
-    bits_per_entry = max(1, (N - 1).bit_length() + L)  # ceil(log2(N)) + L
-    return max(1, B // bits_per_entry)
+    """
+        How many leaf entries fit in a B byte block once the codec header is taken off.
+        Leaf in [0, 2^L-1], block ids are implicit (entry a % E).
+    """
+    return max(1, (B - BinaryBlockCodec(B).overhead()) * 8 // _leaf_bits(L))
 
 
 class Client:
-    """Single-level Path ORAM. Position map is in-memory or provided by position_map."""
-
-    def __init__(self, N, L=None, B=32768, Z=4, position_map=None):
+    """
+        Single-level Path ORAM. Position map is in-memory or provided by position_map.
+        position_path memory-maps the in-memory position map to a .npy file.
+        treetop_budget is the client memory (in bytes of plaintext) for caching the top levels of the tree.
+        initial_data bulk loads the ORAM (see bulk_load) instead of starting with only dummy blocks.
+        batch_size is the number of paths every batch of access_many reads and writes.
+        crypto_pool (crypto_pool.CryptoPool) seals and opens the buckets of a path in parallel.
+        dummy_pool_size > 0 pads the buckets with dummies encrypted ahead of time by a background thread (see DummyPool).
+        eviction="path" evicts along the paths that were read. eviction="reverse_lex" also evicts along
+        evictions_per_access deterministic paths per accessed path, in reverse lexicographic order of their leaves
+        (every bucket of a level in turn), which keeps the stash small with Z=2 or Z=3.
+        bucket_sizes gives every level its own bucket capacity (root first, e.g. from stash.level_bucket_sizes)
+        instead of Z, and sets L. Different sizes need a cipher whose slots do not depend on the bucket size
+        (AESGCMCipher(granularity="block") by default).
+        state_path is the file close() saves the client state to (stash, treetop cache, eviction counter and the
+        position map unless position_path keeps it). If it exists the ORAM is reopened instead of initialized:
+        storage must already hold its tree (e.g. MMapStorage on the same file) and cipher must have the same key.
+    """
+
+    def __init__(self, N, L=None, B=32768, Z=4, position_map=None, codec=None, cipher=None, storage=None, position_path=None,
+                 treetop_budget=0, initial_data=None, initial_leaves=None, batch_size=16, crypto_pool=None,
+                 dummy_pool_size=0, eviction="path", evictions_per_access=1, bucket_sizes=None, state_path=None):
         if N <= 0:
             raise ValueError(f"N={N} is not positive")
+        if eviction not in ("path", "reverse_lex"):
+            raise ValueError(f"Invalid eviction {eviction}")
+        if bucket_sizes is not None:
+            if L is not None and L != len(bucket_sizes) - 1:
+                raise ValueError(f"{len(bucket_sizes)} bucket sizes given for L={L}")
+            L = len(bucket_sizes) - 1
+            Z = max(bucket_sizes)
         # height is 0 of tree with just root node
         if L is None:
             L = int(math.ceil(math.log(max(1, math.ceil(N / Z)), 2)))
-        total_N = (2 ** (L + 1) - 1) * Z
+        bucket_sizes = list(bucket_sizes) if bucket_sizes is not None else [Z] * (L + 1)
+        total_N = sum(2 ** l * z for l, z in enumerate(bucket_sizes))
         if N > total_N:
             raise ValueError(f"N={N} is too big given L={L} and Z={Z} (total_N={total_N})")
        
@@ -106,153 +238,372 @@ class Client:
         self._total_N = total_N  # total # blocks stored on server (including dummy blocks)
         self.L = L  # height of binary tree
         self.B = B  # block size (in bits)
-        self.Z = Z  # capacity of each bucket (in blocks)
+        self.Z = Z  # capacity of each bucket (in blocks), the largest one with per-level sizes
+        self.bucket_sizes = bucket_sizes  # capacity of the buckets of every level, root first
+        self.batch_size = batch_size  # paths per batch of access_many
+        self.eviction = eviction
+        self.evictions_per_access = evictions_per_access if eviction == "reverse_lex" else 0
+        self._evictions = 0  # reverse lexicographic eviction paths so far
+        self.codec = codec if codec is not None else BinaryBlockCodec(B)  # block <-> B byte plaintext
+
+        self.S = Stash()  # stash: block_id -> (data, position)
+
+        # treetop cache: the top levels of the tree that fit in treetop_budget bytes are kept
+        # as plaintext buckets in client memory and are never read from or written to the server
+        self.treetop_levels = 0
+        while (self.treetop_levels <= L and
+               sum(2 ** l * z for l, z in enumerate(bucket_sizes[:self.treetop_levels + 1])) * B <= treetop_budget):
+            self.treetop_levels += 1
+        self._treetop = [{} for _ in range(2 ** self.treetop_levels - 1)] # bucket index -> bucket
 
-        self.S = {}  # stash: block_id -> (data, position)
         if position_map is not None:
             self.position_map = position_map
-            self.position = None  # no in-memory dict in recursive case
+            self.position = None  # no in-memory array in recursive case
         else:
-            pos_dict = self._initialize_position()
-            self.position_map = _InMemoryPositionMap(pos_dict)
-            self.position = pos_dict  # backward compat for tests
-
-        # encryption/decryption
-        key = Fernet.generate_key()
-        self.f = Fernet(key)
-
-        # client initializes dummy data and starts a new server with it
-        self.server = Server(self._generate_initial_data())
+            self.position_map = _ArrayPositionMap(N, 2 ** L, position_path)
+            self.position = self.position_map._position  # backward compat for tests
+        self.state_path = state_path
+        self._position_path = position_path
+        reopen = state_path is not None and os.path.exists(state_path)
+        if state_path is not None and position_map is not None:
+            raise ValueError("state_path needs the in-memory position map")
+        if reopen and initial_data is not None:
+            raise ValueError("initial_data cannot be loaded into a reopened ORAM")
+
+        # encryption/decryption, by default each bucket is sealed as one AES-GCM ciphertext
+        uniform = len(set(bucket_sizes)) == 1
+        if cipher is None:
+            cipher = AESGCMCipher() if uniform else AESGCMCipher(granularity="block")
+        self.cipher = cipher
+        if len({self.cipher.slot_size(z, B) for z in bucket_sizes}) > 1:
+            raise ValueError("Per-level bucket sizes need a cipher whose slot size does not depend on the bucket size")
+        self.crypto_pool = crypto_pool
+        # server slots per bucket, or per bucket of every level
+        self._slots = self.cipher.slots_per_bucket(Z) if uniform else [self.cipher.slots_per_bucket(z) for z in bucket_sizes]
+        self._dummy_block = self.codec.encode(-1, b"", (-1,))
+        self.dummy_pool = DummyPool(self.cipher, self._dummy_block, Z, dummy_pool_size) if dummy_pool_size else None
+
+        # client starts a new server and fills it with the initial data or with dummy blocks,
+        # or reopens the tree already in storage with the saved client state
+        storage = storage if storage is not None else InMemoryStorage()
+        num_slots = (2 ** (L + 1) - 1) * self._slots if uniform else level_offsets(self._slots)[1]
+        if reopen:
+            _check_layout(storage, num_slots, self.cipher.slot_size(Z, B))
+        storage.allocate(num_slots, self.cipher.slot_size(Z, B))
+        self.server = Server(storage, L, self._slots)
+        if reopen:
+            state = _load_state(state_path)
+            self.S.update(state["stash"])
+            self._treetop = state["treetop"]
+            self._evictions = state["evictions"]
+            if position_path is None:
+                self.position[:] = state["position"]
+        elif initial_data is not None:
+            self.bulk_load(initial_data, initial_leaves)
+        else:
+            self._write_initial_data()
+
+    def close(self):
+        """
+            saves the client state to state_path (if given) and flushes the storage, so that the ORAM can be reopened,
+            and stops the dummy pool (of every level with a recursive position map)
+        """
+        if self.state_path is not None:
+            _save_state(self.state_path, {"stash": dict(self.S), "treetop": self._treetop, "evictions": self._evictions,
+                                          "position": self.position if self._position_path is None else None})
+        _flush(self.server.data, self.position)
+        if self.dummy_pool is not None:
+            self.dummy_pool.close()
+        if hasattr(self.position_map, "close"):
+            self.position_map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def access(self, op, a, new_data=None):
         # a is block id
-        new_x = self._uniform_random(2 ** self.L - 1)
-        x = self.position_map.get_and_set(a, new_x)
-
-        # reads each bucket on the path and adds to stash (blocks carry their position)
-        for l in range(self.L + 1):
-            read = self._read_bucket(self._P(x, l))
-            self.S = self.S | read
-
         if op == "write":
             if new_data is None:
                 raise ValueError("write op needs new_data")
-            entry = self.S.get(a)
-            old_data = entry[0] if entry else None
-            self.S[a] = (new_data, new_x)
+            return self._access(a, lambda old_data: new_data)
         elif op == "read":
-            try:
-                old_data, _ = self.S[a]
-            except KeyError as e:
-                print(f"Block not found in stash {e}", file=sys.stderr)
-                raise
+            return self._access(a, None)
         else:
             raise ValueError(f"Invalid op {op}")
 
-        for l in range(self.L, -1, -1):
-            S_prime = {}
-            # choose min(|S_prime|, Z) blocks that belong on this bucket's path
-            for a_prime in self.S.keys():
-                _, pos_prime = self.S[a_prime]
-                if self._P(x, l) == self._P(pos_prime, l):
-                    S_prime[a_prime] = self.S[a_prime]
-                    if len(S_prime) >= self.Z:
-                        break
-            # blocks are now on path P(x); keep position map in sync (batched)
-            if S_prime:
-                self.position_map.set_many({a_prime: x for a_prime in S_prime})
-            for a_prime in S_prime.keys():
-                del self.S[a_prime]
-            self._write_bucket(self._P(x, l), S_prime)
+    def update(self, a, f):
+        """Read-modify-write of block a in one access: stores f(old_data) and returns old_data (None if never written)."""
+        return self._access(a, f)
 
+    def _access(self, a, f):
+        # f maps the old data to the new data, None for a read
+        new_x = self._uniform_random(2 ** self.L - 1)
+        x = self.position_map.get_and_set(a, new_x)
+        if self.evictions_per_access:
+            old_data, = self._access_paths([(a, f)], {a: new_x}, [x])
+            if isinstance(old_data, KeyError):
+                raise old_data
+            return old_data
+
+        # reads the cached top of the path locally and the rest in one request, adding blocks to stash
+        # (blocks carry their position)
+        k = self.treetop_levels
+        for l in range(k):
+            self.S.update(self._treetop[2 ** l - 1 + (x >> (self.L - l))])
+        for bucket in self._open_buckets(self.server.read_path(x, k)):
+            self.S.update(bucket)
+
+        # the block is remapped to new_x in the stash as well, so the position map needs no more updates
+        entry = self.S.get(a)
+        if f is None:
+            if entry is None:
+                print(f"Block not found in stash {a}", file=sys.stderr)
+                raise KeyError(a)
+            old_data = entry[0]
+            self.S[a] = (old_data, new_x)
+        else:
+            old_data = entry[0] if entry else None
+            self.S[a] = (f(old_data), new_x)
+
+        # greedily fill the buckets on the path from the leaf up, then write the uncached part back in one request
+        buckets = self.S.evict_path(x, self.L, self.bucket_sizes)
+        for l in range(k):
+            self._treetop[2 ** l - 1 + (x >> (self.L - l))] = buckets[l]
+        self.server.write_path(x, self._seal_buckets(buckets[k:], self.bucket_sizes[k:]), k)
         return old_data
-    
-    def _initialize_position(self):
-        # returns an initialized position map
-        position = {}
-        for i in range(self.N):
-            position[i] = self._uniform_random(2 ** self.L - 1) # 0 to num leafs - 1 (inclusive)
-        return position
-    
+
+    def access_many(self, requests, batch_size=None, return_exceptions=False):
+        """
+            requests: list of (op, a, new_data) (new_data is ignored for reads), returns the old data of every request.
+            The requests are served in batches of at most batch_size distinct blocks. Every batch reads the union of
+            batch_size paths (padded with random paths), serves its requests from the stash and evicts over all the
+            paths in a single write back, so the server only learns the number of batches.
+            Reads of blocks that were never written raise KeyError once their batch has been written back,
+            with return_exceptions the KeyError is returned in their place instead.
+        """
+        ops = []
+        for op, a, new_data in requests:
+            if op == "write":
+                if new_data is None:
+                    raise ValueError("write op needs new_data")
+                ops.append((a, lambda old_data, new_data=new_data: new_data))
+            elif op == "read":
+                ops.append((a, None))
+            else:
+                raise ValueError(f"Invalid op {op}")
+        return self.update_many(ops, batch_size, return_exceptions)
+
+    def update_many(self, updates, batch_size=None, return_exceptions=False):
+        """updates: list of (a, f) as in update (f=None for a read), returns the old data of every update"""
+        batch_size = batch_size if batch_size is not None else self.batch_size
+        results = []
+        i = 0
+        while i < len(updates):
+            blocks = {}
+            j = i
+            while j < len(updates) and (updates[j][0] in blocks or len(blocks) < batch_size):
+                blocks[updates[j][0]] = None
+                j += 1
+            batch_results = self._access_batch(updates[i:j], list(blocks), batch_size)
+            if not return_exceptions:
+                for result in batch_results:
+                    if isinstance(result, KeyError):
+                        raise result
+            results += batch_results
+            i = j
+        return results
+
+    def dummy_access(self, batch_size=None):
+        """a batch of random paths that touches no block, indistinguishable from a batch of access_many"""
+        self._access_batch([], [], batch_size if batch_size is not None else self.batch_size)
+
+    def _access_batch(self, updates, blocks, batch_size):
+        # updates only touch blocks (distinct block ids, at most batch_size)
+        new_leaves = {a: self._uniform_random(2 ** self.L - 1) for a in blocks}
+        old_leaves = self.position_map.get_and_set_many(new_leaves, batch_size)
+        leaves = [old_leaves[a] for a in blocks]
+        leaves += [self._uniform_random(2 ** self.L - 1) for _ in range(batch_size - len(blocks))]
+        return self._access_paths(updates, new_leaves, leaves)
+
+    def _access_paths(self, updates, new_leaves, leaves):
+        # serves updates from the union of the paths to leaves (plus the eviction paths), new_leaves: block -> new leaf
+        leaves = leaves + self._eviction_leaves(self.evictions_per_access * len(leaves))
+
+        # reads the cached top of the paths locally and the rest of their union in one request
+        k = self.treetop_levels
+        cached = {2 ** l - 1 + (x >> (self.L - l)) for x in leaves for l in range(k)}
+        for bucket in cached:
+            self.S.update(self._treetop[bucket])
+        for bucket in self._open_buckets(list(self.server.read_paths(leaves, k).values())):
+            self.S.update(bucket)
+
+        results = []
+        for a, f in updates:
+            entry = self.S.get(a)
+            if f is None:
+                if entry is None:
+                    # raised once the paths are written back, the other requests of the batch are still served
+                    print(f"Block not found in stash {a}", file=sys.stderr)
+                    results.append(KeyError(a))
+                else:
+                    results.append(entry[0])
+            else:
+                results.append(entry[0] if entry else None)
+                self.S[a] = (f(results[-1]), new_leaves[a])
+        for a in new_leaves:
+            if a in self.S:
+                self.S[a] = (self.S[a][0], new_leaves[a])
+
+        # greedy eviction over the union of the paths, the uncached buckets are written back in one request
+        buckets = self.S.evict_paths(leaves, self.L, self.bucket_sizes)
+        for bucket in cached:
+            self._treetop[bucket] = buckets.pop(bucket)
+        sizes = [self.bucket_sizes[(b + 1).bit_length() - 1] for b in buckets]
+        self.server.write_paths(dict(zip(buckets, self._seal_buckets(list(buckets.values()), sizes))))
+        return results
+
+    def _eviction_leaves(self, n):
+        # the next n leaves in reverse lexicographic order (leaf g is the bit reversal of the eviction counter)
+        leaves = [_reverse_bits(g, self.L) for g in range(self._evictions, self._evictions + n)]
+        self._evictions += n
+        return leaves
+
     def _uniform_random(self, n):
         # return a uniform random int from 0 to n inclusive
         return random.randint(0, n)
     
-    def _generate_initial_data(self):
-        return [self._create_dummy_block() for _ in range(self._total_N)]
-    
-    def _create_dummy_block(self):
-        return self._encrypt_block((-1, "", -1))
+    def bulk_load(self, values, leaves=None):
+        """
+            Replaces the contents of the ORAM with values (block i gets the i-th value) without any accesses.
+            One linear pass over the leaves places every block in the deepest bucket on its path that still
+            has room (the stash if there is none). If values can be indexed (list, ndarray, memmap), the buckets
+            are then encrypted and written one at a time, fetching the values of their blocks by index. Other
+            iterables are streamed in id order and every bucket is written once its last block has arrived, so
+            the blocks of the unfinished buckets are held in memory meanwhile.
+            leaves[i] is the leaf of block i, by default taken from the in-memory position map.
+        """
+        if leaves is None:
+            if self.position is None:
+                raise ValueError("leaves are needed to bulk load with a recursive position map")
+            leaves = self.position
+        num_buckets = 2 ** (self.L + 1) - 1
+        remaining = [0] * num_buckets  # blocks that are still to arrive per bucket
+        targets = [-1] * self.N  # bucket of every block, -1 for the stash
+        for a in range(self.N):
+            x = int(leaves[a])
+            for l in range(self.L, -1, -1):
+                bucket = 2 ** l - 1 + (x >> (self.L - l))
+                if remaining[bucket] < self.bucket_sizes[l]:
+                    remaining[bucket] += 1
+                    targets[a] = bucket
+                    break
+
+        self.S.clear()
+        if isinstance(values, (Sequence, np.ndarray)):
+            if len(values) > self.N:
+                raise ValueError(f"More than N={self.N} initial values")
+            # ids grouped by bucket (the stash first), bounds[b + 1]:bounds[b + 2] are the ids of bucket b
+            targets = np.array(targets[:len(values)], dtype=np.int64)
+            order = np.argsort(targets, kind="stable")
+            bounds = np.searchsorted(targets[order], np.arange(-1, num_buckets + 1))
+            for a in order[bounds[0]:bounds[1]]:
+                self.S[int(a)] = (values[a], int(leaves[a]))
+            for bucket in range(num_buckets):
+                self._store_bucket(bucket, {int(a): (values[a], int(leaves[a]))
+                                            for a in order[bounds[bucket + 1]:bounds[bucket + 2]]})
+            return
+        empty = [bucket for bucket in range(num_buckets) if remaining[bucket] == 0]
+        pending = {}  # bucket -> blocks seen so far
+        for a, value in enumerate(values):
+            if a >= self.N:
+                raise ValueError(f"More than N={self.N} initial values")
+            bucket = targets[a]
+            if bucket == -1:
+                self.S[a] = (value, int(leaves[a]))
+                continue
+            pending.setdefault(bucket, {})[a] = (value, int(leaves[a]))
+            remaining[bucket] -= 1
+            if remaining[bucket] == 0:
+                self._store_bucket(bucket, pending.pop(bucket))
+        # empty buckets, and buckets of blocks that were not given a value
+        for bucket in empty + [bucket for bucket in range(num_buckets) if remaining[bucket] > 0]:
+            self._store_bucket(bucket, pending.pop(bucket, {}))
+
+    def _write_initial_data(self):
+        # fills the tree with encrypted empty buckets, one bucket at a time
+        for bucket in range(2 ** (self.L + 1) - 1):
+            self._store_bucket(bucket, {})
+
+    def _store_bucket(self, bucket, data):
+        # bucket index -> treetop cache or server
+        if bucket < len(self._treetop):
+            self._treetop[bucket] = data
+        else:
+            self.server.write_bucket(bucket, self._seal_bucket(data, self.bucket_sizes[(bucket + 1).bit_length() - 1]))
 
-    def _P(self, x, l):
-        return (2 ** l - 1 + x // 2 ** (self.L - l)) * self.Z
+    def _seal_bucket(self, data, Z):
+        # data: dict block_id -> (data, position), padded with dummy blocks up to Z
+        blocks = [self.codec.encode(a_prime, data_val, (pos_val,)) for a_prime, (data_val, pos_val) in data.items()]
+        if self.dummy_pool is not None:
+            return self.dummy_pool.seal(blocks, Z)
+        blocks += [self._dummy_block] * (Z - len(blocks))
+        return self.cipher.seal(blocks)
 
-    def _read_bucket(self, bucket):
+    def _open_bucket(self, slots):
         bucket_blocks = {}
-        for i in range(self.Z):
-            encrypted_block = self.server.read_block(bucket + i)
-            a, data, pos = self._decrypt_block(encrypted_block)
+        for block in self.cipher.open(slots, self.B):
+            a, data, positions = self.codec.decode(block)
             if a != -1:
-                bucket_blocks[a] = (data, pos)
+                bucket_blocks[a] = (data, positions[0])
         return bucket_blocks
 
-    def _write_bucket(self, bucket, data):
-        # data: dict block_id -> (data, position)
-        for i, (a_prime, (data_val, pos_val)) in enumerate(data.items()):
-            encrypted_block = self._encrypt_block((a_prime, data_val, pos_val))
-            self.server.write_block(bucket + i, encrypted_block)
-        for i in range(len(data), self.Z):
-            encrypted_block = self._create_dummy_block()
-            self.server.write_block(bucket + i, encrypted_block)
-
-    def _encrypt_block(self, block):
-        # block: (a, data, pos) or (-1, "", -1) for dummy
-        byte_block = json.dumps(block).encode("utf-8")
-        padded_block = self._pad_block(byte_block)
-        encrypted_block = self._encrypt(padded_block)
-        return encrypted_block
-
-    def _decrypt_block(self, block):
-        padded_decrypted_byte_block = self._decrypt(block)
-        decrypted_byte_block = self._depad_block(padded_decrypted_byte_block)
-        decrypted_block = decrypted_byte_block.decode("utf-8")
-        parsed = json.loads(decrypted_block)
-        if len(parsed) == 2:
-            a, data = parsed
-            pos = -1
-        else:
-            a, data, pos = parsed
-        return a, data, pos
-    
-    def _pad_block(self, block):
-        if len(block) > self.B:
-            raise ValueError(f"Block size {len(block)} is larger than B={self.B}")
-        if len(block) == self.B:
-            return block
-        return block + b"\x01" + b"\x00" * (self.B - len(block) - 1)
-
-    def _depad_block(self, block):
-        return block.rstrip(b"\x00").removesuffix(b"\x01")
-
-    def _encrypt(self, data, identity=False):
-        return self.f.encrypt(data) if not identity else data
-
-    def _decrypt(self, data, identity=False):
-        return self.f.decrypt(data) if not identity else data
-
-
-def recursiveClient(N, B=1<<15, Z=4):
-    """Path ORAM with the position map stored recursively in smaller ORAM(s)"""
+    def _seal_buckets(self, buckets, sizes):
+        # list of buckets (dict block_id -> (data, position)) and their capacities -> list of the slots of every bucket
+        if self.crypto_pool is None:
+            return [self._seal_bucket(data, Z) for data, Z in zip(buckets, sizes)]
+        blocks = [[(a, data_val, (pos_val,)) for a, (data_val, pos_val) in data.items()] for data in buckets]
+        return self.crypto_pool.seal_buckets(self.cipher, self.codec, blocks, sizes, self._dummy_block, self.dummy_pool)
+
+    def _open_buckets(self, buckets):
+        # inverse of _seal_buckets
+        if self.crypto_pool is None:
+            return [self._open_bucket(slots) for slots in buckets]
+        return [{a: (data, positions[0]) for a, data, positions in blocks if a != -1}
+                for blocks in self.crypto_pool.open_buckets(self.cipher, self.codec, buckets, self.B)]
+
+
+def recursiveClient(N, B=1<<15, Z=4, cipher_factory=None, storage_factory=InMemoryStorage, treetop_budget=0,
+                    initial_data=None, batch_size=16, crypto_pool=None, dummy_pool_size=0, client_class=None):
+    """
+        Path ORAM with the position map stored recursively in smaller ORAM(s)
+        cipher_factory and storage_factory are called once per level so that every ORAM gets its own key and storage.
+        Every level gets its own treetop cache of treetop_budget bytes.
+        The position map ORAMs are bulk loaded with their chunks, and the data ORAM with initial_data if given.
+        All the levels share crypto_pool, every level gets its own dummy pool of dummy_pool_size dummies.
+        client_class builds every level (Client by default, or e.g. ring_oram_client.RingClient), and the client's
+        default cipher is used without cipher_factory.
+    """
+    client_class = client_class if client_class is not None else Client
+    cipher_factory = cipher_factory if cipher_factory is not None else (lambda: None)
     L = _tree_height(N, Z)
     E = _entries_per_block(N, L, B)
     next_N = (N + E - 1) // E
 
     if next_N <= 1:
-        return Client(N, B=B, Z=Z)
+        return client_class(N, B=B, Z=Z, cipher=cipher_factory(), storage=storage_factory(),
+                            treetop_budget=treetop_budget, initial_data=initial_data, batch_size=batch_size,
+                            crypto_pool=crypto_pool, dummy_pool_size=dummy_pool_size)
 
-    recursive_oram = recursiveClient(next_N, B, Z)
     num_leaves = 2 ** L
+    leaves = _ArrayPositionMap(N, num_leaves)._position
+    width = _leaf_bits(L)
+    chunks = (_pack_leaves(leaves[start:start + E], width) for start in range(0, N, E))
+    recursive_oram = recursiveClient(next_N, B, Z, cipher_factory, storage_factory, treetop_budget, chunks, batch_size,
+                                     crypto_pool, dummy_pool_size, client_class)
     position_map = _RecursivePositionMap(N, L, E, recursive_oram, num_leaves)
-    data_oram = Client(N, B=B, Z=Z, position_map=position_map)
-    position_map.initialize()
-    return data_oram
+    return client_class(N, B=B, Z=Z, position_map=position_map, cipher=cipher_factory(), storage=storage_factory(),
+                        treetop_budget=treetop_budget, initial_data=initial_data, initial_leaves=leaves,
+                        batch_size=batch_size, crypto_pool=crypto_pool, dummy_pool_size=dummy_pool_size)
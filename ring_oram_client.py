@@ -0,0 +1,358 @@
+import math
+import random
+import struct
+import sys
+from path_oram_server import PathORAMServer as Server
+from block_codec import BinaryBlockCodec
+from cipher import AESGCMCipher
+from storage import InMemoryStorage
+from stash import Stash
+from crypto_pool import DummyPool
+from recursive_path_oram_client import _ArrayPositionMap, _reverse_bits
+
+
+class _BucketMetadata:
+    """
+        per bucket: block id and leaf of each of the Z + S slots (-1 for dummies), which slots are still valid
+        (not read since the bucket was last written) and the number of reads since then
+    """
+
+    _COUNT = struct.Struct("<I")
+    _SLOT = struct.Struct("<qqB")
+
+    __slots__ = ("ids", "leaves", "valid", "count")
+
+    def __init__(self, ids, leaves, valid, count=0):
+        self.ids = ids
+        self.leaves = leaves
+        self.valid = valid
+        self.count = count
+
+    @classmethod
+    def size(cls, num_slots):
+        return cls._COUNT.size + cls._SLOT.size * num_slots
+
+    def encode(self, B):
+        block = bytearray(B)
+        self._COUNT.pack_into(block, 0, self.count)
+        for k, slot in enumerate(zip(self.ids, self.leaves, self.valid)):
+            self._SLOT.pack_into(block, self._COUNT.size + k * self._SLOT.size, *slot)
+        return bytes(block)
+
+    @classmethod
+    def decode(cls, block, num_slots):
+        count, = cls._COUNT.unpack_from(block, 0)
+        slots = [cls._SLOT.unpack_from(block, cls._COUNT.size + k * cls._SLOT.size) for k in range(num_slots)]
+        ids, leaves, valid = (list(column) for column in zip(*slots))
+        return cls(ids, leaves, valid, count)
+
+    def find(self, a):
+        # valid slot holding block a, None if it is not in the bucket
+        for k, (a_prime, valid) in enumerate(zip(self.ids, self.valid)):
+            if a_prime == a and valid:
+                return k
+        return None
+
+    def valid_dummies(self):
+        return [k for k, (a_prime, valid) in enumerate(zip(self.ids, self.valid)) if a_prime == -1 and valid]
+
+    def valid_reals(self):
+        return [k for k, (a_prime, valid) in enumerate(zip(self.ids, self.valid)) if a_prime != -1 and valid]
+
+
+class RingClient:
+    """
+        Ring ORAM with the same interface as Client (access, update, access_many, update_many, dummy_access,
+        bulk loading, recursive position maps).
+        Every bucket has Z real and S dummy slots, each encrypted on its own in a random order. Its metadata is
+        a small slot of its own (sized for Z + S entries, not B) in metadata_storage (InMemoryStorage by default).
+        An access reads the metadata of the path and then a single slot per bucket (the block or a valid dummy),
+        a path is evicted every A accesses in reverse lexicographic order and a bucket that has been read S times
+        is reshuffled early. The cipher has to encrypt blocks one by one (AESGCMCipher(granularity="block") by default).
+        access_many makes one access per distinct block of a batch, padded with dummy accesses to batch_size.
+    """
+
+    def __init__(self, N, L=None, B=32768, Z=4, S=6, A=3, position_map=None, codec=None, cipher=None, storage=None,
+                 position_path=None, treetop_budget=0, initial_data=None, initial_leaves=None, batch_size=16,
+                 crypto_pool=None, dummy_pool_size=0, metadata_storage=None):
+        if N <= 0:
+            raise ValueError(f"N={N} is not positive")
+        if treetop_budget or crypto_pool is not None:
+            raise ValueError("RingClient does not support treetop caching or crypto pools")
+        if A > S:
+            raise ValueError(f"A={A} evictions apart need at least as many dummies per bucket (S={S})")
+        # height is 0 of tree with just root node
+        if L is None:
+            L = int(math.ceil(math.log(max(1, math.ceil(N / Z)), 2)))
+        total_N = (2 ** (L + 1) - 1) * Z
+        if N > total_N:
+            raise ValueError(f"N={N} is too big given L={L} and Z={Z} (total_N={total_N})")
+
+        self.N = N  # total # blocks outsourced to server (excluding dummy blocks)
+        self.L = L  # height of binary tree
+        self.B = B  # block size (in bits)
+        self.Z = Z  # real blocks per bucket
+        self.dummies = S  # dummy blocks per bucket (reads before a bucket is reshuffled)
+        self.A = A  # accesses between evictions
+        self.batch_size = batch_size
+        self.treetop_levels = 0
+        self.codec = codec if codec is not None else BinaryBlockCodec(B)  # block <-> B byte plaintext
+        self._metadata_size = _BucketMetadata.size(Z + S)  # plaintext bytes of the metadata of a bucket
+
+        self.S = Stash()  # stash: block_id -> (data, position)
+        self._round = 0  # accesses so far
+        self._evictions = 0  # evicted paths so far, the next one is the reverse of its bits
+
+        if position_map is not None:
+            self.position_map = position_map
+            self.position = None  # no in-memory array in recursive case
+        else:
+            self.position_map = _ArrayPositionMap(N, 2 ** L, position_path)
+            self.position = self.position_map._position
+
+        self.cipher = cipher if cipher is not None else AESGCMCipher(granularity="block")
+        if self.cipher.slots_per_bucket(Z) != Z:
+            raise ValueError("RingClient needs a cipher that encrypts every block on its own")
+        self._slots = Z + S  # server slots per bucket
+        self._dummy_block = self.codec.encode(-1, b"", (-1,))
+        self.dummy_pool = DummyPool(self.cipher, self._dummy_block, Z + S, dummy_pool_size) if dummy_pool_size else None
+
+        storage = storage if storage is not None else InMemoryStorage()
+        storage.allocate((2 ** (L + 1) - 1) * self._slots, self.cipher.slot_size(1, B))
+        self.server = Server(storage, L, self._slots)
+        metadata_storage = metadata_storage if metadata_storage is not None else InMemoryStorage()
+        metadata_storage.allocate(2 ** (L + 1) - 1, self.cipher.slot_size(1, self._metadata_size))
+        self.metadata_server = Server(metadata_storage, L, 1)  # slot b is the metadata of bucket b
+        if initial_data is not None:
+            self.bulk_load(initial_data, initial_leaves)
+        else:
+            for bucket in range(2 ** (L + 1) - 1):
+                self._write_buckets({bucket: {}})
+
+    def access(self, op, a, new_data=None):
+        # a is block id
+        if op == "write":
+            if new_data is None:
+                raise ValueError("write op needs new_data")
+            return self._access(a, lambda old_data: new_data)
+        elif op == "read":
+            return self._access(a, None)
+        else:
+            raise ValueError(f"Invalid op {op}")
+
+    def update(self, a, f):
+        """Read-modify-write of block a in one access: stores f(old_data) and returns old_data (None if never written)."""
+        return self._access(a, f)
+
+    def close(self):
+        """stops the dummy pool (of every level with a recursive position map)"""
+        if self.dummy_pool is not None:
+            self.dummy_pool.close()
+        if hasattr(self.position_map, "close"):
+            self.position_map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def access_many(self, requests, batch_size=None, return_exceptions=False):
+        """
+            requests: list of (op, a, new_data) (new_data is ignored for reads), returns the old data of every request.
+            The requests are served in batches of at most batch_size distinct blocks, every batch is batch_size
+            accesses (one per block, padded with dummy accesses), so the server only learns the number of batches.
+            Reads of blocks that were never written raise KeyError once their batch is done,
+            with return_exceptions the KeyError is returned in their place instead.
+        """
+        ops = []
+        for op, a, new_data in requests:
+            if op == "write":
+                if new_data is None:
+                    raise ValueError("write op needs new_data")
+                ops.append((a, lambda old_data, new_data=new_data: new_data))
+            elif op == "read":
+                ops.append((a, None))
+            else:
+                raise ValueError(f"Invalid op {op}")
+        return self.update_many(ops, batch_size, return_exceptions)
+
+    def update_many(self, updates, batch_size=None, return_exceptions=False):
+        """updates: list of (a, f) as in update (f=None for a read), returns the old data of every update"""
+        batch_size = batch_size if batch_size is not None else self.batch_size
+        results = [None] * len(updates)
+        i = 0
+        while i < len(updates):
+            blocks = {}  # block id -> indices of its updates in the batch
+            j = i
+            while j < len(updates) and (updates[j][0] in blocks or len(blocks) < batch_size):
+                blocks.setdefault(updates[j][0], []).append(j)
+                j += 1
+            for a, indices in blocks.items():
+                for k, result in zip(indices, self._access_ops(a, [updates[k][1] for k in indices])):
+                    results[k] = result
+            self.dummy_access(batch_size - len(blocks))
+            if not return_exceptions:
+                for result in results[i:j]:
+                    if isinstance(result, KeyError):
+                        raise result
+            i = j
+        return results
+
+    def dummy_access(self, batch_size=None):
+        """batch_size accesses of random paths that touch no block, indistinguishable from a batch of access_many"""
+        for _ in range(batch_size if batch_size is not None else self.batch_size):
+            self._access_ops(None, [])
+
+    def _access(self, a, f):
+        old_data, = self._access_ops(a, [f])
+        if isinstance(old_data, KeyError):
+            raise old_data
+        return old_data
+
+    def _access_ops(self, a, fs):
+        # one access to block a (a random path that touches no block for a=None) serving fs in order,
+        # returns the old data of every f (f=None for a read, a KeyError if a read finds no block)
+        new_x = self._uniform_random(2 ** self.L - 1)
+        x = self.position_map.get_and_set(a, new_x) if a is not None else self._uniform_random(2 ** self.L - 1)
+
+        # reads the metadata of the path, then one slot per bucket: the block where it is, a valid dummy elsewhere
+        path = self.server._path(x)
+        metadata = self._read_metadata(path)
+        indices, real = [], None
+        for b, meta in zip(path, metadata):
+            k = meta.find(a)
+            if k is None:
+                k = random.choice(meta.valid_dummies())
+            else:
+                real = len(indices)
+            meta.valid[k] = 0
+            meta.count += 1
+            indices.append(b * self._slots + k)
+        slots = self.server.read_blocks(indices)
+        self._write_metadata(path, metadata)
+        if real is not None:
+            a_prime, data, positions = self.codec.decode(self.cipher.decrypt(slots[real]))
+            self.S[a_prime] = (data, positions[0])
+
+        entry = self.S.get(a) if a is not None else None
+        results = []
+        for f in fs:
+            if f is None:
+                if entry is None:
+                    print(f"Block not found in stash {a}", file=sys.stderr)
+                    results.append(KeyError(a))
+                else:
+                    results.append(entry[0])
+            else:
+                results.append(entry[0] if entry else None)
+                entry = (f(results[-1]), new_x)
+        if entry is not None:
+            self.S[a] = (entry[0], new_x)
+
+        self._round += 1
+        evicted = self._evict_path() if self._round % self.A == 0 else []
+        for b, meta in zip(path, metadata):
+            if meta.count >= self.dummies and b not in evicted: # evicted buckets were just rewritten
+                self._reshuffle(b, meta)
+        return results
+
+    def _uniform_random(self, n):
+        # return a uniform random int from 0 to n inclusive
+        return random.randint(0, n)
+
+    def _read_metadata(self, path):
+        slots = self.metadata_server.read_blocks(path)
+        return [_BucketMetadata.decode(self.cipher.decrypt(slot), self.Z + self.dummies) for slot in slots]
+
+    def _write_metadata(self, path, metadata):
+        self.metadata_server.write_blocks({b: self.cipher.encrypt(meta.encode(self._metadata_size))
+                                           for b, meta in zip(path, metadata)})
+
+    def _read_reals(self, path, metadata):
+        # reads Z slots of every bucket (its valid real blocks, padded with valid dummies) into the stash
+        indices, reals = [], set()
+        for b, meta in zip(path, metadata):
+            valid_reals = meta.valid_reals()
+            reals.update(b * self._slots + k for k in valid_reals)
+            chosen = valid_reals + random.sample(meta.valid_dummies(), self.Z - len(valid_reals))
+            indices += [b * self._slots + k for k in chosen]
+        for i, slot in zip(indices, self.server.read_blocks(indices)):
+            if i in reals:
+                a, data, positions = self.codec.decode(self.cipher.decrypt(slot))
+                self.S[a] = (data, positions[0])
+
+    def _evict_path(self):
+        # the leaves of the evicted paths go through all the subtrees in turn (reverse lexicographic order)
+        g = _reverse_bits(self._evictions, self.L)
+        self._evictions += 1
+        path = self.server._path(g)
+        self._read_reals(path, self._read_metadata(path))
+        buckets = self.S.evict_path(g, self.L, self.Z)
+        self._write_buckets(dict(zip(path, buckets)))
+        return path
+
+    def _reshuffle(self, b, meta):
+        # early reshuffle of a bucket that ran out of dummies: rewritten with the blocks of the stash that can go there
+        self._read_reals([b], [meta])
+        l = (b + 1).bit_length() - 1
+        bucket = {}
+        for a, (data, leaf) in self.S.items():
+            if len(bucket) == self.Z:
+                break
+            if 2 ** l - 1 + (leaf >> (self.L - l)) == b:
+                bucket[a] = (data, leaf)
+        for a in bucket:
+            del self.S[a]
+        self._write_buckets({b: bucket})
+
+    def bulk_load(self, values, leaves=None):
+        """
+            Replaces the contents of the ORAM with values (block i gets the i-th value) without any accesses.
+            Every block is placed in the deepest bucket on its path that still has room (the stash if there is none).
+            leaves[i] is the leaf of block i, by default taken from the in-memory position map.
+        """
+        if leaves is None:
+            if self.position is None:
+                raise ValueError("leaves are needed to bulk load with a recursive position map")
+            leaves = self.position
+        buckets = [{} for _ in range(2 ** (self.L + 1) - 1)]
+        self.S.clear()
+        for a, value in enumerate(values):
+            if a >= self.N:
+                raise ValueError(f"More than N={self.N} initial values")
+            x = int(leaves[a])
+            for l in range(self.L, -1, -1):
+                bucket = buckets[2 ** l - 1 + (x >> (self.L - l))]
+                if len(bucket) < self.Z:
+                    bucket[a] = (value, x)
+                    break
+            else:
+                self.S[a] = (value, x)
+        for b, bucket in enumerate(buckets):
+            self._write_buckets({b: bucket})
+
+    def _write_buckets(self, buckets):
+        # buckets: dict bucket index -> bucket, their slots and their metadata are written in one request each
+        sealed = {b: self._seal_bucket(bucket) for b, bucket in buckets.items()}
+        self.server.write_paths({b: slots for b, (slots, _) in sealed.items()})
+        self.metadata_server.write_blocks({b: meta for b, (_, meta) in sealed.items()})
+
+    def _seal_bucket(self, data):
+        # data: dict block_id -> (data, position), at most Z blocks, placed in random slots among the S dummies,
+        # returns the slots of the bucket and its metadata slot
+        blocks = [self.codec.encode(a, data_val, (pos_val,)) for a, (data_val, pos_val) in data.items()]
+        if self.dummy_pool is not None:
+            sealed = self.dummy_pool.seal(blocks)
+        else:
+            sealed = [self.cipher.encrypt(block) for block in blocks]
+            sealed += [self.cipher.encrypt(self._dummy_block) for _ in range(self.Z + self.dummies - len(blocks))]
+        order = random.sample(range(self.Z + self.dummies), self.Z + self.dummies)  # order[k]: slot of the k-th block
+        slots = [None] * (self.Z + self.dummies)
+        ids, leaves = [-1] * (self.Z + self.dummies), [-1] * (self.Z + self.dummies)
+        for k, slot in enumerate(sealed):
+            slots[order[k]] = slot
+        for k, (a, (_, pos_val)) in enumerate(data.items()):
+            ids[order[k]], leaves[order[k]] = a, pos_val
+        meta = _BucketMetadata(ids, leaves, [1] * (self.Z + self.dummies))
+        return slots, self.cipher.encrypt(meta.encode(self._metadata_size))
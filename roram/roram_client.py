@@ -1,11 +1,18 @@
+import concurrent.futures
+import itertools
 import math
+import os
 import random
-import copy
-from roram.sub_oram import SubORAMClient
+import numpy as np
+from roram.sub_oram import BlockRecord, SubORAMClient
+from storage import InMemoryStorage
+from recursive_path_oram_client import _save_state, _load_state, _flush
 
 
 class RORAMClient:
-    def __init__(self, N, L=None, B=32768, Z=4):
+    def __init__(self, N, L=None, B=32768, Z=4, codec=None, cipher_factory=None, storage_factory=InMemoryStorage,
+                 crypto_pool=None, dummy_pool_size=0, bucket_sizes=None, eviction_pool=None, initial_data=None,
+                 state_path=None):
         if N <= 0:
             raise ValueError(f"N={N} is not positive")
         self.h = math.ceil(math.log2(N))
@@ -15,8 +22,47 @@ class RORAMClient:
         self.l = math.ceil(math.log2(self.L)) # we have l + 1 PATH ORAMS labeled R_0, ..., R_l
         self.B = B # block size (in bits)
         self.Z = Z # capacity of each bucket (in blocks)
+        self.codec = codec # shared by the sub-ORAMs, None for the default binary codec
+        # called once per sub-ORAM so that each has its own key, None for the sub-ORAM default
+        # (AESGCMCipher, per block with different bucket sizes)
+        self.cipher_factory = cipher_factory if cipher_factory is not None else lambda: None
+        self.storage_factory = storage_factory # called once per sub-ORAM for its server storage
+        self.crypto_pool = crypto_pool # optional crypto_pool.CryptoPool shared by the sub-ORAMs
+        self.dummy_pool_size = dummy_pool_size # encrypted dummies pooled per sub-ORAM, 0 to encrypt them inline
+        self.bucket_sizes = bucket_sizes # per-level bucket capacities of every sub-ORAM (h + 1 of them, root first), Z by default
+        # optional concurrent.futures.ThreadPoolExecutor that evicts the sub-ORAMs of an access concurrently
+        # (threads: the sub-ORAMs are updated in place), None to evict them one after the other
+        self.eviction_pool = eviction_pool
         self.cnt = [0] # global counter
-        self.R = self._initialize_sub_orams()
+        self.versions = [0] * N # block id -> version of its current record, shared by the sub-ORAMs
+        # client state file written by close() (positions, versions, counter and stashes). If it exists the ORAM is
+        # reopened: storage_factory must return the storages of the sub-ORAMs in order, cipher_factory their ciphers
+        self.state_path = state_path
+        if state_path is not None and os.path.exists(state_path):
+            if initial_data is not None:
+                raise ValueError("initial_data cannot be loaded into a reopened ORAM")
+            self.R = self._reopen_sub_orams(_load_state(state_path))
+        else:
+            self.R = self._initialize_sub_orams(initial_data if initial_data is not None else ())
+
+    def close(self):
+        """
+            saves the client state to state_path (if given) and flushes the storages, so that the ORAM can be reopened,
+            and stops the dummy pools of the sub-ORAMs
+        """
+        if self.state_path is not None:
+            # pickled together, so the stashes still share their records once reloaded
+            _save_state(self.state_path, {"positions": [Ri.position for Ri in self.R], "versions": self.versions,
+                                          "cnt": self.cnt[0], "stashes": [Ri.S for Ri in self.R]})
+        for Ri in self.R:
+            _flush(Ri.server.data, None)
+            Ri.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def access(self, a, r, op, D_star=None):
         if r > self.L:
@@ -24,54 +70,85 @@ class RORAMClient:
         i = math.ceil(math.log2(r))
         a_0 = (a // (2 ** i)) * 2 ** i
         D = {}
-        for a_prime in [a_0, a_0 + 2 ** i]:
-            Bs, p_prime = self.R[i].read_range(a_prime) # read_range returns (result (copied), p_prime)
+        # both ranges are read with one request, read_ranges returns (result (shared records), p_prime) of each
+        for a_prime, (Bs, p_prime) in zip([a_0, a_0 + 2 ** i], self.R[i].read_ranges([a_0, a_0 + 2 ** i])):
             for j in range(2 ** i):
-                Bs[a_prime + j][1 + i] = p_prime + j
-            D = D | Bs
+                Bs[a_prime + j].positions[i] = p_prime + j
+            D.update(Bs)
+        # the copies of the range left in the trees are stale from now on
+        version = self.cnt[0] + 1
+        for a_prime, B in D.items():
+            B.version = self.versions[a_prime] = version
         
         # update if write
         if op == "write":
             for j in range(r):
-                D[a + j][0] = D_star[j]
-        # Update stashes and evict in each tree
+                D[a + j].data = D_star[j]
+        # Update stashes and evict in each tree, every stash references the same records of the range
         for j in range(self.l + 1):                
             Rj = self.R[j]
-            as_to_remove = set()
-            for a_to_maybe_remove in Rj.S.keys():
-                if a_0 <= a_to_maybe_remove < a_0 + 2 ** (i + 1):
-                    as_to_remove.add(a_to_maybe_remove)
-            for a_to_remove in as_to_remove:
-                del Rj.S[a_to_remove]
-            Rj.S = Rj.S | copy.deepcopy(D)
-            Rj.batch_evict(2 ** (i + 1))
+            for a_to_remove in range(a_0, a_0 + 2 ** (i + 1)):
+                Rj.S.pop(a_to_remove, None)
+            Rj.S.update(D)
+        self._evict(2 ** (i + 1))
 
         self.cnt[0] += 2 ** (i + 1)
         if op == "read":
-            return D
+            # block id -> [d, p_0, ..., p_l], copied out of the records the stashes share
+            return {a_prime: [B.data, *B.positions] for a_prime, B in D.items()}
         
+    def _evict(self, k):
+        # batch_evict(k) in every sub-ORAM. They share nothing but the records (only read while evicting) and
+        # the counter (only moved once all of them are done), so concurrent evictions end in the same state
+        # as serial ones. Errors are raised once every eviction has finished, the one of the lowest R_j first.
+        if self.eviction_pool is None:
+            for Rj in self.R:
+                Rj.batch_evict(k)
+            return
+        futures = [self.eviction_pool.submit(Rj.batch_evict, k) for Rj in self.R]
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
     def print_debug(self, i):
         Ri = self.R[i]
-        print(f'HERE IS SERVER for {i}: {[Ri._decrypt_block(block) for block in Ri.server.read_slice(0, len(Ri.server.data)) ]}')
+        buckets = []
+        for j in range(Ri.h + 1):
+            slots = Ri.server.read_slice(2 ** j - 1, 2 ** (j + 1) - 1)
+            n = Ri._level_slots[j]
+            buckets += [Ri._open_bucket(slots[k:k + n]) for k in range(0, len(slots), n)]
+        print(f'HERE IS SERVER for {i}: {buckets}')
         print(f"Here is the stash for {i}: {Ri.S}")
 
     def _uniform_random(self, n):
         # return a uniform random int from 0 to n inclusive
         return random.randint(0, n)
     
-    def _initialize_sub_orams(self):
-        # initialize positions
+    def _initialize_sub_orams(self, initial_data):
+        # initialize positions: in R_i every range of 2^i blocks starts at a random position and is consecutive
         positions = []
         for i in range(self.l + 1):
-            position = []
-            for j in range(0, self.N, 2 ** i):
-                position.append(self._uniform_random(self.N - 1))
-                for k in range(1, 2 ** i):
-                    position.append((position[j] + k) % self.N)
-            positions.append(position)
-        
-        data = {}
-        for a in range(self.N):
-            data[a] = ["", *[positions[i][a] for i in range(self.l + 1)]]
-        return [SubORAMClient(i, self.cnt, positions[i], copy.deepcopy(data), self.N, self.h, B=self.B, Z=self.Z) for i in range(self.l + 1)]
-        # need to move stash to server so that post-initialization there is not too much in stash
+            starts = np.array([self._uniform_random(self.N - 1) for _ in range(0, self.N, 2 ** i)], dtype=np.int64)
+            positions.append(((np.repeat(starts, 2 ** i) + np.tile(np.arange(2 ** i), len(starts))) % self.N).tolist())
+
+        # one record per block (block a gets the a-th initial value, "" by default), shared by all the sub-ORAMs,
+        # which build their trees with the records in place
+        values = list(itertools.islice(initial_data, self.N + 1))
+        if len(values) > self.N:
+            raise ValueError(f"More than N={self.N} initial values")
+        values += [""] * (self.N - len(values))
+        data = {a: BlockRecord(value, list(block_positions))
+                for a, (value, block_positions) in enumerate(zip(values, zip(*positions)))}
+        return [self._sub_oram(i, positions[i], data) for i in range(self.l + 1)]
+
+    def _reopen_sub_orams(self, state):
+        # sub-ORAMs on the trees already in storage, with the saved client state
+        self.cnt[0] = state["cnt"]
+        self.versions[:] = state["versions"]
+        R = [self._sub_oram(i, position, None) for i, position in enumerate(state["positions"])]
+        for Ri, S in zip(R, state["stashes"]):
+            Ri.S = S
+        return R
+
+    def _sub_oram(self, i, position, data):
+        return SubORAMClient(i, self.cnt, position, data, self.N, self.h, B=self.B, Z=self.Z, codec=self.codec, cipher=self.cipher_factory(), storage=self.storage_factory(), crypto_pool=self.crypto_pool, dummy_pool_size=self.dummy_pool_size, bucket_sizes=self.bucket_sizes, versions=self.versions)
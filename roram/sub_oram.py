@@ -1,153 +1,283 @@
 # modified basic path oram for now
 
 import random
-import json
 import numpy as np
-import copy
-from cryptography.fernet import Fernet
+from block_codec import BinaryBlockCodec
+from cipher import AESGCMCipher
+from storage import InMemoryStorage
+from crypto_pool import DummyPool
+from path_oram_server import level_offsets
+from recursive_path_oram_client import _check_layout
 
 class SubORAMServer:
     def __init__(self, data, Z):
-        self.data = data
-        self.Z = Z
+        self.data = data # storage backend (storage.InMemoryStorage, storage.MMapStorage)
+        self.Z = Z # slots per bucket, or a list of the slots per bucket of every level (root first)
+        if isinstance(Z, (list, tuple)):
+            offsets, total = level_offsets(Z)
+            self._offsets = offsets + [total] # first slot of every level, and of the level past the leaves
+        else:
+            self._offsets = None
+
+    def _slot(self, b):
+        # first slot of bucket index b, the buckets of a level are contiguous
+        if self._offsets is None:
+            return b * self.Z
+        l = (b + 1).bit_length() - 1
+        return self._offsets[l] + (b - 2 ** l + 1) * (self.Z[l] if l < len(self.Z) else 0)
 
-    # i, j are bucket indices not blocks!
+    # i, j are bucket indices not blocks! (of the same level)
     def read_slice(self, i, j): # [i,j)
-        return self.data[i*self.Z:j*self.Z]
+        return self.data.read_range(self._slot(i), self._slot(j))
     
-    # i, j are bucket indices not blocks!
+    # i, j are bucket indices not blocks! (of the same level)
     def write_slice(self, i, j, data): # [i,j)
-        self.data[i*self.Z:j*self.Z] = data
+        self.data.write_range(self._slot(i), self._slot(j), data)
+
+    def _ranges(self, slices):
+        # slot ranges of (level, start, length) slices, a slice wrapping around the end of its level takes two
+        ranges = []
+        for level, start, length in slices:
+            first, n = 2 ** level - 1, min(length, 2 ** level)
+            start %= 2 ** level
+            if start + n <= 2 ** level:
+                ranges.append((self._slot(first + start), self._slot(first + start + n)))
+            else:
+                ranges.append((self._slot(first + start), self._slot(first + 2 ** level)))
+                ranges.append((self._slot(first), self._slot(first + start + n - 2 ** level)))
+        return ranges
+
+    def read_slices(self, slices):
+        """
+            slices: list of (level, start, length), the buckets start, ..., start + length - 1 (mod 2^level) of a level
+            -> the slots of all of them, concatenated in order (a single read_ranges request)
+        """
+        return [slot for slots in self.data.read_ranges(self._ranges(slices)) for slot in slots]
+
+    def write_slices(self, slices, data):
+        """data: the slots of all the slices, concatenated in order (a single write_ranges request)"""
+        ranges = self._ranges(slices)
+        if len(data) != sum(j - i for i, j in ranges):
+            raise ValueError(f"Expected {sum(j - i for i, j in ranges)} slots, got {len(data)}")
+        slots, k = [], 0
+        for i, j in ranges:
+            slots.append(data[k:k + j - i])
+            k += j - i
+        self.data.write_ranges(ranges, slots)
+
+
+class BlockRecord:
+    """
+        A block in the stashes of the sub-ORAMs: its data, its position in every sub-ORAM R_0, ..., R_l and its version
+        (the access that last moved it, 0 at construction), which tells it from the stale copies left in the trees.
+        The stashes share one record per block instead of copies, so its fields are updated in place.
+        Indexing follows the [d, p_0, ..., p_l] layout: record[0] is the data, record[1 + i] the position in R_i.
+    """
+
+    __slots__ = ("data", "positions", "version")
+
+    def __init__(self, data, positions, version=0):
+        self.data = data
+        self.positions = positions # list, p_i is the position in R_i
+        self.version = version
+
+    def __getitem__(self, k):
+        return self.data if k == 0 else self.positions[k - 1]
+
+    def __setitem__(self, k, value):
+        if k == 0:
+            self.data = value
+        else:
+            self.positions[k - 1] = value
+
+    def __iter__(self):
+        yield self.data
+        yield from self.positions
+
+    def __len__(self):
+        return 1 + len(self.positions)
+
+    def __repr__(self):
+        return repr([self.data, *self.positions])
 
 
 class SubORAMClient:
-    def __init__(self, i, cnt, position, data, N, h, B, Z):
+    def __init__(self, i, cnt, position, data, N, h, B, Z, codec=None, cipher=None, storage=None, crypto_pool=None, dummy_pool_size=0,
+                 bucket_sizes=None, versions=None):
         
         self.i = i # as in R_i
         self.N = N # total # blocks outsourced to server
         self.h = h # height of binary tree
         self.B = B # block size (in bits)
-        self.Z = Z # capacity of each bucket (in blocks)
+        # capacity of the buckets of every level (root first), Z everywhere by default
+        self.bucket_sizes = list(bucket_sizes) if bucket_sizes is not None else [Z] * (h + 1)
+        if len(self.bucket_sizes) != h + 1:
+            raise ValueError(f"{len(self.bucket_sizes)} bucket sizes given for h={h}")
+        self.Z = max(self.bucket_sizes) # capacity of each bucket (in blocks), the largest one with per-level sizes
         self.cnt = cnt
+        self.codec = codec if codec is not None else BinaryBlockCodec(B) # block <-> B byte plaintext
 
         self.position = position # position map
-        self.S = data # start with the initial data in stash
-        # but will then immediately evict so we only have large amount of data in stash as part of initialization
-        # so after initialization, normal stash bounds apply
+        # current version of every block (shared with the other sub-ORAMs), older copies read from the tree are dropped
+        self.versions = versions if versions is not None else [0] * N
+        self.S = {} # stash: block id -> BlockRecord (shared with the other sub-ORAMs), filled by _build_tree
 
-        # encryption/decryption
-        key = Fernet.generate_key()
-        self.f = Fernet(key)
+        # encryption/decryption, different bucket sizes need slots that do not depend on the bucket size
+        uniform = len(set(self.bucket_sizes)) == 1
+        if cipher is None:
+            cipher = AESGCMCipher() if uniform else AESGCMCipher(granularity="block")
+        self.cipher = cipher
+        if len({self.cipher.slot_size(z, B) for z in self.bucket_sizes}) > 1:
+            raise ValueError("Per-level bucket sizes need a cipher whose slot size does not depend on the bucket size")
+        self.crypto_pool = crypto_pool # optional crypto_pool.CryptoPool for the buckets of a slice
+        self._level_slots = [self.cipher.slots_per_bucket(z) for z in self.bucket_sizes] # server slots per bucket of every level
+        self._slots = self._level_slots[0] if uniform else self._level_slots
+        self._dummy_block = self.codec.encode(-1, b"")
+        # background-refilled encrypted dummies for padding buckets (off by default)
+        self.dummy_pool = DummyPool(self.cipher, self._dummy_block, self.Z, dummy_pool_size) if dummy_pool_size else None
 
-        # server
-        self.server = SubORAMServer(np.array([self._create_dummy_block() for _ in range(self.Z * (2 ** (self.h + 1) - 1))]), self.Z)
+        # server, built with the initial data (block id -> BlockRecord) already in place,
+        # or with data=None the tree already in storage (a reopened ORAM)
+        storage = storage if storage is not None else InMemoryStorage()
+        if data is None:
+            _check_layout(storage, level_offsets(self._level_slots)[1], self.cipher.slot_size(self.Z, B))
+        storage.allocate(level_offsets(self._level_slots)[1], self.cipher.slot_size(self.Z, B))
+        self.server = SubORAMServer(storage, self._slots)
+        if data is not None:
+            self._build_tree(data)
     
+    def close(self):
+        """stops the dummy pool"""
+        if self.dummy_pool is not None:
+            self.dummy_pool.close()
+
     def _uniform_random(self, n):
         # return a uniform random int from 0 to n inclusive
         return random.randint(0, n)
-    
-    def _create_dummy_block(self):
-        return self._encrypt_block((-1, "dummy!"))
-
-    def _read_buckets(self, j, start, length, p=None):
-        start = start % 2 ** j
-        end = (start + length) % 2 ** j
-        if length >= 2 ** j:
-            encrypted_blocks = self.server.read_slice(2 ** j - 1 + 0, 2 ** j - 1 + 2 ** j).tolist()
-        elif start <= end:
-            encrypted_blocks = self.server.read_slice(2 ** j - 1 + start, 2 ** j - 1 + end).tolist()
-        else:
-            encrypted_blocks = self.server.read_slice(2 ** j - 1 + start, 2 ** j - 1 + 2 ** j).tolist() + self.server.read_slice(2 ** j - 1 + 0, 2 ** j - 1 + end).tolist()
-        decrypted_blocks = {}
-        for encrypted_block in encrypted_blocks:
-            a, data = self._decrypt_block(encrypted_block)
-            if a != -1 and a not in decrypted_blocks: # not dummy and not already there
-                decrypted_blocks[a] = data
-        return decrypted_blocks
+
+    def _build_tree(self, data):
+        """
+            Writes the whole tree once, with every block of data in the deepest bucket of its path (bucket p_i mod 2^j
+            of level j) that still has room, the blocks that fit nowhere start in the stash.
+            The blocks are placed one level at a time from the leaves up, vectorized over their positions,
+            then every level is sealed in bulk (on crypto_pool if there is one) and written with one write_slices.
+        """
+        ids = np.fromiter(data, dtype=np.int64, count=len(data))
+        positions = np.fromiter((data[a].positions[self.i] for a in data), dtype=np.int64, count=len(data))
+        levels = [] # (level, ids of its blocks, bucket of each block)
+        for j in range(self.h, -1, -1):
+            buckets = positions % 2 ** j
+            order = np.argsort(buckets, kind="stable")
+            sorted_buckets = buckets[order]
+            rank = np.arange(len(order)) - np.searchsorted(sorted_buckets, sorted_buckets) # rank in its bucket
+            fits = np.zeros(len(order), dtype=bool)
+            fits[order[rank < self.bucket_sizes[j]]] = True
+            levels.append((j, ids[fits], buckets[fits]))
+            ids, positions = ids[~fits], positions[~fits]
+        self.S = {a: data[a] for a in ids.tolist()}
+
+        # one level at a time, so only a level of sealed buckets is held in memory
+        for j, level_ids, level_buckets in levels:
+            level = [{} for _ in range(2 ** j)]
+            for a, b in zip(level_ids.tolist(), level_buckets.tolist()):
+                level[b][a] = data[a]
+            self._write_slices([(j, 0, 2 ** j)], [level])
+
+    @staticmethod
+    def _slice_buckets(j, start, length):
+        # bucket indices (in level j) of a slice, in order: start, ..., start + length - 1 mod 2^j
+        return [(start + t) % 2 ** j for t in range(min(length, 2 ** j))]
+
+    def _read_slices(self, slices):
+        """
+            slices: list of (level, start, length) -> for every slice, the blocks (a -> BlockRecord) of its buckets
+            that are not dummies nor stale, the first copy of a block wins.
+            All the slices are read with one server request and opened together.
+        """
+        slots = self.server.read_slices(slices)
+        buckets, k = [], 0
+        for j, _, length in slices:
+            n = self._level_slots[j]
+            for _ in range(min(length, 2 ** j)):
+                buckets.append(slots[k:k + n])
+                k += n
+        opened = iter(self._open_buckets(buckets))
+        result = []
+        for j, _, length in slices:
+            decrypted_blocks = {}
+            for _ in range(min(length, 2 ** j)):
+                for a, data in next(opened):
+                    if a != -1 and a not in decrypted_blocks and data.version == self.versions[a]: # not dummy, not already there, not stale
+                        decrypted_blocks[a] = data
+            result.append(decrypted_blocks)
+        return result
 
     # pads with dummy blocks if needed
-    def _write_buckets(self, j, start, length, buckets):
-        start = start % 2 ** j
-        end = (start + length) % 2 ** j
-        if length >= 2 ** j:
-            encrypted_blocks = []
-            for r in range(0, 2 ** j):
-                bucket = buckets[r]
-                encrypted_blocks += [self._encrypt_block(block) for block in bucket.items()]
-                for _ in range(self.Z - len(bucket)):
-                    encrypted_blocks.append(self._create_dummy_block())
-            self.server.write_slice(2 ** j - 1 + 0, 2 ** j - 1 + 2 ** j, np.array(encrypted_blocks))
-        elif start <= end:
-            encrypted_blocks = []
-            for r in range(start, end):
-                bucket = buckets[r]
-                encrypted_blocks += [self._encrypt_block(block) for block in bucket.items()]
-                for _ in range(self.Z - len(bucket)):
-                    encrypted_blocks.append(self._create_dummy_block())
-            self.server.write_slice(2 ** j - 1 + start, 2 ** j - 1 + end, np.array(encrypted_blocks))
-        else:
-            encrypted_blocks_1 = []
-            encrypted_blocks_2 = []
-            for r in range(start, 2 ** j):
-                bucket = buckets[r]
-                encrypted_blocks_1 += [self._encrypt_block(block) for block in bucket.items()]
-                for _ in range(self.Z - len(bucket)):
-                    encrypted_blocks_1.append(self._create_dummy_block())
-
-            for r in range(0, end):
-                bucket = buckets[r]
-                encrypted_blocks_2 += [self._encrypt_block(block) for block in bucket.items()]
-                for _ in range(self.Z - len(bucket)):
-                    encrypted_blocks_2.append(self._create_dummy_block())
-                
-            self.server.write_slice(2 ** j - 1 + start, 2 ** j - 1 + 2 ** j, np.array(encrypted_blocks_1))
-            self.server.write_slice(2 ** j - 1 + 0, 2 ** j - 1 + end, np.array(encrypted_blocks_2))
-
-    def _encrypt_block(self, block):
-        byte_block = json.dumps(block).encode("utf-8")
-        padded_block = self._pad_block(byte_block)
-        encrypted_block = self._encrypt(padded_block)
-        return encrypted_block
-
-    def _decrypt_block(self, block):
-        padded_decrypted_byte_block = self._decrypt(block)
-        decrypted_byte_block = self._depad_block(padded_decrypted_byte_block)
-        decrypted_block = decrypted_byte_block.decode("utf-8")
-        a, data = json.loads(decrypted_block)
-        return a, data
-        
-    def _pad_block(self, block):
-        if len(block) > self.B:
-            raise ValueError(f"Block size {len(block)} is larger than B={self.B}")
-        if len(block) == self.B:
-            return block
-        return block + b"\x01" + b"\x00" * (self.B - len(block) - 1)
+    def _write_slices(self, slices, buckets):
+        # buckets: for every slice, its buckets in order, all sealed together and written with one server request
+        sizes = [self.bucket_sizes[j] for (j, _, _), slice_buckets in zip(slices, buckets) for _ in slice_buckets]
+        self.server.write_slices(slices, self._seal_slice([bucket for slice_buckets in buckets for bucket in slice_buckets], sizes))
 
-    def _depad_block(self, block):
-        return block.rstrip(b"\x00").removesuffix(b"\x01")
+    # block is (a, BlockRecord), bucket is dict a -> BlockRecord, the version is encoded after the positions
+    def _seal_bucket(self, bucket, Z):
+        blocks = [self.codec.encode(a, record.data, [*record.positions, record.version]) for a, record in bucket.items()]
+        if self.dummy_pool is not None:
+            return self.dummy_pool.seal(blocks, Z)
+        blocks += [self._dummy_block] * (Z - len(blocks))
+        return self.cipher.seal(blocks)
 
-    def _encrypt(self, data, identity=False):
-        return self.f.encrypt(data) if not identity else data
+    def _open_bucket(self, slots):
+        # returns the (a, BlockRecord) blocks of the bucket, including dummies (a == -1)
+        blocks = []
+        for block in self.cipher.open(slots, self.B):
+            a, data, positions = self.codec.decode(block)
+            blocks.append((a, BlockRecord(data, list(positions[:-1]), positions[-1] if positions else 0)))
+        return blocks
 
-    def _decrypt(self, data, identity=False):
-        return self.f.decrypt(data) if not identity else data
+    def _seal_slice(self, buckets, Z):
+        # list of buckets of Z blocks (or of Z[k] blocks for the k-th one) -> the slots of all of them, in order
+        if self.crypto_pool is None:
+            sizes = Z if isinstance(Z, (list, tuple)) else [Z] * len(buckets)
+            sealed = [self._seal_bucket(bucket, z) for bucket, z in zip(buckets, sizes)]
+        else:
+            blocks = [[(a, record.data, [*record.positions, record.version]) for a, record in bucket.items()] for bucket in buckets]
+            sealed = self.crypto_pool.seal_buckets(self.cipher, self.codec, blocks, Z, self._dummy_block, self.dummy_pool)
+        return [slot for slots in sealed for slot in slots]
+
+    def _open_buckets(self, buckets):
+        # list of the slots of every bucket -> list of the blocks of every bucket as returned by _open_bucket
+        if self.crypto_pool is None:
+            return [self._open_bucket(slots) for slots in buckets]
+        return [[(a, BlockRecord(data, list(positions[:-1]), positions[-1] if positions else 0)) for a, data, positions in blocks]
+                for blocks in self.crypto_pool.open_buckets(self.cipher, self.codec, buckets, self.B)]
     
-    # block is now (a, (d, p_0, ..., p_l))
+    # block is now (a, BlockRecord)
     def read_range(self, a):
         """
             Reads the range [a, a + 2i)
             a must be a multiple of 2^i
+            The records are not copied: the ones from the stash are shared with the other sub-ORAMs.
         """
-        result = {B[0]:B[1] for B in self.S.items() if a <= B[0] < a + 2 ** self.i}
-        p = self.position[a]
-        p_prime = self._uniform_random(self.N - 1)
-        self.position[a] = p_prime
-        for j in range(self.h + 1):
-            V = self._read_buckets(j, p, 2 ** self.i)
-            for B in V.items():
-                if a <= B[0] < a + 2 ** self.i and B[0] not in result:
-                    result.update([B])
-        return (copy.deepcopy(result), p_prime)
+        return self.read_ranges([a])[0]
+
+    def read_ranges(self, starts):
+        """
+            read_range of every range start in starts, returns the list of their (result, p_prime).
+            The slices of all the levels of all the ranges are read with one server request.
+        """
+        slices = [(j, self.position[a], 2 ** self.i) for a in starts for j in range(self.h + 1)]
+        V = self._read_slices(slices)
+        results = []
+        for n, a in enumerate(starts):
+            result = {B[0]:B[1] for B in self.S.items() if a <= B[0] < a + 2 ** self.i}
+            for level_blocks in V[n * (self.h + 1):(n + 1) * (self.h + 1)]:
+                for B in level_blocks.items():
+                    if a <= B[0] < a + 2 ** self.i and B[0] not in result:
+                        result.update([B])
+            p_prime = self._uniform_random(self.N - 1)
+            self.position[a] = p_prime
+            results.append((result, p_prime))
+        return results
             
 
     def batch_evict(self, k):
@@ -159,34 +289,43 @@ class SubORAMClient:
             maintain this order.
         """
         cnt = self.cnt[0]
-        for j in range(self.h + 1):
-            V = self._read_buckets(j, cnt, k)
+        slices = [(j, cnt, k) for j in range(self.h + 1)]
+        for V in self._read_slices(slices):
             for B in V.items():
                 if B[0] not in self.S.keys():
                     self.S.update([B])
 
-        # evict paths
-        v = {j: ([None] * 2 ** j) for j in range(0, self.h + 1)}
+        index = self._index_stash(cnt, k)
+
+        # evict paths, deepest level first: a bucket takes the blocks for which it is the deepest target
+        # and the ones that did not fit in its target children, the blocks that do not fit move up to its parent
+        v = {j: {} for j in range(0, self.h + 1)} # level -> evicted bucket -> its blocks
+        leftovers = {} # (level, bucket) -> blocks that did not fit in its children
         for j in range(self.h, -1, -1):
-            start = cnt % 2 ** j
-            end = (cnt + k) % 2 ** j
-            if k >= 2 ** j:
-                r_range = range(0, 2 ** j)
-            elif start <= end:
-                r_range = range(start, end)
-            else:
-                r_range = [*range(start, 2 ** j), *range(0, end)]
-            for r in r_range:
-                S_prime = {}
-                for B in self.S.items():
-                    if B[1][self.i + 1] % 2 ** j == r:
-                        S_prime.update([B])
-                        if len(S_prime) == self.Z:
-                            break
-                for a in S_prime.keys():
-                    del self.S[a]
-                v[j][r] = S_prime
+            Z = self.bucket_sizes[j]
+            for r in self._slice_buckets(j, cnt, k):
+                candidates = index.get((j, r), []) + leftovers.pop((j, r), [])
+                v[j][r] = {a: self.S.pop(a) for a in candidates[:Z]}
+                if j > 0 and len(candidates) > Z:
+                    leftovers.setdefault((j - 1, r % 2 ** (j - 1)), []).extend(candidates[Z:])
 
         # write back buckets to server
-        for j in range(self.h + 1):
-            self._write_buckets(j, cnt, k, v[j])
+        self._write_slices(slices, [[v[j][r] for r in self._slice_buckets(j, cnt, k)] for j in range(self.h + 1)])
+
+    def _index_stash(self, cnt, k):
+        """
+            Groups the stash by the deepest bucket each block can be evicted to by the k evictions from cnt,
+            returns dict (level, bucket) -> block ids in stash order.
+            A block at position p can go to bucket p mod 2^j of level j, which is evicted iff (p - cnt) mod 2^j < k.
+            That holds for all the levels above the deepest one where it holds, so the deepest levels of all the
+            blocks are found with one vectorized pass over their positions per level.
+        """
+        ids = list(self.S)
+        positions = np.fromiter((self.S[a].positions[self.i] for a in ids), dtype=np.int64, count=len(ids))
+        deepest = np.zeros(len(ids), dtype=np.int64)
+        for j in range(1, self.h + 1):
+            deepest[(positions - cnt) % 2 ** j < k] = j
+        index = {}
+        for a, p, j in zip(ids, positions.tolist(), deepest.tolist()):
+            index.setdefault((j, p % 2 ** j), []).append(a)
+        return index
@@ -0,0 +1,133 @@
+import bisect
+import math
+import numpy as np
+
+
+class Stash(dict):
+    """
+        Path ORAM stash: block_id -> entry (by default (data, position)).
+        leaf(a, entry) returns the leaf a block is assigned to, for stashes whose entries do not carry it.
+    """
+
+    def __init__(self, leaf=None):
+        super().__init__()
+        self._leaf = leaf if leaf is not None else (lambda a, entry: entry[1])
+
+    def evict_path(self, x, L, Z):
+        """
+            Removes the blocks that are written back to the path to leaf x and returns them
+            as a list of L + 1 buckets (dict block_id -> entry), root first.
+            Z is the capacity of every bucket, or a list of the capacities of every level (root first).
+            A block on leaf p can go as deep as level L - bit_length(x ^ p), so the blocks are
+            indexed by that level once and the buckets are filled greedily from the leaf up
+            in a single O(|S| + L * Z) pass.
+        """
+        sizes = Z if isinstance(Z, (list, tuple)) else [Z] * (L + 1)
+        by_level = [[] for _ in range(L + 1)]
+        for a, entry in self.items():
+            by_level[L - (x ^ self._leaf(a, entry)).bit_length()].append(a)
+
+        buckets = [None] * (L + 1)
+        candidates = [] # blocks that can go to the current level or above
+        for l in range(L, -1, -1):
+            candidates += by_level[l]
+            bucket = {}
+            while candidates and len(bucket) < sizes[l]:
+                a = candidates.pop()
+                bucket[a] = self.pop(a)
+            buckets[l] = bucket
+        return buckets
+
+    def evict_paths(self, leaves, L, Z):
+        """
+            evict_path for the union of the paths to leaves: removes the evicted blocks and returns
+            them as dict bucket index -> bucket for every bucket of the union.
+            Every block starts at the deepest bucket of the union on its own path (the leaf sharing the
+            longest prefix with it is a neighbour in sorted order), buckets are filled deepest first
+            and blocks that do not fit move up to the parent.
+        """
+        sizes = Z if isinstance(Z, (list, tuple)) else [Z] * (L + 1)
+        xs = sorted(set(leaves))
+        deepest = {}  # bucket index -> blocks whose deepest bucket in the union it is
+        for a, entry in self.items():
+            p = self._leaf(a, entry)
+            i = bisect.bisect_left(xs, p)
+            l = max(L - (x ^ p).bit_length() for x in xs[max(0, i - 1):i + 1])
+            deepest.setdefault(2 ** l - 1 + (p >> (L - l)), []).append(a)
+
+        union = {2 ** l - 1 + (x >> (L - l)) for x in xs for l in range(L + 1)}
+        buckets = {}
+        leftovers = {}  # bucket index -> blocks that did not fit in its children
+        for b in sorted(union, reverse=True): # children have larger indices than their parents
+            candidates = deepest.get(b, []) + leftovers.pop(b, [])
+            bucket = {}
+            while candidates and len(bucket) < sizes[(b + 1).bit_length() - 1]:
+                a = candidates.pop()
+                bucket[a] = self.pop(a)
+            buckets[b] = bucket
+            if candidates and b > 0:
+                leftovers.setdefault((b - 1) // 2, []).extend(candidates)
+        return buckets
+
+
+def level_bucket_sizes(N, L, max_Z=8, stash_size=40, overflow=2 ** -40):
+    """
+        Per-level bucket capacities (root first) for N blocks in a tree of height L that cut both the server slots
+        and the slots read per path while the estimated probability of more than stash_size blocks in the stash
+        stays below overflow. Starting from the smallest uniform Z <= max_Z that meets it, the levels are shrunk
+        from the leaves up, never below the level under them, so no path is longer than with uniform buckets and
+        the buckets only get smaller towards the leaves.
+        The stash of Path ORAM is what is left over when the blocks of the same accesses on a tree with
+        unbounded buckets (infinity-ORAM) are pushed up greedily from full buckets to their parents, so the
+        estimate does that with independent Poisson loads per bucket: after k more accesses a block sits at
+        the deepest level its leaf shares with one of the k + 1 paths written since it was remapped, and k is
+        geometric with mean N (uniformly random accesses).
+    """
+    Z = next((Z for Z in range(1, max_Z + 1) if _stash_overflow(N, L, [Z] * (L + 1), stash_size) <= overflow), None)
+    if Z is None:
+        raise ValueError(f"Buckets of max_Z={max_Z} blocks overflow the stash of {stash_size} blocks too often")
+    sizes = [Z] * (L + 1)
+    for l in range(L, -1, -1):
+        while sizes[l] > (sizes[l + 1] if l < L else 1):
+            sizes[l] -= 1
+            if _stash_overflow(N, L, sizes, stash_size) > overflow:
+                sizes[l] += 1
+                break
+    return sizes
+
+
+def _poisson(lam, M):
+    # Poisson pmf over 0..M, the last entry holding the mass >= M (summed term by term, 1 - sum would only
+    # be accurate to rounding errors)
+    if lam == 0:
+        return np.eye(1, M + 1, 0)[0]
+    k = np.arange(M + 64 + int(8 * lam))
+    pmf = np.exp(k * math.log(lam) - lam - np.array([math.lgamma(i + 1) for i in k]))
+    return np.append(pmf[:M], pmf[M:].sum())
+
+
+def _stash_overflow(N, L, sizes, stash_size):
+    # probability that more than stash_size blocks are pushed out of the root, distributions are over 0..M,
+    # the last entry holding all the mass >= M (M is large enough that it stays above stash_size)
+    M = stash_size + 1 + sum(sizes)
+    p = 1 / N
+
+    def stays(q):
+        # probability that none of the k + 1 paths shares a prefix of probability q with the leaf of a block
+        return (1 - q) * p / (1 - (1 - p) * (1 - q))
+
+    loads = [N / 2 ** l * (stays(2 ** -(l + 1)) - stays(2 ** -l)) for l in range(L)] + [N / 2 ** L * (1 - stays(2 ** -L))]
+    incoming = _poisson(loads[L], M)
+    for l in range(L, -1, -1):
+        z = sizes[l]
+        over = np.zeros(M + 1)
+        over[0] = incoming[:z + 1].sum()
+        over[1:M + 1 - z] = incoming[z + 1:]
+        if l == 0:
+            return over[stash_size + 1:].sum()
+        incoming = _capped(np.convolve(_capped(np.convolve(over, over), M), _poisson(loads[l - 1], M)), M)
+
+
+def _capped(dist, M):
+    # distribution over 0..M with the mass >= M in the last entry
+    return np.append(dist[:M], dist[M:].sum())
@@ -0,0 +1,304 @@
+import mmap
+import multiprocessing
+import os
+import struct
+import tempfile
+
+
+class InMemoryStorage:
+    """server storage kept as a python list of slots (one ciphertext per slot)"""
+
+    def __init__(self):
+        self._slots = []
+        self.slot_size = None
+
+    def allocate(self, num_slots, slot_size):
+        self._slots = [None] * num_slots
+        self.slot_size = slot_size
+
+    def __len__(self):
+        return len(self._slots)
+
+    def read(self, i):
+        return self._slots[i]
+
+    def write(self, i, slot):
+        self._slots[i] = slot
+
+    def read_range(self, i, j): # [i,j)
+        return self._slots[i:j]
+
+    def write_range(self, i, j, slots): # [i,j)
+        if len(slots) != j - i:
+            raise ValueError(f"Expected {j - i} slots, got {len(slots)}")
+        self._slots[i:j] = slots
+
+    def read_ranges(self, ranges):
+        """ranges: list of [i,j) -> list of the slots of every range (one request for remote storage)"""
+        return [self.read_range(i, j) for i, j in ranges]
+
+    def write_ranges(self, ranges, slots):
+        """slots: the slots of every range"""
+        for (i, j), range_slots in zip(ranges, slots):
+            self.write_range(i, j, range_slots)
+
+
+class MMapStorage:
+    """
+        server storage laid out as fixed-size slots in a memory-mapped file.
+        Reads return zero-copy memoryviews into the mapping. The file starts with a small header
+        (magic, number of slots, slot size) so that it can be reopened after a restart by passing the same path.
+        With path=None an anonymous temporary file is used.
+    """
+
+    _MAGIC = b"ORAMSLOT"
+    _HEADER = struct.Struct("<8sQQ")
+    _HEADER_SIZE = mmap.PAGESIZE # keeps the slots page aligned
+
+    def __init__(self, path=None):
+        self.path = path
+        self.num_slots = 0
+        self.slot_size = None
+        self._file = None
+        self._mmap = None
+        self._view = None
+        if path is not None and os.path.exists(path) and os.path.getsize(path) >= self._HEADER_SIZE:
+            self._open(open(path, "r+b"))
+
+    def _open(self, file):
+        self._file = file
+        self._mmap = mmap.mmap(file.fileno(), 0)
+        magic, self.num_slots, self.slot_size = self._HEADER.unpack_from(self._mmap, 0)
+        if magic != self._MAGIC:
+            self.close()
+            raise ValueError(f"{self.path} is not an ORAM storage file")
+        self._view = memoryview(self._mmap)
+
+    def allocate(self, num_slots, slot_size):
+        if self._mmap is not None and (self.num_slots, self.slot_size) == (num_slots, slot_size):
+            return # reopened file already has the right layout
+        self.close() # before anything is changed
+        file = open(self.path, "w+b") if self.path is not None else tempfile.TemporaryFile()
+        file.truncate(self._HEADER_SIZE + num_slots * slot_size)
+        file.write(self._HEADER.pack(self._MAGIC, num_slots, slot_size))
+        file.flush()
+        self._open(file)
+
+    def __len__(self):
+        return self.num_slots
+
+    def _offset(self, i):
+        return self._HEADER_SIZE + i * self.slot_size
+
+    def read(self, i):
+        offset = self._offset(i)
+        return self._view[offset:offset + self.slot_size]
+
+    def write(self, i, slot):
+        if len(slot) != self.slot_size:
+            raise ValueError(f"Slot size {len(slot)} does not match slot_size={self.slot_size}")
+        offset = self._offset(i)
+        self._mmap[offset:offset + self.slot_size] = slot
+
+    def read_range(self, i, j): # [i,j)
+        view = self._view[self._offset(i):self._offset(j)]
+        return [view[k:k + self.slot_size] for k in range(0, len(view), self.slot_size)]
+
+    def write_range(self, i, j, slots): # [i,j)
+        data = b"".join(slots)
+        if len(data) != (j - i) * self.slot_size:
+            raise ValueError(f"Expected {j - i} slots of {self.slot_size} bytes")
+        self._mmap[self._offset(i):self._offset(j)] = data
+
+    def read_ranges(self, ranges):
+        """ranges: list of [i,j) -> list of the slots of every range (one request for remote storage)"""
+        return [self.read_range(i, j) for i, j in ranges]
+
+    def write_ranges(self, ranges, slots):
+        """slots: the slots of every range"""
+        for (i, j), range_slots in zip(ranges, slots):
+            self.write_range(i, j, range_slots)
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        """raises BufferError, leaving the storage open, while slots returned by a read are still referenced"""
+        if self._mmap is None:
+            return
+        self.flush()
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            self._view = memoryview(self._mmap)
+            raise BufferError("slots read from the storage are still referenced, release them before closing") from None
+        self._file.close()
+        self._mmap = self._view = self._file = None
+
+
+def _shard_worker(conn, storage_factory):
+    # serves (method, args) requests on the storage of one shard until "close"
+    storage = storage_factory()
+    while True:
+        op, args = conn.recv()
+        if op == "close":
+            conn.close()
+            return
+        try:
+            result = getattr(storage, op)(*args)
+            if op == "read_ranges": # memoryviews cannot be pickled
+                result = [[bytes(slot) if slot is not None else None for slot in slots] for slots in result]
+            conn.send((True, result))
+        except Exception as e:
+            conn.send((False, e))
+
+
+class ShardedStorage:
+    """
+        server storage split across num_shards worker processes, each with its own storage_factory() backend
+        (so each can live on its own disk), so that the buckets of a path are read and written in parallel.
+        The top top_levels levels of the tree are pinned to shard 0 and the subtrees below are split evenly
+        across the shards. slots_per_bucket must match the server (cipher.slots_per_bucket(Z), 1 for bucket
+        granularity ciphers).
+        layout="heap" shards the subtrees of Path ORAM (the path to leaf x goes through bucket x >> (L - l) of
+        level l), layout="slices" the ones of the rORAM sub-ORAMs (path p goes through bucket p mod 2^l),
+        so a level slice is spread across all the shards.
+    """
+
+    def __init__(self, num_shards=2, top_levels=None, slots_per_bucket=1, layout="heap", storage_factory=InMemoryStorage):
+        if layout not in ("heap", "slices"):
+            raise ValueError(f"Invalid layout {layout}")
+        self.num_shards = num_shards
+        self.top_levels = top_levels
+        self.slots_per_bucket = slots_per_bucket
+        self.layout = layout
+        self.storage_factory = storage_factory
+        self.num_slots = 0
+        self.slot_size = None
+        self._shards = [] # (process, connection)
+
+    def allocate(self, num_slots, slot_size):
+        num_buckets, rest = divmod(num_slots, self.slots_per_bucket)
+        if rest or (num_buckets + 1) & num_buckets:
+            raise ValueError(f"{num_slots} slots are not a tree of buckets of {self.slots_per_bucket} slots")
+        self.close()
+        L = (num_buckets + 1).bit_length() - 2
+        self._bits = (self.num_shards - 1).bit_length() # subtrees start at level _bits, 2^_bits of them
+        self._top = min(L + 1, max(self._bits, self.top_levels or 0))
+        # local bucket index of the first bucket of every level >= _top in each shard, shard 0 starts with the top
+        self._groups = [len(range(s, 2 ** self._bits, self.num_shards)) for s in range(self.num_shards)]
+        self._base = []
+        sizes = []
+        for s in range(self.num_shards):
+            base = [0] * (L + 1)
+            offset = 2 ** self._top - 1 if s == 0 else 0
+            for l in range(self._top, L + 1):
+                base[l] = offset
+                offset += self._groups[s] << (l - self._bits)
+            self._base.append(base)
+            sizes.append(offset)
+
+        for size in sizes:
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_worker, args=(child, self.storage_factory), daemon=True)
+            process.start()
+            self._shards.append((process, conn))
+            conn.send(("allocate", (size * self.slots_per_bucket, slot_size)))
+        for _, conn in self._shards:
+            self._result(conn)
+        self.num_slots, self.slot_size = num_slots, slot_size
+
+    def _result(self, conn):
+        ok, result = conn.recv()
+        if not ok:
+            raise result
+        return result
+
+    def _locate(self, b):
+        # bucket index -> (shard, local bucket index)
+        l = (b + 1).bit_length() - 1
+        if l < self._top:
+            return 0, b
+        r = b - (2 ** l - 1)
+        depth = l - self._bits
+        if self.layout == "heap":
+            group, within = r >> depth, r & ((1 << depth) - 1)
+            shard = group % self.num_shards
+            return shard, self._base[shard][l] + ((group // self.num_shards) << depth) + within
+        group, q = r & ((1 << self._bits) - 1), r >> self._bits
+        shard = group % self.num_shards
+        return shard, self._base[shard][l] + q * self._groups[shard] + group // self.num_shards
+
+    def _split(self, ranges):
+        # global slot ranges -> local slot ranges per shard, and where each slot lands in its shard's flat reply
+        requests = [[] for _ in range(self.num_shards)]
+        counts = [0] * self.num_shards
+        where = []
+        for i, j in ranges:
+            slots = []
+            for s in range(i, j):
+                b, k = divmod(s, self.slots_per_bucket)
+                shard, local = self._locate(b)
+                local = local * self.slots_per_bucket + k
+                request = requests[shard]
+                if request and request[-1][1] == local:
+                    request[-1][1] += 1
+                else:
+                    request.append([local, local + 1])
+                slots.append((shard, counts[shard]))
+                counts[shard] += 1
+            where.append(slots)
+        return requests, where
+
+    def __len__(self):
+        return self.num_slots
+
+    def read(self, i):
+        return self.read_ranges([(i, i + 1)])[0][0]
+
+    def write(self, i, slot):
+        self.write_ranges([(i, i + 1)], [[slot]])
+
+    def read_range(self, i, j): # [i,j)
+        return self.read_ranges([(i, j)])[0]
+
+    def write_range(self, i, j, slots): # [i,j)
+        self.write_ranges([(i, j)], [slots])
+
+    def read_ranges(self, ranges):
+        requests, where = self._split(ranges)
+        # every shard gets its request before any reply is awaited, so the shards work in parallel
+        for (_, conn), request in zip(self._shards, requests):
+            if request:
+                conn.send(("read_ranges", (request,)))
+        flat = [[slot for slots in self._result(conn) for slot in slots] if request else []
+                for (_, conn), request in zip(self._shards, requests)]
+        return [[flat[shard][k] for shard, k in slots] for slots in where]
+
+    def write_ranges(self, ranges, slots):
+        for (i, j), range_slots in zip(ranges, slots):
+            if len(range_slots) != j - i:
+                raise ValueError(f"Expected {j - i} slots, got {len(range_slots)}")
+        requests, where = self._split(ranges)
+        flat = [[None] * sum(j - i for i, j in request) for request in requests]
+        for range_where, range_slots in zip(where, slots):
+            for (shard, k), slot in zip(range_where, range_slots):
+                flat[shard][k] = bytes(slot)
+        for (_, conn), request, shard_slots in zip(self._shards, requests, flat):
+            if request:
+                grouped, k = [], 0
+                for i, j in request:
+                    grouped.append(shard_slots[k:k + j - i])
+                    k += j - i
+                conn.send(("write_ranges", (request, grouped)))
+        for (_, conn), request in zip(self._shards, requests):
+            if request:
+                self._result(conn)
+
+    def close(self):
+        for process, conn in self._shards:
+            conn.send(("close", ()))
+            process.join()
+        self._shards = []
@@ -1,4 +1,13 @@
+import random
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
 from recursive_path_oram_client import Client, recursiveClient
+from basic_path_oram_client import PathORAMClient
+from cipher import AESGCMCipher
+from crypto_pool import CryptoPool
+from roram.roram_client import RORAMClient
+from stash import level_bucket_sizes
+from storage import InMemoryStorage, MMapStorage
 
 def test_basic_write_read(client_class, label="Path ORAM"):
     print(f"\n=== Overwriting blocks with trace ({label}) ===")
@@ -24,6 +33,341 @@ def test_basic_write_read(client_class, label="Path ORAM"):
     print(f"Passed overwrite test ({label})\n")
 
 
+def test_path_round_trips():
+    print("\n=== Server requests per access ===")
+    client = Client(64, B=512)
+    calls = []
+    for name in ["read_path", "write_path", "read_block", "write_block"]:
+        method = getattr(client.server, name)
+        setattr(client.server, name, lambda *args, _name=name, _method=method: calls.append(_name) or _method(*args))
+
+    client.access("write", 5, "five")
+    assert calls == ["read_path", "write_path"], f"Unexpected server requests {calls}"
+    calls.clear()
+    assert client.access("read", 5) == "five"
+    assert calls == ["read_path", "write_path"], f"Unexpected server requests {calls}"
+
+    # multi-path variants cover the union of the paths once
+    server = client.server
+    buckets = server.read_paths([0, 1, 2 ** client.L - 1])
+    assert len(buckets) == (client.L + 2) + client.L  # 0 and 1 only differ in the leaf, the last path only shares the root
+    server.write_paths(buckets)
+    assert client.access("read", 5) == "five"
+    print("Passed server requests test\n")
+
+
+def test_recursive_accesses():
+    print("\n=== Recursive accesses per logical access ===")
+    N = 2000
+    client = recursiveClient(N, B=32)
+    levels = [client]
+    while levels[-1].position is None:
+        levels.append(levels[-1].position_map._oram)
+    assert len(levels) > 2, "expected at least two recursion levels"
+
+    counts = [0] * len(levels)
+    for k, level in enumerate(levels):
+        method = level._access
+        def counted(*args, _k=k, _method=method):
+            counts[_k] += 1
+            return _method(*args)
+        level._access = counted
+
+    for i in range(0, N, 97):
+        client.access("write", i, f"rec_{i}")
+    for i in range(0, N, 97):
+        assert client.access("read", i) == f"rec_{i}"
+    accesses = 2 * len(range(0, N, 97))
+    assert counts == [accesses] * len(levels), f"Expected one access per level, got {counts} for {accesses} accesses"
+    print(f"Passed recursive accesses test ({len(levels)} levels)\n")
+
+
+def test_position_map_chunks():
+    print("\n=== Position map chunks fill their blocks ===")
+    N, B = 2000, 64
+    client = recursiveClient(N, B=B)
+    position_map = client.position_map
+    # 9 bits per leaf (L=9) in the 64 - 22 bytes left after the codec header: 37 leaves per chunk, 55 chunks
+    capacity = B - client.codec.overhead()
+    assert (position_map.E, position_map._width) == (37, 9)
+    assert capacity < ((position_map.E + 1) * 9 + 7) // 8, "one more leaf would still fit"
+    chunk = position_map._updated(None, {a: 2 ** 9 - 1 for a in range(position_map.E)})
+    assert len(chunk) == capacity, f"a full chunk takes {len(chunk)} of the {capacity} bytes"
+    client.codec.encode(0, chunk, (0,)) # fits
+    assert position_map._oram.N == 55 and position_map._oram.position is not None, "expected a single position map level"
+    for i in range(0, N, 101):
+        client.access("write", i, i)
+    for i in range(0, N, 101):
+        assert client.access("read", i) == i
+    print("Passed position map chunks test\n")
+
+
+def test_treetop_cache():
+    print("\n=== Treetop cache ===")
+    B, Z = 512, 4
+    budget = 7 * Z * B  # top 3 levels
+    for client in [Client(64, B=B, Z=Z, treetop_budget=budget), PathORAMClient(64, B=B, Z=Z, treetop_budget=budget),
+                   recursiveClient(64, B=B, Z=Z, treetop_budget=budget)]:
+        assert client.treetop_levels == 3
+        requested = []
+        read_path = client.server.read_path
+        client.server.read_path = lambda leaf, start=0: requested.append(start) or read_path(leaf, start)
+        for i in range(64):
+            client.access("write", i, f"top_{i}")
+        for i in range(64):
+            assert client.access("read", i) == f"top_{i}"
+        assert set(requested) == {3}, "cached levels were read from the server"
+    print("Passed treetop cache test\n")
+
+
+def test_bulk_load():
+    print("\n=== Bulk load ===")
+    N = 3000
+    for client in [Client(N, B=256, initial_data=(f"bulk_{i}" for i in range(N))),
+                   Client(N, B=256, treetop_budget=4096, initial_data=[f"bulk_{i}" for i in range(N)]),
+                   recursiveClient(N, B=256, initial_data=(f"bulk_{i}" for i in range(N)))]:
+        for i in range(0, N, 37):
+            val = client.access("read", i)
+            assert val == f"bulk_{i}", f"Expected bulk_{i}, got {val}"
+        client.access("write", 5, "new")
+        assert client.access("read", 5) == "new"
+
+    # indexable values are fetched bucket by bucket, each once
+    class Values(Sequence):
+        def __init__(self, n):
+            self.n, self.fetched = n, []
+
+        def __len__(self):
+            return self.n
+
+        def __getitem__(self, a):
+            self.fetched.append(int(a))
+            return f"indexed_{a}"
+
+    values = Values(N)
+    client = Client(N, B=256, initial_data=values)
+    assert sorted(values.fetched) == list(range(N)) and values.fetched != list(range(N))
+    assert all(client.access("read", i) == f"indexed_{i}" for i in range(0, N, 41))
+
+    # blocks without a value are not in the ORAM
+    client = Client(16, B=256, initial_data=["only_0", "only_1"])
+    assert client.access("read", 1) == "only_1"
+    assert client.access("write", 9, "nine") is None
+    print("Passed bulk load test\n")
+
+
+def test_access_many():
+    print("\n=== Batched accesses ===")
+    N, batch_size = 500, 8
+    for client in [Client(N, B=256, treetop_budget=4096), PathORAMClient(N, B=256, treetop_budget=4096),
+                   recursiveClient(N, B=256)]:
+        sizes = []
+        read_paths = client.server.read_paths
+        client.server.read_paths = lambda leaves, start=0: sizes.append(len(leaves)) or read_paths(leaves, start)
+
+        requests = [("write", i, f"many_{i}") for i in range(0, N, 3)]
+        assert client.access_many(requests, batch_size) == [None] * len(requests)
+        # repeated blocks are served from the stash within a batch
+        results = client.access_many([("read", 3, None), ("write", 3, "again"), ("read", 3, None), ("read", 6, None)],
+                                     batch_size)
+        assert results == ["many_3", "many_3", "again", "many_6"], results
+        client.dummy_access(batch_size)
+        results = client.access_many([("read", i, None) for i in range(0, N, 3)], batch_size)
+        assert results == ["again" if i == 3 else f"many_{i}" for i in range(0, N, 3)]
+        assert client.access("read", 9) == "many_9"
+        assert set(sizes) == {batch_size}, "every batch reads the same number of paths"
+        assert len(client.S) < 50, f"stash grew to {len(client.S)} blocks"
+    print("Passed batched accesses test\n")
+
+
+def test_reverse_lex_eviction():
+    print("\n=== Reverse lexicographic eviction ===")
+    N = 512
+    for Z, evictions_per_access in [(2, 1), (3, 1), (2, 2)]:
+        client = Client(N, B=256, Z=Z, treetop_budget=1024, eviction="reverse_lex", evictions_per_access=evictions_per_access)
+        assert client.L == Client(N, B=256, Z=Z).L
+        max_stash = 0
+        for i in range(N):
+            client.access("write", i, f"lex_{i}")
+            max_stash = max(max_stash, len(client.S))
+        for _ in range(2):
+            for i in random.sample(range(N), N):
+                val = client.access("read", i)
+                assert val == f"lex_{i}", f"Expected lex_{i}, got {val}"
+                max_stash = max(max_stash, len(client.S))
+        results = client.access_many([("read", i, None) for i in range(0, N, 5)], 8)
+        assert results == [f"lex_{i}" for i in range(0, N, 5)]
+        # every access evicted evictions_per_access paths in turn
+        assert client._evictions == evictions_per_access * (3 * N + 8 * len(results[::8]))
+        print(f"Z={Z}, {evictions_per_access} eviction(s) per access: max stash {max_stash} blocks")
+        assert max_stash < 40, f"stash grew to {max_stash} blocks"
+
+    client = Client(16, B=256, Z=2, eviction="reverse_lex")
+    try:
+        client.access("read", 3)
+        assert False, "read of a missing block succeeded"
+    except KeyError:
+        pass
+    assert [client._eviction_leaves(1)[0] for _ in range(4)] == [4, 2, 6, 1]  # L=3, after leaf 0
+    print("Passed reverse lexicographic eviction test\n")
+
+
+def test_bucket_sizes():
+    print("\n=== Per-level bucket sizes ===")
+    N = 512
+    sizes = level_bucket_sizes(N, 9)
+    uniform = Client(N, L=9, B=256, Z=4)
+    with CryptoPool(2) as pool:
+        for client in [Client(N, B=256, bucket_sizes=sizes), Client(N, B=256, bucket_sizes=sizes, storage=MMapStorage()),
+                       Client(N, B=256, bucket_sizes=sizes, crypto_pool=pool, dummy_pool_size=64, treetop_budget=2048),
+                       Client(N, B=256, bucket_sizes=sizes, initial_data=[f"size_{i}" for i in range(N)]),
+                       PathORAMClient(N, B=256, bucket_sizes=sizes, crypto_pool=pool)]:
+            assert client.L == 9 and client._total_N < uniform._total_N
+            for i in range(N):
+                client.access("write", i, f"size_{i}")
+            for i in random.sample(range(N), N):
+                val = client.access("read", i)
+                assert val == f"size_{i}", f"Expected size_{i}, got {val}"
+            results = client.access_many([("read", i, None) for i in range(0, N, 3)], 8)
+            assert results == [f"size_{i}" for i in range(0, N, 3)]
+            assert len(client.S) < 40, f"stash grew to {len(client.S)} blocks"
+
+    try:
+        Client(N, B=256, bucket_sizes=sizes, cipher=AESGCMCipher())
+        assert False, "bucket granularity cipher accepted different bucket sizes"
+    except ValueError:
+        pass
+
+    client = RORAMClient(32, bucket_sizes=[4, 4, 3, 2, 2, 1])
+    client.access(5, 3, "write", ["a", "b", "c"])
+    client.access(20, 8, "write", [f"r_{k}" for k in range(8)])
+    d = client.access(5, 3, "read")
+    assert [d[5][0], d[6][0], d[7][0]] == ["a", "b", "c"], f"Unexpected range {d}"
+    d = client.access(20, 8, "read")
+    assert [d[20 + k][0] for k in range(8)] == [f"r_{k}" for k in range(8)], f"Unexpected range {d}"
+    print("Passed per-level bucket sizes test\n")
+
+
+def test_roram_shared_records():
+    print("\n=== rORAM block records shared by the sub-ORAMs ===")
+    client = RORAMClient(64, B=256)
+    client.access(8, 8, "write", [f"shared_{k}" for k in range(8)])
+    d = client.access(8, 8, "read")
+    assert [d[8 + k][0] for k in range(8)] == [f"shared_{k}" for k in range(8)], f"Unexpected range {d}"
+    for a in range(8, 16):
+        holders = [client.R[j].S[a] for j in range(client.l + 1) if a in client.R[j].S]
+        assert all(record is holders[0] for record in holders), "stashes hold different records of a block"
+        assert all(list(record) == d[a] for record in holders)
+        d[a][0] = "changed by the caller"
+        assert all(record.data == f"shared_{a - 8}" for record in holders), "the result aliases the stashes"
+    print("Passed rORAM shared records test\n")
+
+
+def test_roram_construction():
+    print("\n=== rORAM trees built at construction ===")
+    random.seed(3)
+    N = 256
+    client = RORAMClient(N, L=16, B=256, initial_data=[f"init_{a}" for a in range(N)])
+    stash = max(len(Rj.S) for Rj in client.R)
+    print(f"Largest stash after construction: {stash}")
+    assert stash < N // 8, f"{stash} blocks left in a stash"
+    for a in range(0, N - 16, 16): # an access also reads the next range
+        d = client.access(a, 16, "read")
+        assert [d[a + k][0] for k in range(16)] == [f"init_{a + k}" for k in range(16)], f"Unexpected range at {a}"
+
+    # the copies left in the trees by an access are never read again
+    client.access(32, 4, "write", ["new"] * 4)
+    for r in (1, 2, 4, 8, 16):
+        d = client.access(32, r, "read")
+        assert [d[32 + k][0] for k in range(r)] == ["new"] * min(r, 4) + [f"init_{32 + k}" for k in range(4, r)]
+
+    assert RORAMClient(8, B=256).access(2, 2, "read")[3][0] == ""
+    try:
+        RORAMClient(8, B=256, initial_data=range(9))
+        assert False, "too many initial values were accepted"
+    except ValueError:
+        pass
+    print("Passed rORAM construction test\n")
+
+
+def test_roram_slices():
+    print("\n=== rORAM multi-slice reads and writes ===")
+    client = RORAMClient(64, B=256, bucket_sizes=[2, 3, 4, 4, 3, 2, 2])
+    server = client.R[2].server
+    # a wrapping slice is the end of its level followed by its start
+    assert server.read_slices([(3, 6, 4)]) == server.read_slice(7 + 6, 7 + 8) + server.read_slice(7, 7 + 2)
+    assert server.read_slices([(1, 1, 8), (0, 0, 1)]) == server.read_slice(2, 3) + server.read_slice(1, 2) + server.read_slice(0, 1)
+    slots = server.read_slices([(4, 14, 3), (2, 1, 2)])
+    server.write_slices([(4, 14, 3), (2, 1, 2)], slots)
+    assert server.read_slices([(4, 14, 3), (2, 1, 2)]) == slots
+    try:
+        server.write_slices([(2, 0, 1)], [])
+        assert False, "write of missing slots succeeded"
+    except ValueError:
+        pass
+
+    # construction writes the tree of every sub-ORAM one level (one request) at a time
+    writes = []
+    def storage_factory():
+        storage = InMemoryStorage()
+        storage.write_ranges = lambda ranges, slots, write=storage.write_ranges: writes.append(len(slots)) or write(ranges, slots)
+        return storage
+    built = RORAMClient(64, B=256, storage_factory=storage_factory)
+    assert writes == [1] * (built.h + 1) * (built.l + 1), writes
+
+    # an access is one read request for both ranges, then one read and one write request per sub-ORAM
+    requests = []
+    for Rj in client.R:
+        storage = Rj.server.data
+        storage.read_ranges = lambda ranges, j=Rj.i, read=storage.read_ranges: requests.append(("read", j)) or read(ranges)
+        storage.write_ranges = lambda ranges, slots, j=Rj.i, write=storage.write_ranges: requests.append(("write", j)) or write(ranges, slots)
+    client.access(20, 4, "write", ["slice"] * 4)
+    assert requests == [("read", 2)] + [(op, j) for j in range(client.l + 1) for op in ("read", "write")], requests
+    assert [client.access(20, 4, "read")[20 + k][0] for k in range(4)] == ["slice"] * 4
+    print("Passed rORAM slices test\n")
+
+
+def test_roram_batch_evict():
+    print("\n=== rORAM batch eviction ===")
+    client = RORAMClient(64, B=256)
+    R = client.R[2]
+    cnt, k = 13, 10
+    client.cnt[0] = cnt
+    R.batch_evict(k)
+    for j in range(R.h + 1):
+        targets = {(cnt + t) % 2 ** j for t in range(k)}
+        for r in range(2 ** j):
+            bucket = [(a, record) for a, record in R._open_bucket(R.server.read_slice(2 ** j - 1 + r, 2 ** j + r)) if a != -1]
+            assert len(bucket) <= R.bucket_sizes[j]
+            for a, record in bucket:
+                assert record.positions[R.i] % 2 ** j == r, f"block {a} is not on a path through bucket {r} of level {j}"
+            # a block stays in the stash only if every evicted bucket it could go to is full
+            if r in targets:
+                for a, record in R.S.items():
+                    if record.positions[R.i] % 2 ** j == r:
+                        assert len(bucket) == R.bucket_sizes[j], f"block {a} could have been evicted to level {j}"
+    print("Passed rORAM batch eviction test\n")
+
+
+def test_roram_parallel_eviction():
+    print("\n=== rORAM eviction of the sub-ORAMs on a thread pool ===")
+    states = []
+    with ThreadPoolExecutor(4) as pool:
+        for eviction_pool in [None, pool]:
+            random.seed(7)
+            client = RORAMClient(64, B=256, eviction_pool=eviction_pool)
+            client.access(5, 3, "write", ["a", "b", "c"])
+            client.access(20, 16, "write", [f"p_{k}" for k in range(16)])
+            d = client.access(5, 3, "read")
+            assert [d[5][0], d[6][0], d[7][0]] == ["a", "b", "c"], f"Unexpected range {d}"
+            d = client.access(20, 16, "read")
+            assert [d[20 + k][0] for k in range(16)] == [f"p_{k}" for k in range(16)], f"Unexpected range {d}"
+            assert client.cnt[0] == 2 * (8 + 32)
+            states.append([{a: list(record) for a, record in Rj.S.items()} for Rj in client.R])
+    assert states[0] == states[1], "concurrent evictions ended in a different state"
+    print("Passed rORAM parallel eviction test\n")
+
+
 def test_basic_both():
     test_basic_write_read(Client, "single-level Path ORAM")
     test_basic_write_read(recursiveClient, "recursive Path ORAM")
@@ -32,3 +376,16 @@ def test_basic_both():
 
 if __name__ == "__main__":
     test_basic_both()
+    test_path_round_trips()
+    test_recursive_accesses()
+    test_position_map_chunks()
+    test_treetop_cache()
+    test_bulk_load()
+    test_access_many()
+    test_reverse_lex_eviction()
+    test_bucket_sizes()
+    test_roram_shared_records()
+    test_roram_construction()
+    test_roram_slices()
+    test_roram_batch_evict()
+    test_roram_parallel_eviction()
@@ -0,0 +1,41 @@
+from cipher import FernetCipher, AESGCMCipher, ChaCha20Poly1305Cipher
+from recursive_path_oram_client import Client
+from basic_path_oram_client import PathORAMClient
+
+
+def test_cipher_engines():
+    print("\n=== Cipher engines ===")
+    engines = {
+        "fernet": FernetCipher,
+        "aes-gcm per block": lambda: AESGCMCipher(granularity="block"),
+        "aes-gcm per bucket": AESGCMCipher,
+        "chacha20-poly1305 per bucket": ChaCha20Poly1305Cipher,
+    }
+    N = 16
+    for label, engine in engines.items():
+        for client_class in [Client, PathORAMClient]:
+            client = client_class(N, B=512, cipher=engine())
+            for i in range(N):
+                client.access("write", i, f"{label}_{i}")
+            for i in range(N):
+                val = client.access("read", i)
+                assert val == f"{label}_{i}", f"Expected {label}_{i}, got {val}"
+        print(f"Passed {label}")
+
+
+def test_bucket_sealing():
+    print("\n=== Bucket sealing ===")
+    Z, B = 4, 128
+    cipher = AESGCMCipher()
+    blocks = [bytes([k]) * B for k in range(Z)]
+    slots = cipher.seal(blocks)
+    assert len(slots) == cipher.slots_per_bucket(Z) == 1
+    assert len(slots[0]) == Z * B + AESGCMCipher.NONCE_SIZE + AESGCMCipher.TAG_SIZE  # raw output, one nonce and tag
+    assert [bytes(block) for block in cipher.open(slots, B)] == blocks
+    assert cipher.seal(blocks) != slots  # fresh nonce every time
+    print("Passed bucket sealing test\n")
+
+
+if __name__ == "__main__":
+    test_cipher_engines()
+    test_bucket_sealing()
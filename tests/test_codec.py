@@ -0,0 +1,40 @@
+from block_codec import BinaryBlockCodec, JSONBlockCodec
+from recursive_path_oram_client import Client
+
+
+def test_codec_roundtrip():
+    print("\n=== Block codec round trip ===")
+    B = 256
+    for codec in [BinaryBlockCodec(B), JSONBlockCodec(B)]:
+        for a, data, positions in [(3, "text", [5]), (-1, "", []), (7, [1, 2], [0, 4, 9]), (2, {"k": 1}, [1])]:
+            block = codec.encode(a, data, positions)
+            assert len(block) == B, f"{type(codec).__name__}: encoded {len(block)} bytes, expected {B}"
+            assert codec.decode(block) == (a, data, positions), f"{type(codec).__name__}: mismatch for {a}"
+
+    codec = BinaryBlockCodec(B)
+    payload = bytes(range(256))[:B - codec.overhead(1)]
+    assert codec.decode(codec.encode(1, payload, [2])) == (1, payload, [2])
+    try:
+        codec.encode(1, payload + b"!", [2])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("oversized block was accepted")
+    print("Passed codec round trip\n")
+
+
+def test_binary_values():
+    print("\n=== Binary values in Path ORAM ===")
+    N = 16
+    client = Client(N, B=1024)
+    for i in range(N):
+        client.access("write", i, bytes([i]) * 100 + b"\x00\x00")
+    for i in range(N):
+        val = client.access("read", i)
+        assert val == bytes([i]) * 100 + b"\x00\x00", f"Mismatch on block {i}: {val!r}"
+    print("Passed binary values test\n")
+
+
+if __name__ == "__main__":
+    test_codec_roundtrip()
+    test_binary_values()
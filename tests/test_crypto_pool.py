@@ -0,0 +1,106 @@
+import gc
+import pickle
+from cipher import AESGCMCipher, FernetCipher
+import time
+from crypto_pool import CryptoPool, DummyPool
+from recursive_path_oram_client import Client, recursiveClient
+from basic_path_oram_client import PathORAMClient
+from roram.roram_client import RORAMClient
+
+
+def test_cipher_pickling():
+    print("\n=== Cipher pickling ===")
+    for cipher in [AESGCMCipher(), AESGCMCipher(granularity="block"), FernetCipher()]:
+        copy = pickle.loads(pickle.dumps(cipher))
+        assert copy.decrypt(cipher.encrypt(b"secret")) == b"secret"
+    print("Passed cipher pickling test\n")
+
+
+def test_crypto_pool():
+    print("\n=== Parallel crypto pool ===")
+    N = 64
+    for kind in ["thread", "process"]:
+        with CryptoPool(workers=4, kind=kind) as pool:
+            for client in [Client(N, B=512, crypto_pool=pool), PathORAMClient(N, B=512, crypto_pool=pool),
+                           recursiveClient(N, B=512, crypto_pool=pool)]:
+                for i in range(N):
+                    client.access("write", i, f"{kind}_{i}")
+                assert client.access_many([("read", i, None) for i in range(N)], 8) == [f"{kind}_{i}" for i in range(N)]
+
+            # shared by all the sub-ORAMs
+            client = RORAMClient(32, crypto_pool=pool)
+            assert all(R.crypto_pool is pool for R in client.R)
+            client.access(5, 3, "write", ["a", "b", "c"])
+            D = client.access(5, 3, "read")
+            assert [D[5][0], D[6][0], D[7][0]] == ["a", "b", "c"]
+        print(f"Passed {kind} pool")
+    print("Passed parallel crypto pool test\n")
+
+
+def test_dummy_pool():
+    print("\n=== Encrypted dummy pool ===")
+    Z, B = 4, 128
+    for cipher in [AESGCMCipher(granularity="block"), AESGCMCipher(), FernetCipher()]:
+        dummy_block = bytes(B)
+        pool = DummyPool(cipher, dummy_block, Z, capacity=32)
+        while pool.stats()["size"] < 32:
+            time.sleep(0.01)
+        seen = set()
+        for k in range(Z + 1):
+            slots = pool.seal([bytes([1]) * B] * k)
+            assert len(slots) == cipher.slots_per_bucket(Z)
+            assert [bytes(block) for block in cipher.open(slots, B)] == [bytes([1]) * B] * k + [dummy_block] * (Z - k)
+            assert not seen & set(map(bytes, slots)), "dummy ciphertext reused"
+            seen |= set(map(bytes, slots))
+        stats = pool.stats()
+        assert stats["served"] > 0 and stats["starved"] == 0 and stats["refill_rate"] > 0, stats
+        pool.close()
+
+    # drained pools fall back to inline encryption
+    pool = DummyPool(AESGCMCipher(granularity="block"), bytes(B), Z, capacity=1)
+    for _ in range(100):
+        pool.seal([])
+    assert pool.stats()["served"] + pool.stats()["starved"] == 100 * Z
+    pool.close()
+
+    N = 64
+    for client in [Client(N, B=512, dummy_pool_size=64), PathORAMClient(N, B=512, dummy_pool_size=64),
+                   recursiveClient(N, B=512, dummy_pool_size=64)]:
+        for i in range(N):
+            client.access("write", i, f"pooled_{i}")
+        for i in range(N):
+            assert client.access("read", i) == f"pooled_{i}"
+        assert client.dummy_pool.stats()["served"] > 0
+        client.close()
+        client.dummy_pool._thread.join(5)
+        assert not client.dummy_pool._thread.is_alive(), "refill thread still running after close"
+    with RORAMClient(32, dummy_pool_size=64) as client:
+        client.access(5, 3, "write", ["a", "b", "c"])
+        D = client.access(5, 3, "read")
+        assert [D[5][0], D[6][0], D[7][0]] == ["a", "b", "c"]
+    pools = [Ri.dummy_pool for Ri in client.R]
+
+    # closing a recursive client stops the pools of all its levels
+    with recursiveClient(2000, B=64, dummy_pool_size=8) as client:
+        level = client
+        while level.position is None:
+            pools.append(level.dummy_pool)
+            level = level.position_map._oram
+        pools.append(level.dummy_pool)
+    assert len(pools) > 6
+    for pool in pools:
+        pool._thread.join(5)
+        assert not pool._thread.is_alive(), "refill thread still running after close"
+
+    # the refill thread of a pool that is never closed stops once the pool is collected
+    thread = DummyPool(AESGCMCipher(granularity="block"), bytes(B), Z, capacity=4)._thread
+    gc.collect()
+    thread.join(5)
+    assert not thread.is_alive(), "refill thread keeps a collected pool alive"
+    print("Passed encrypted dummy pool test\n")
+
+
+if __name__ == "__main__":
+    test_cipher_pickling()
+    test_crypto_pool()
+    test_dummy_pool()
@@ -0,0 +1,93 @@
+import socket
+import time
+import network
+from network import LocalServer, RemoteError
+from recursive_path_oram_client import Client, recursiveClient
+from roram.roram_client import RORAMClient
+
+
+def test_remote_storage():
+    print("\n=== Remote storage ===")
+    with LocalServer() as server:
+        storage = server.storage("tree")
+        storage.allocate(8, 4)
+        storage.write_range(0, 8, [bytes([k]) * 4 for k in range(8)])
+        storage.write(3, b"abcd")
+        assert bytes(storage.read(3)) == b"abcd"
+        ranges = storage.read_ranges([(6, 8), (0, 1)])
+        assert [[bytes(slot) for slot in slots] for slots in ranges] == [[b"\x06" * 4, b"\x07" * 4], [b"\x00" * 4]]
+        storage.close()
+
+        # reconnecting by name reopens the storage
+        reopened = server.storage("tree")
+        assert len(reopened) == 8 and reopened.slot_size == 4
+        assert bytes(reopened.read(3)) == b"abcd"
+        try:
+            reopened._request(99)
+            assert False, "invalid opcode was accepted"
+        except RemoteError:
+            pass
+    print("Passed remote storage test\n")
+
+
+def test_clients_on_remote_storage():
+    print("\n=== Clients on remote storage ===")
+    with LocalServer() as server:
+        N = 64
+        for client in [Client(N, B=512, storage=server.storage()), recursiveClient(N, B=256, storage_factory=server.storage)]:
+            for i in range(N):
+                client.access("write", i, f"remote_{i}")
+            for i in range(N):
+                assert client.access("read", i) == f"remote_{i}"
+
+        client = RORAMClient(16, storage_factory=server.storage)
+        client.access(5, 3, "write", ["a", "b", "c"])
+        d = client.access(5, 3, "read")
+        assert [d[5][0], d[6][0], d[7][0]] == ["a", "b", "c"], f"Unexpected range {d}"
+    print("Passed clients on remote storage test\n")
+
+
+def test_pipelined_writes():
+    print("\n=== Pipelined requests under latency ===")
+    rtt = 0.05
+    with LocalServer(latency=rtt) as server:
+        storage = server.storage()
+        storage.allocate(64, 16)
+        start = time.perf_counter()
+        for k in range(64):
+            storage.write(k, bytes([k]) * 16)
+        assert bytes(storage.read(63)) == bytes([63]) * 16
+        elapsed = time.perf_counter() - start
+        storage.flush()
+        assert elapsed < 10 * rtt, f"65 pipelined requests took {elapsed:.2f}s at {rtt}s round trips"
+
+        client = Client(16, B=512, storage=server.storage())
+        start = time.perf_counter()
+        client.access("write", 1, "one")
+        assert client.access("read", 1) == "one"
+        elapsed = time.perf_counter() - start
+        assert elapsed < 4 * rtt, f"two accesses took {elapsed:.2f}s at {rtt}s round trips"
+    print("Passed pipelined requests test\n")
+
+
+def test_unread_responses():
+    print("\n=== Client not reading delayed responses ===")
+    with LocalServer(latency=0.01) as server:
+        def frame(request_id, op, body):
+            return network._FRAME.pack(network._FRAME.size - 4 + len(body), request_id, op) + body
+
+        read = network._COUNT.pack(1) + network._RANGE.pack(0, 256)
+        with socket.create_connection((server.host, server.port)) as sock:
+            sock.sendall(frame(0, network.OPEN, b"tree") + frame(1, network.ALLOCATE, network._GEOMETRY.pack(256, 4096)) +
+                         b"".join(frame(k, network.READ_RANGES, read) for k in range(2, 402))) # 400 MiB of responses
+            time.sleep(1)
+            buffered = sum(writer.transport.get_write_buffer_size() for writer in server.server._connections)
+            assert buffered < network._PENDING_RESPONSES * 2 ** 20, f"{buffered} bytes of responses buffered"
+    print("Passed unread responses test\n")
+
+
+if __name__ == "__main__":
+    test_remote_storage()
+    test_clients_on_remote_storage()
+    test_pipelined_writes()
+    test_unread_responses()
@@ -0,0 +1,66 @@
+from partition_oram import PartitionORAM
+
+
+def test_partition_oram():
+    print("\n=== Partition ORAM ===")
+    N = 200
+    with PartitionORAM(N, K=4, B=256) as oram:
+        for i in range(N):
+            assert oram.access("write", i, f"part_{i}") is None
+        for i in range(N):
+            val = oram.access("read", i)
+            assert val == f"part_{i}", f"Expected part_{i}, got {val}"
+        assert oram.access("write", 3, "three") == "part_3"
+
+        results = oram.access_many([("read", i, None) for i in range(0, N, 7)] + [("write", 7, "seven"), ("read", 7, None)])
+        assert results[:-2] == ["three" if i == 3 else f"part_{i}" for i in range(0, N, 7)]
+        assert results[-2:] == ["part_7", "seven"]
+
+        # every block is either in exactly one partition or in one eviction cache
+        for i in range(N):
+            p = oram.partition[i]
+            assert (oram.local[i] == -1) == (i in oram.caches[p])
+        assert all(len(free) + sum(1 for i in range(N) if oram.partition[i] == p and oram.local[i] != -1) == oram.partition_N
+                   for p, free in enumerate(oram.free))
+        print(f"Largest eviction cache: {oram.max_cache} blocks")
+
+    # small caches: extra evictions bring every cache back under cache_size before an access returns
+    with PartitionORAM(64, K=4, B=256, evictions_per_access=1, cache_size=2, slack=1) as oram:
+        for i in range(64):
+            oram.access("write", i, i)
+            assert all(len(cache) <= 2 for cache in oram.caches)
+        assert oram.access_many([("read", i, None) for i in range(0, 64, 3)]) == list(range(0, 64, 3))
+        assert all(len(cache) <= 2 for cache in oram.caches)
+        print(f"Largest eviction cache: {oram.max_cache} blocks, {oram.extra_rounds} extra eviction rounds")
+
+    # full partitions: an access that would overflow one raises before anything is read or written
+    with PartitionORAM(16, K=2, B=256, cache_size=0, slack=0) as oram:
+        overflows = 0
+
+        def access(op, a, value=None):
+            # retries until the new partition drawn for a has room; a failed attempt leaves everything as it was
+            nonlocal overflows
+            while True:
+                partition, local = list(oram.partition), list(oram.local)
+                try:
+                    return oram.access(op, a, value)
+                except RuntimeError:
+                    overflows += 1
+                    assert list(oram.partition) == partition and list(oram.local) == local
+
+        for i in list(range(16)) + [0] * 20: # once both partitions are full, a block moving to the other overflows it
+            access("write", i, i)
+        assert overflows > 0
+        assert all(access("read", i) == i for i in range(16))
+
+    with PartitionORAM(16, K=2, B=256) as oram:
+        try:
+            oram.access("read", 5)
+            assert False, "read of a missing block succeeded"
+        except KeyError:
+            pass
+    print("Passed partition ORAM test\n")
+
+
+if __name__ == "__main__":
+    test_partition_oram()
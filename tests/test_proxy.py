@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+from proxy import ORAMProxy
+from recursive_path_oram_client import Client, recursiveClient
+from basic_path_oram_client import PathORAMClient
+
+
+def test_proxy_threads():
+    print("\n=== Concurrent proxy (threads) ===")
+    N, batch_size = 256, 8
+    for client in [Client(N, B=256), PathORAMClient(N, B=256), recursiveClient(N, B=256)]:
+        sizes = []
+        read_paths = client.server.read_paths
+        client.server.read_paths = lambda leaves, start=0: sizes.append(len(leaves)) or read_paths(leaves, start)
+        errors = []
+        with ORAMProxy(client, batch_size) as proxy:
+            def worker(t):
+                try:
+                    for i in range(t, N, 16):
+                        proxy.write(i, f"proxy_{i}")
+                        assert proxy.read(i) == f"proxy_{i}"
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=worker, args=(t,)) for t in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert not errors, errors
+            assert proxy.rounds < proxy.requests, "concurrent requests were not batched"
+
+            # concurrent requests for one block share a round
+            futures = [proxy.submit("write", 7, f"seven_{k}") for k in range(20)] + [proxy.submit("read", 7)]
+            assert futures[-1].result() == "seven_19"
+            assert [future.result() for future in futures[1:20]] == [f"seven_{k}" for k in range(19)]
+        assert set(sizes) == {batch_size}, "every round reads the same number of paths"
+
+    # a missing block only fails its own request
+    with ORAMProxy(Client(4, B=256), batch_size) as proxy:
+        proxy.write(1, "one")
+        missing, present = proxy.submit("read", 3), proxy.submit("read", 1)
+        assert present.result() == "one"
+        try:
+            missing.result()
+            assert False, "read of a missing block succeeded"
+        except KeyError:
+            pass
+    print("Passed concurrent proxy (threads) test\n")
+
+
+def test_proxy_asyncio():
+    print("\n=== Concurrent proxy (asyncio) ===")
+    N = 64
+
+    async def main(proxy):
+        await asyncio.gather(*(proxy.awrite(i, f"task_{i}") for i in range(N)))
+        return await asyncio.gather(*(proxy.aread(i) for i in range(N)))
+
+    with ORAMProxy(Client(N, B=256), batch_size=16) as proxy:
+        assert asyncio.run(main(proxy)) == [f"task_{i}" for i in range(N)]
+        assert proxy.rounds <= 2 * N // 16 + 2, f"{proxy.rounds} rounds for {2 * N} requests"
+
+    # fixed rate rounds with dummy accesses while idle
+    with ORAMProxy(Client(N, B=256), batch_size=4, interval=0.01) as proxy:
+        proxy.write(1, "one")
+        time.sleep(0.1)
+        assert proxy.read(1) == "one"
+        assert proxy.dummy_rounds > 0
+    print("Passed concurrent proxy (asyncio) test\n")
+
+
+if __name__ == "__main__":
+    test_proxy_threads()
+    test_proxy_asyncio()
@@ -0,0 +1,96 @@
+from ring_oram_client import RingClient
+from recursive_path_oram_client import recursiveClient
+from proxy import ORAMProxy
+
+
+def test_ring_oram():
+    print("\n=== Ring ORAM ===")
+    N = 64
+    client = RingClient(N, B=256, Z=4, S=6, A=3)
+    for i in range(N):
+        client.access("write", i, f"ring_{i}")
+    for _ in range(3):
+        for i in range(N):
+            val = client.access("read", i)
+            assert val == f"ring_{i}", f"Expected ring_{i}, got {val}"
+    assert client.update(5, lambda old_data: old_data + "!") == "ring_5"
+    assert client.access("read", 5) == "ring_5!"
+    print(f"Stash size: {len(client.S)}")
+
+    # online reads fetch a single slot per bucket, plus the metadata of the path from its own small slots
+    requested = []
+    for server in (client.server, client.metadata_server):
+        server.read_blocks = lambda indices, server=server, read=server.read_blocks: \
+            requested.append((server, len(indices))) or read(indices)
+    client._round = 1 # no eviction on the next access
+    client.access("read", 7)
+    # then possibly early reshuffles
+    assert requested[:2] == [(client.metadata_server, client.L + 1), (client.server, client.L + 1)], requested
+    del client.server.read_blocks, client.metadata_server.read_blocks
+    metadata_size = client.metadata_server.data.slot_size
+    assert metadata_size < client.server.data.slot_size and metadata_size < client.B, metadata_size
+
+    # no bucket has been read more often than it has dummies
+    for b in range(2 ** (client.L + 1) - 1):
+        meta, = client._read_metadata([b])
+        assert meta.count < client.dummies and len(meta.valid_reals()) <= client.Z
+
+    try:
+        RingClient(8, B=256).access("read", 3)
+        assert False, "read of a missing block succeeded"
+    except KeyError:
+        pass
+    print("Passed Ring ORAM test\n")
+
+
+def test_ring_oram_bulk_and_recursive():
+    print("\n=== Ring ORAM bulk load and recursive position map ===")
+    N = 100
+    client = RingClient(N, B=256, initial_data=[f"bulk_{i}" for i in range(N)])
+    for i in range(N):
+        assert client.access("read", i) == f"bulk_{i}"
+
+    N = 1000 # more than one position map chunk
+    client = recursiveClient(N, B=256, client_class=RingClient)
+    assert isinstance(client.position_map._oram, RingClient)
+    for i in range(0, N, 7):
+        client.access("write", i, f"rec_{i}")
+    for i in range(0, N, 7):
+        val = client.access("read", i)
+        assert val == f"rec_{i}", f"Expected rec_{i}, got {val}"
+    print("Passed Ring ORAM bulk load and recursive test\n")
+
+
+def test_ring_oram_batches():
+    print("\n=== Ring ORAM access_many and proxy ===")
+    N = 64
+    client = RingClient(N, B=256, batch_size=4)
+    rounds = []
+    access_ops = client._access_ops
+    client._access_ops = lambda a, fs: rounds.append(a) or access_ops(a, fs)
+    results = client.access_many([("write", 1, "one"), ("read", 1, None), ("write", 2, "two"), ("read", 3, None)],
+                                 return_exceptions=True)
+    assert results[:3] == [None, "one", None] and isinstance(results[3], KeyError), results
+    assert rounds == [1, 2, 3, None], rounds # one access per distinct block, padded to the batch size
+    rounds.clear()
+    client.dummy_access()
+    assert rounds == [None] * 4
+    del client._access_ops
+    try:
+        client.access_many([("read", 5, None)])
+        assert False, "read of a missing block succeeded"
+    except KeyError:
+        pass
+    assert client.update_many([(2, lambda old: old + "!"), (2, None)]) == ["two", "two!"]
+
+    with ORAMProxy(client) as proxy:
+        for i in range(N):
+            proxy.submit("write", i, f"proxy_{i}")
+        assert [proxy.read(i) for i in range(N)] == [f"proxy_{i}" for i in range(N)]
+    print("Passed Ring ORAM access_many and proxy test\n")
+
+
+if __name__ == "__main__":
+    test_ring_oram()
+    test_ring_oram_bulk_and_recursive()
+    test_ring_oram_batches()
@@ -0,0 +1,90 @@
+import random
+from stash import Stash, level_bucket_sizes
+
+
+def test_evict_path():
+    print("\n=== Stash eviction ===")
+    L, Z = 5, 2
+    for _ in range(50):
+        S = Stash()
+        for a in range(40):
+            S[a] = (f"data_{a}", random.randint(0, 2 ** L - 1))
+        before = dict(S)
+        x = random.randint(0, 2 ** L - 1)
+        buckets = S.evict_path(x, L, Z)
+
+        assert len(buckets) == L + 1
+        for l, bucket in enumerate(buckets):
+            assert len(bucket) <= Z, f"bucket at level {l} holds {len(bucket)} > Z blocks"
+            for a, (data, pos) in bucket.items():
+                assert pos >> (L - l) == x >> (L - l), f"block {a} on leaf {pos} is not on the path to {x} at level {l}"
+                assert a not in S
+        evicted = {a: entry for bucket in buckets for a, entry in bucket.items()}
+        assert evicted | S == before
+
+        # greedy: a block stays in the stash only if every bucket it could have gone to is full
+        for a, (_, pos) in S.items():
+            deepest = L - (x ^ pos).bit_length()
+            assert all(len(buckets[l]) == Z for l in range(deepest + 1)), f"block {a} could have been evicted"
+    print("Passed stash eviction test\n")
+
+
+def test_evict_paths():
+    print("\n=== Stash eviction over several paths ===")
+    L, Z = 5, 2
+    for _ in range(50):
+        S = Stash()
+        for a in range(60):
+            S[a] = (f"data_{a}", random.randint(0, 2 ** L - 1))
+        before = dict(S)
+        leaves = [random.randint(0, 2 ** L - 1) for _ in range(4)]
+        buckets = S.evict_paths(leaves, L, Z)
+
+        union = {2 ** l - 1 + (x >> (L - l)) for x in leaves for l in range(L + 1)}
+        assert set(buckets) == union
+        for b, bucket in buckets.items():
+            l = (b + 1).bit_length() - 1
+            assert len(bucket) <= Z
+            for a, (data, pos) in bucket.items():
+                assert 2 ** l - 1 + (pos >> (L - l)) == b, f"block {a} on leaf {pos} is not below bucket {b}"
+        evicted = {a: entry for bucket in buckets.values() for a, entry in bucket.items()}
+        assert evicted | S == before
+
+        # a block stays in the stash only if every bucket of the union on its path is full
+        for a, (_, pos) in S.items():
+            for l in range(L + 1):
+                b = 2 ** l - 1 + (pos >> (L - l))
+                assert b not in union or len(buckets[b]) == Z, f"block {a} could have been evicted to {b}"
+    print("Passed stash eviction over several paths test\n")
+
+
+def test_level_bucket_sizes():
+    print("\n=== Per-level bucket sizes ===")
+    N, L = 4096, 12
+    sizes = level_bucket_sizes(N, L)
+    print(f"Bucket sizes for N={N}, L={L}: {sizes}")
+    assert len(sizes) == L + 1 and all(1 <= z <= 8 for z in sizes)
+    assert sizes[-1] < sizes[0], "leaves should be smaller than the root"
+    assert all(z >= z_next for z, z_next in zip(sizes, sizes[1:])), "buckets should shrink towards the leaves"
+    assert sum(sizes) <= 4 * (L + 1), f"path of {sum(sizes)} slots is longer than with Z=4"
+    slots = sum(2 ** l * z for l, z in enumerate(sizes))
+    assert N <= slots < (2 ** (L + 1) - 1) * 4, f"{slots} slots"
+    try:
+        level_bucket_sizes(N, 8, max_Z=4)
+        assert False, "too small buckets were accepted"
+    except ValueError:
+        pass
+
+    # eviction honors the capacity of every level
+    S = Stash()
+    for a in range(40):
+        S[a] = (f"data_{a}", random.randint(0, 2 ** 5 - 1))
+    buckets = S.evict_path(3, 5, [3, 3, 2, 2, 1, 1])
+    assert all(len(bucket) <= z for bucket, z in zip(buckets, [3, 3, 2, 2, 1, 1]))
+    print("Passed per-level bucket sizes test\n")
+
+
+if __name__ == "__main__":
+    test_evict_path()
+    test_evict_paths()
+    test_level_bucket_sizes()
@@ -0,0 +1,167 @@
+import os
+import tempfile
+from storage import InMemoryStorage, MMapStorage, ShardedStorage
+from cipher import AESGCMCipher
+from recursive_path_oram_client import Client
+from basic_path_oram_client import PathORAMClient
+from roram.roram_client import RORAMClient
+
+
+def test_mmap_storage_persists():
+    print("\n=== Memory-mapped storage ===")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "tree.oram")
+        storage = MMapStorage(path)
+        storage.allocate(8, 4)
+        storage.write_range(0, 8, [bytes([k]) * 4 for k in range(8)])
+        storage.write(3, b"abcd")
+        assert isinstance(storage.read(0), memoryview)
+        storage.close()
+
+        reopened = MMapStorage(path)
+        assert len(reopened) == 8 and reopened.slot_size == 4
+        assert [bytes(slot) for slot in reopened.read_range(2, 5)] == [b"\x02" * 4, b"abcd", b"\x04" * 4]
+
+        # closing while a read slot is referenced fails and leaves the storage usable
+        slot = reopened.read(3)
+        try:
+            reopened.close()
+            assert False, "closed with a referenced slot"
+        except BufferError:
+            pass
+        assert bytes(reopened.read(3)) == b"abcd"
+        slot.release()
+        reopened.close()
+    print("Passed memory-mapped storage test\n")
+
+
+def test_clients_on_mmap_storage():
+    print("\n=== Clients on memory-mapped storage ===")
+    N = 16
+    client = Client(N, B=512, storage=MMapStorage())
+    for i in range(N):
+        client.access("write", i, f"mmap_{i}")
+    for i in range(N):
+        val = client.access("read", i)
+        assert val == f"mmap_{i}", f"Expected mmap_{i}, got {val}"
+
+    for storage_factory in [InMemoryStorage, MMapStorage]:
+        client = RORAMClient(16, storage_factory=storage_factory)
+        client.access(5, 3, "write", ["a", "b", "c"])
+        d = client.access(5, 3, "read")
+        assert [d[5][0], d[6][0], d[7][0]] == ["a", "b", "c"], f"Unexpected range {d}"
+    print("Passed clients on memory-mapped storage test\n")
+
+
+def test_memory_mapped_position_map():
+    print("\n=== Memory-mapped position map ===")
+    with tempfile.TemporaryDirectory() as directory:
+        for client_class in [Client, PathORAMClient]:
+            path = os.path.join(directory, f"position_{client_class.__name__}.npy")
+            client = client_class(64, B=512, position_path=path)
+            client.access("write", 7, "seven")
+            leaf = int(client.position[7])
+            assert 0 <= leaf < 2 ** client.L
+            del client
+
+            reopened = client_class(64, B=512, position_path=path)
+            assert int(reopened.position[7]) == leaf, "position map was not persisted"
+            del reopened
+    print("Passed memory-mapped position map test\n")
+
+
+def test_clients_reopen():
+    print("\n=== Clients reopened after close ===")
+    N = 64
+    with tempfile.TemporaryDirectory() as directory:
+        def path(name):
+            return os.path.join(directory, name)
+        for client_class in [Client, PathORAMClient]:
+            name = client_class.__name__
+            key = AESGCMCipher().key
+            client = client_class(N, B=512, cipher=AESGCMCipher(key), storage=MMapStorage(path(name)),
+                                  treetop_budget=2048, state_path=path(f"{name}.state"))
+            for i in range(N):
+                client.access("write", i, f"{name}_{i}")
+            client.close()
+            client.server.data.close()
+            del client
+
+            reopened = client_class(N, B=512, cipher=AESGCMCipher(key), storage=MMapStorage(path(name)),
+                                    treetop_budget=2048, state_path=path(f"{name}.state"))
+            for i in range(N):
+                assert reopened.access("read", i) == f"{name}_{i}", f"{name} lost block {i}"
+            reopened.server.data.close()
+            try:
+                client_class(N, B=512, cipher=AESGCMCipher(key), state_path=path(f"{name}.state"))
+                assert False, "reopened on empty storage"
+            except ValueError:
+                pass
+
+        keys = [AESGCMCipher().key for _ in range(5)]
+        def factories():
+            ciphers, storages = iter(keys), iter(range(5))
+            return (lambda: AESGCMCipher(next(ciphers)), lambda: MMapStorage(path(f"roram_{next(storages)}")))
+        cipher_factory, storage_factory = factories()
+        client = RORAMClient(16, B=256, cipher_factory=cipher_factory, storage_factory=storage_factory,
+                             state_path=path("roram.state"))
+        client.access(4, 4, "write", ["a", "b", "c", "d"])
+        client.close()
+        for Ri in client.R:
+            Ri.server.data.close()
+
+        cipher_factory, storage_factory = factories()
+        reopened = RORAMClient(16, B=256, cipher_factory=cipher_factory, storage_factory=storage_factory,
+                               state_path=path("roram.state"))
+        d = reopened.access(4, 4, "read")
+        assert [d[4 + k][0] for k in range(4)] == ["a", "b", "c", "d"], f"Unexpected range {d}"
+        for Ri in reopened.R:
+            Ri.server.data.close()
+    print("Passed clients reopen test\n")
+
+
+def test_sharded_storage():
+    print("\n=== Sharded storage ===")
+    for layout in ["heap", "slices"]:
+        for num_shards in [1, 3, 4]:
+            storage = ShardedStorage(num_shards, top_levels=2, slots_per_bucket=2, layout=layout)
+            num_slots = (2 ** 6 - 1) * 2
+            storage.allocate(num_slots, 4)
+            located = {storage._locate(b) for b in range(2 ** 6 - 1)}
+            assert len(located) == 2 ** 6 - 1, "two buckets share a shard slot"
+            assert {shard for shard, _ in located} == set(range(num_shards))
+            storage.write_range(0, num_slots, [k.to_bytes(4, "little") for k in range(num_slots)])
+            assert [int.from_bytes(slot, "little") for slot in storage.read_range(0, num_slots)] == list(range(num_slots))
+            ranges = storage.read_ranges([(5, 9), (0, 2)])
+            assert [[int.from_bytes(slot, "little") for slot in slots] for slots in ranges] == [[5, 6, 7, 8], [0, 1]]
+            storage.close()
+
+    # the buckets below the top of a path come from every shard
+    storage = ShardedStorage(4, top_levels=2)
+    client = Client(200, B=512, storage=storage)
+    shards = {storage._locate(b)[0] for b in client.server._path(0, 2) + client.server._path(2 ** client.L - 1, 2)}
+    assert shards == {0, 3}
+    for i in range(200):
+        client.access("write", i, f"shard_{i}")
+    for i in range(200):
+        assert client.access("read", i) == f"shard_{i}"
+
+    client = Client(64, B=512, cipher=AESGCMCipher(granularity="block"), storage=ShardedStorage(3, slots_per_bucket=4))
+    for i in range(64):
+        client.access("write", i, f"block_{i}")
+    for i in range(64):
+        assert client.access("read", i) == f"block_{i}"
+
+    client = RORAMClient(32, storage_factory=lambda: ShardedStorage(4, layout="slices"))
+    client.access(5, 3, "write", ["a", "b", "c"])
+    d = client.access(5, 3, "read")
+    assert [d[5][0], d[6][0], d[7][0]] == ["a", "b", "c"], f"Unexpected range {d}"
+    print("Passed sharded storage test\n")
+
+
+if __name__ == "__main__":
+    test_mmap_storage_persists()
+    test_clients_on_mmap_storage()
+    test_memory_mapped_position_map()
+    test_clients_reopen()
+    test_sharded_storage()